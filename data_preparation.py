@@ -6,57 +6,103 @@ This file is to prepare data for generating words from file.
 It can generate n-gram words.
 """
 
-import re
 import os
 import sys
+import json
 import multiprocessing
 
+from gramutil import (DedupSet, PipelineJob, RangeJob, TokenStats, chainGrams,
+                      isCompressed, openGrams, prepareFile, shareObjects, sharedDedup,
+                      sharedPhrases, sharedSample)
+
 def ChainWords(gramNumber, fd, words):
         """Used to chain words into gramNumber
         Args:
             gramNumber, n-gram
             fd, output file
-            words, collections of words
+            words, iterable of words, consumed as a stream
         Return:
             return words left after generate grams
         """
-        assert gramNumber > 0, 'gramNumber must be greater than 0'
-        size = len(words)
-        for i in xrange(size - gramNumber + 1):
-            fd.write("\t".join(words[i:i+gramNumber]))
-            fd.write("\n")
-        return words[-(gramNumber - 1):]
+        return chainGrams([gramNumber], [fd], words)[0]
 
 
 def PrepareCommon(gramNumber, inputFile, outputFile):
     """split by non [A-Za-z0-9]+ characters"""
-    words = []
-    with open(outputFile, 'w') as outFd:
-        with open(inputFile, 'r') as inFd:
-            for line in inFd:
-                words.extend(re.split(r'[^0-9A-Za-z]+', line.strip()))
-                words = map(lambda word:word.lower(), words)
-                # empty or single character
-                words = filter(lambda word:len(word) > 1, words)
-                # pure number
-                words = filter(lambda word:not re.match(r'^[0-9]+$', word), words)
-                # number & a-z combination
-                words = filter(lambda word:not re.search(r'.*([0-9][a-z])|([a-z][0-9]).*', word), words)
-                # single repeated character
-                words = filter(lambda word: not re.match(r'^([a-z])\1*$', word), words)
-                words = ChainWords(gramNumber, outFd, words)
-        if words:
-            outFd.write("\t".join(words))
-            outFd.write("\n")
+    PrepareMulti(inputFile, [(gramNumber, outputFile)])
+
+
+def PrepareMulti(inputFile, outputs, cacheFile=None, mmapInput=False, profile=False,
+                 dedup=False, chars=False, sample=False, phrases=False, combine=False):
+    """Read and tokenize inputFile once for several n-grams
+    Args:
+        inputFile, text file
+        outputs, list of (gramNumber, outputFile)
+        cacheFile, prefix of a token id cache to read, or build on the way
+        mmapInput, scan a memory map of inputFile instead of its lines
+        profile, count rule rejections and time the stages
+        dedup, drop lines met before by the DedupSet shared with the worker
+        chars, write grams of CJK characters instead of words
+        sample, sample the lines with the LineSample shared with the worker
+        phrases, drop the phrases of the PhraseFilter shared with the worker
+        combine, write "gram\tcount" records instead of a line per gram
+    Return:
+        TokenStats if profile, otherwise None
+    """
+    stats = TokenStats() if profile else None
+    gramNumbers = [gramNumber for gramNumber, _ in outputs]
+    outFds = [openGrams(outputFile, combine=combine) for _, outputFile in outputs]
+    try:
+        prepareFile(inputFile, gramNumbers, outFds, cacheFile, mmapInput, stats,
+                    sharedDedup() if dedup else None, chars,
+                    sharedSample() if sample else None,
+                    sharedPhrases() if phrases else None)
+    finally:
+        for outFd in outFds:
+            outFd.close()
+    return stats
 
 class PrepareWords(object):
     """Prepare gram file and candidate file"""
+    CHUNK_SIZE = 64 << 20
 
-    def __init__(self, inputFile, outputGramFile, outputCandidateFile):
+    def __init__(self, inputFile, outputGramFile, outputCandidateFile,
+                 processes=None, chunkSize=CHUNK_SIZE, cacheFile=None,
+                 mmapInput=False, profile=False, dedup=False, chars=False,
+                 sample=None, phrases=None, pipeline=False, combine=False):
+        """
+        Files ending with .gz, .bz2, .xz or .lzma are read and written compressed.
+        The options are documented at the top of gramutil.
+        Args:
+            processes, pool size, number of cpus by default
+            chunkSize, inputs larger than this are split into byte ranges
+            cacheFile, prefix of a token id cache, read or built
+            mmapInput, tokenize a memory map of the input
+            profile, print rule rejections and stage timings as JSON
+            dedup, True or a DedupSet, drop repeated lines
+            chars, prepare grams of CJK characters instead of words
+            sample, a LineSample, prepare a sample of the input lines
+            phrases, a PhraseFilter, drop its phrases from the words
+            pipeline, prepare large inputs with a PipelineJob
+            combine, write "gram\tcount" records instead of a line per gram
+        """
         self._inputFile = inputFile
         assert os.path.exists(self._inputFile), 'File %s not existed' % self._inputFile
         self._outputGramFile = outputGramFile
         self._outputCandidateFile = outputCandidateFile
+        self._processes = processes or multiprocessing.cpu_count()
+        self._chunkSize = chunkSize
+        self._cacheFile = cacheFile
+        self._mmapInput = mmapInput
+        self._profile = profile
+        self._dedup = DedupSet() if dedup is True else dedup or None
+        self._chars = chars
+        assert not (chars and cacheFile), 'Character grams are not cached'
+        self._sample = sample
+        assert not (sample and cacheFile), 'Samples are not cached'
+        self._phrases = phrases
+        self._pipeline = pipeline
+        self._combine = combine
         self._args = []
 
     def chainWords(self, gramNumber, fd, words):
@@ -68,34 +114,12 @@ class PrepareWords(object):
         Return:
             return words left after generate grams
         """
-        assert gramNumber > 0, 'gramNumber must be greater than 0'
-        size = len(words)
-        for i in xrange(size - gramNumber + 1):
-            fd.write("\t".join(words[i:i+gramNumber]))
-            fd.write("\n")
-        return words[-(gramNumber - 1):]
+        return ChainWords(gramNumber, fd, words)
 
     def prepareCommon(self, gramNumber, inputFile, outputFile):
         """split by non [A-Za-z0-9]+ characters"""
         print "Start preparing: %s" % str(gramNumber)
-        words = []
-        with open(outputFile, 'w') as outFd:
-            with open(inputFile) as inFd:
-                for line in inFd:
-                    words.extend(re.split(r'[^0-9A-Za-z]+', line.strip()))
-                    words = map(lambda word:word.lower(), words)
-                    # empty or single character
-                    words = filter(lambda word:len(word) > 1, words)
-                    # pure number
-                    words = filter(lambda word:not re.match(r'^[0-9]+$', word), words)
-                    # number & a-z combination
-                    words = filter(lambda word:not re.search(r'.*([0-9][a-z])|([a-z][0-9]).*', word), words)
-                    # single repeated character
-                    words = filter(lambda word: not re.match(r'^([a-z])\1*$', word), words)
-                    words = self.chainWords(gramNumber, outFd, words)
-            if words:
-                outFd.write("\t".join(words))
-                outFd.write("\n")
+        PrepareCommon(gramNumber, inputFile, outputFile)
         print "End preparing: %s" % str(gramNumber)
 
     def prepareGram(self, gramNumber):
@@ -131,13 +155,68 @@ class PrepareWords(object):
         """
         self._args.append((candidateNumber, self._inputFile, self._outputCandidateFile))
 
+    def prepareGrams(self, gramNumbers, outputPattern):
+        """generate several n-gram files from the same tokenization pass
+        Args:
+            gramNumbers, list of n-gram, e.g. range(1, 6)
+            outputPattern, output file name with %s replaced by n
+        """
+        for gramNumber in gramNumbers:
+            self._args.append((gramNumber, self._inputFile, outputPattern % gramNumber))
+
     def run(self):
-        pool = multiprocessing.Pool(processes = 3)
-        for args in self._args:
-            print args
-            pool.apply_async(PrepareCommon, args)
+        """Tokenize each input file once, feeding all its requested n-grams"""
+        outputs = {}
+        for gramNumber, inputFile, outputFile in self._args:
+            outputs.setdefault(inputFile, []).append((gramNumber, outputFile))
+        for args in outputs.values():
+            outputFiles = [outputFile for _, outputFile in args]
+            assert len(set(outputFiles)) == len(outputFiles), 'Duplicated output %s' % outputFiles
+        if self._sample:
+            self._sample.total_bytes = sum(os.path.getsize(inputFile) for inputFile in outputs)
+        pool = multiprocessing.Pool(processes = self._processes, initializer=shareObjects,
+                                    initargs=(self._dedup, self._sample, self._phrases))
+        jobs = []
+        results = []
+        for inputFile, args in outputs.items():
+            print "Preparing %s into %s" % (inputFile,
+                                            ", ".join(outputFile for _, outputFile in args))
+            large = (not self._cacheFile and os.path.getsize(inputFile) > self._chunkSize
+                     and (self._pipeline or not isCompressed(inputFile)))
+            if large and self._phrases is not None:
+                print "Warning: %s is prepared by a single worker, as phrases may cross" \
+                    " its byte ranges" % inputFile
+            if large and self._phrases is None:
+                if self._pipeline:
+                    job = PipelineJob(inputFile, args, profile=self._profile,
+                                      dedup=self._dedup is not None, chars=self._chars,
+                                      sample=self._sample is not None, combine=self._combine)
+                else:
+                    job = RangeJob(inputFile, args, self._chunkSize, self._profile,
+                                   self._dedup is not None, self._chars,
+                                   self._sample is not None, combine=self._combine)
+                job.submit(pool)
+                jobs.append(job)
+            else:
+                results.append(pool.apply_async(PrepareMulti,
+                    (inputFile, args, self._cacheFile, self._mmapInput, self._profile,
+                     self._dedup is not None, self._chars, self._sample is not None,
+                     self._phrases is not None, self._combine)))
+        # pipelines queue their blocks until they finish
+        statsList = [job.finish() for job in jobs] + [result.get() for result in results]
         pool.close()
         pool.join()
+        if self._profile:
+            total = TokenStats()
+            for stats in statsList:
+                total.add(stats)
+            print json.dumps(total.report(), indent=1, sort_keys=True)
+        if self._dedup:
+            print "Removed %(removed_lines)d duplicated lines, %(removed_bytes)d bytes" % (
+                self._dedup.report())
+        if self._sample:
+            print "Sampled %(kept_lines)d of %(seen_lines)d lines, rate %(rate).6f" % (
+                self._sample.report())
 
 
 def test():
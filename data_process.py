@@ -19,55 +19,271 @@ frequency: 'I' = 1, 'love' = 1, 'to' = 1, 'embrace' = 1, we lost frequency of 'c
 import os
 import sys
 import math
-import pickle
+import shutil
 import argparse
+import tempfile
+import multiprocessing
 
 import pygtrie as trie
 from timeutil import TimeUtil
+from gramutil import GramCounter, dumpTrieFile, isCompressed, loadTrieFile, openFile, openGrams, \
+    prepareFile, shardFile, splitCount, splitRanges
+
+SEP = '\t'
+
+def newTrie(chars=False):
+    """Counting trie, keeping the sum of counts under every prefix"""
+    if chars:
+        return trie.CharCountingTrie()
+    return trie.StringCountingTrie(separator=SEP)
+
+def trieKey(key, chars=False):
+    """Key in the tries of a tab separated gram, the unicode string of its
+    characters if chars
+    """
+    if chars:
+        return key.replace(SEP, '').decode('utf-8')
+    return key
+
+def gramKeys(line):
+    """Tab separated keys of a gram line in pre_trie and post_trie, the
+    latter None unless the gram has 3 words
+    """
+    key = line.strip()
+    #I love to embrace, prefix(love to) = {embrace,...}, postfix(love to) = {I,...}
+    try:
+        #last line in gram-3 has only 2 column
+        preword, midword, postword = key.split(SEP)
+    except:
+        return key, None
+    return key, SEP.join([midword,postword,preword])
+
+def rangeLines(fd, length):
+    """Lines of the next length bytes of fd"""
+    while length > 0:
+        line = fd.readline()
+        if not line:
+            return
+        length -= len(line)
+        yield line
+
+def splitGramRange(gramFile, start, end, preFile, postFile, shards):
+    """Write the pre_trie and post_trie keys of the grams of a byte range of
+    gramFile as "key\tcount" records to shards of preFile and postFile, split
+    by a hash of their first tokens, in a worker of Process.buildTrieParallel
+    Args:
+        start, end, byte range at line boundaries, the whole file if end is
+            None
+    """
+    if end is None:
+        fd = openFile(gramFile)
+        lines = fd
+    else:
+        fd = open(gramFile, 'rb')
+        fd.seek(start)
+        lines = rangeLines(fd, end - start)
+    try:
+        with openGrams(preFile, shards) as preFd:
+            with openGrams(postFile, shards) as postFd:
+                for line in lines:
+                    gram, count = splitCount(line)
+                    preKey, postKey = gramKeys(gram)
+                    preFd.write("%s\t%d\n" % (preKey, count))
+                    if postKey is not None:
+                        postFd.write("%s\t%d\n" % (postKey, count))
+    finally:
+        fd.close()
+
+def buildShardTries(preFiles, postFiles, chars=False):
+    """Count the records of one shard of the keys written by splitGramRange,
+    in a worker of Process.buildTrieParallel
+    Return:
+        (pre_trie, post_trie) of the shard, frozen as they pickle back to the
+        parent a lot faster than counting tries
+    """
+    tries = []
+    for files in (preFiles, postFiles):
+        counting = newTrie(chars)
+        for file in files:
+            with openFile(file) as fd:
+                # keys may be blank, so records are not split with splitCount
+                records = (line[:-1].rpartition(SEP) for line in fd)
+                counting.increment_items((trieKey(key, chars), int(count))
+                                         for key, _, count in records)
+        tries.append(counting.freeze())
+    return tuple(tries)
 
 class Process(object):
-    """Generate score with gram file and candidate file"""
-    SEP = '\t'
+    """Generate score with gram file and candidate file.
+    Files ending with .gz, .bz2, .xz or .lzma are read and written compressed.
+    """
+    SEP = SEP
 
-    def __init__(self, gramFile, candidateFile, scoreFile):
+    def __init__(self, gramFile, candidateFile, scoreFile, chars=False, sampleRate=1.0):
+        """
+        Args:
+            chars, grams are of CJK characters, as prepared with chars=True.
+                They are counted in CharTries keyed by the unicode string of
+                their characters.
+            sampleRate, rate of the lines the grams were prepared from, as
+                printed by PrepareWords.run with a sample.  Counts are
+                scaled by it to estimate the full corpus.
+        """
         self._gramFile = gramFile
         self._candidateFile = candidateFile
         self._scoreFile = scoreFile
+        self._chars = chars
+        self._sampleRate = sampleRate
         """pre_trie"""
-        self._pretrie = trie.StringTrie(separator=Process.SEP)
+        self._pretrie = self.newTrie()
         self._pretrieFile = 'PreGramTrie'
         self._precache = {}
         """post_trie"""
-        self._posttrie = trie.StringTrie(separator=Process.SEP)
+        self._posttrie = self.newTrie()
         self._posttrieFile = 'PostGramTrie'
         self._postcache = {}
-        assert os.path.exists(gramFile), "GramFile %s not exists" % gramFile
         assert os.path.exists(candidateFile), "CandidateFile %s not exists" % candidateFile
 
-    def buildTrie(self):
-        """Generate StringTrie"""
-        with open(self._gramFile) as fd:
-            for line in fd:
-                key = line.strip()
-                self._pretrie.setdefault(key, 0)
-                self._pretrie[key] += 1
-
-                #I love to embrace, prefix(love to) = {embrace,...}, postfix(love to) = {I,...}
-                try:
-                    #last line in gram-3 has only 2 column
-                    preword, midword, postword = line.strip().split(Process.SEP)
-                except:
-                    continue
-                key = Process.SEP.join([midword,postword,preword])
-                self._posttrie.setdefault(key, 0)
-                self._posttrie[key] += 1
+    def newTrie(self):
+        """Counting trie, keeping the sum of counts under every prefix"""
+        return newTrie(self._chars)
+
+    def frozenTrie(self, loaded):
+        """Compact read-only trie of a loaded trie, summing counts under
+        prefixes even if pickled before sums were kept
+        """
+        if isinstance(loaded, trie.FrozenTrie):
+            return loaded
+        return loaded.freeze()
+
+    def freezeTries(self):
+        """Replace the tries, only read once built, by FrozenTries taking
+        a fraction of their memory
+        """
+        self._pretrie = self._pretrie.freeze()
+        self._posttrie = self._posttrie.freeze()
+
+    def trieKey(self, key):
+        """Key in the tries of a tab separated gram"""
+        return trieKey(key, self._chars)
+
+    def gramKeys(self, line):
+        """Tab separated keys of a gram line in pre_trie and post_trie"""
+        return gramKeys(line)
+
+    def countGram(self, line, count=1):
+        """Add count of a gram line to pre_trie and post_trie"""
+        preKey, postKey = self.gramKeys(line)
+        self._pretrie.increment(self.trieKey(preKey), count)
+        if postKey is not None:
+            self._posttrie.increment(self.trieKey(postKey), count)
+
+    def buildTrie(self, inputFile=None, gramNumber=3, writeGrams=False, cacheFile=None,
+                  sample=None, processes=None):
+        """Generate StringTrie.  gramFile may be of a line per gram or of
+        combined "gram\tcount" records, as prepared with combine=True.
+        Once built, the tries are frozen and can no longer be counted into.
+        Args:
+            inputFile, if given, grams of this text file are counted straight
+                from the tokenizer instead of being read back from gramFile
+            gramNumber, n-gram used with inputFile
+            writeGrams, with inputFile, also write the grams to gramFile
+            cacheFile, with inputFile, prefix of a token id cache to read,
+                or build on the way
+            sample, with inputFile, a LineSample the lines are sampled with.
+                Its rate becomes the sample rate of the scores.
+            processes, without inputFile, number of worker processes the
+                tries are built by, each counting the keys of its own first
+                tokens, see buildTrieParallel
+        """
+        if inputFile:
+            self.buildTrieFused(inputFile, gramNumber, writeGrams, cacheFile, sample)
+        elif processes > 1:
+            # workers freeze the tries of their shards
+            self.buildTrieParallel(processes)
+            return
+        else:
+            assert os.path.exists(self._gramFile), "GramFile %s not exists" % self._gramFile
+            with openFile(self._gramFile) as fd:
+                for line in fd:
+                    gram, count = splitCount(line)
+                    self.countGram(gram, count)
+        self.freezeTries()
 
         #with open(self._pretrieFile, 'w') as fd:
         #   pickle.dump(self._pretrie, fd)
 
+    def buildTrieParallel(self, processes):
+        """Build the tries in processes workers, in two rounds.  First each
+        worker splits the keys of a byte range of gramFile into shards by a
+        hash of their first token, the first word of pre_trie keys and the
+        middle word of post_trie ones.  Then each worker counts and freezes
+        the tries of the keys of its own shard.  As shards share no first
+        token, their tries share no root child and are joined at the root
+        by FrozenTrie.join, none of their keys is inserted again.
+        A compressed gramFile is split by a single worker.
+        """
+        assert os.path.exists(self._gramFile), "GramFile %s not exists" % self._gramFile
+        if isCompressed(self._gramFile):
+            ranges = [(0, None)]
+        else:
+            chunkSize = os.path.getsize(self._gramFile) // processes + 1
+            ranges = splitRanges(self._gramFile, chunkSize) or [(0, 0)]
+        tempDir = tempfile.mkdtemp(prefix='grams')
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            files = [(os.path.join(tempDir, 'pre%03d' % index),
+                      os.path.join(tempDir, 'post%03d' % index))
+                     for index in xrange(len(ranges))]
+            results = [pool.apply_async(splitGramRange, (self._gramFile, start, end, preFile,
+                                                         postFile, processes))
+                       for (start, end), (preFile, postFile) in zip(ranges, files)]
+            for result in results:
+                result.get()
+            results = [pool.apply_async(buildShardTries,
+                                        ([shardFile(preFile, shard) for preFile, _ in files],
+                                         [shardFile(postFile, shard) for _, postFile in files],
+                                         self._chars))
+                       for shard in xrange(processes)]
+            shards = [result.get() for result in results]
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(tempDir)
+        self._pretrie = trie.FrozenTrie.join(pre for pre, _ in shards)
+        self._posttrie = trie.FrozenTrie.join(post for _, post in shards)
+
+    def buildTrieFused(self, inputFile, gramNumber=3, writeGrams=False, cacheFile=None,
+                       sample=None):
+        """Tokenize inputFile and count its grams in memory, skipping the
+        gram file round trip unless writeGrams is set
+        """
+        gramFd = openFile(self._gramFile, 'w') if writeGrams else None
+        try:
+            counter = GramCounter(gramFd)
+            prepareFile(inputFile, [gramNumber], [counter], cacheFile, chars=self._chars,
+                        sample=sample)
+        finally:
+            if gramFd:
+                gramFd.close()
+        if sample:
+            self._sampleRate = sample.rate
+        counts = counter.counts
+        while counts:
+            line, count = counts.popitem()
+            self.countGram(line, count)
+
+    def saveTrie(self, file):
+        """Write pre_trie in the format of pygtrie.MappedTrie, which
+        generateScore(file) opens in place instead of unpickling, sharing
+        its pages with other scoring processes of the host
+        """
+        dumpTrieFile(self._pretrie, file, mapped=True)
+
     def lazySum(self, key):
+        """Count of key and the grams it is a prefix of, 0 if none"""
         if not self._precache.has_key(key):
-            self._precache[key] = sum(self._pretrie.itervalues(prefix=key))
+            self._precache[key] = self._pretrie.prefix_sum(key)
         return self._precache[key]
 
     """
@@ -77,29 +293,34 @@ class Process(object):
     def generateScore(self, file=None):
 
         if file:
-            with open(file, 'rb') as fd:
-                self._pretrie = pickle.load(fd)
-        totalFreq = sum(self._pretrie.itervalues())
-        with open(self._scoreFile, 'w') as outFd:
-            with open(self._candidateFile) as fd:
+            # dumped, pickled, or mapped as written by saveTrie
+            self._pretrie = self.frozenTrie(loadTrieFile(file))
+        totalFreq = self._pretrie.prefix_sum()
+        with openFile(self._scoreFile, 'w') as outFd:
+            with openFile(self._candidateFile) as fd:
                 for line in fd:
-                    words = line.strip().split('\t')
-                    if len(words) < 2 or any(map(lambda word:len(word)<2, words)):
+                    # candidates may be combined records, scored once each
+                    line = splitCount(line)[0]
+                    words = line.split('\t')
+                    if len(words) < 2 or (not self._chars and
+                                          any(map(lambda word:len(word)<2, words))):
                         continue
-                    try:
-                        # The last word in the whole text is lost frequency
-                        XFreq = self.lazySum(words[0])
-                        YFreq = self.lazySum(words[1])
-                    except:
+                    # The last word in the whole text is lost frequency
+                    XFreq = self.lazySum(self.trieKey(words[0]))
+                    YFreq = self.lazySum(self.trieKey(words[1]))
+                    if XFreq == 0 or YFreq == 0:
                         continue
-                    XYFreq = self.lazySum(line.strip())
+                    XYFreq = self.lazySum(self.trieKey(line.strip()))
+                    # probabilities of a sample estimate the full ones, its
+                    # counts are scaled up
+                    fullXYFreq = XYFreq / self._sampleRate
                     # frequences filter
-                    if XYFreq < 2 or XYFreq > 24:
+                    if fullXYFreq < 2 or fullXYFreq > 24:
                         continue
                     PX = XFreq * 1.0 / totalFreq
                     PY = YFreq * 1.0 / totalFreq
                     PXY = XYFreq * 1.0 / totalFreq
-                    pmi = math.log(PXY/PX/PY, 2) * XYFreq
+                    pmi = math.log(PXY/PX/PY, 2) * fullXYFreq
                     result = "{0}\t{1:.2f}\n".format(line.strip(), pmi)
                     outFd.write(result)
     """
@@ -107,17 +328,14 @@ class Process(object):
     H(x) = -sum(P(x)logP(x))
     """
     def computeEntropy(self, candidatekey):
+        candidatekey = self.trieKey(candidatekey)
         H_right = 0
-        sumright = 0
-        for item in self._pretrie.iteritems(prefix=candidatekey):
-            sumright += item[1]
+        sumright = self._pretrie.prefix_sum(candidatekey)
         for item in self._pretrie.iteritems(prefix=candidatekey):
             probility_x = 1.0*item[1]/sumright
             H_right += -probility_x*math.log(probility_x, 2)
         H_left = 0
-        sumleft = 0
-        for item in self._posttrie.iteritems(prefix=candidatekey):
-            sumleft += item[1]
+        sumleft = self._posttrie.prefix_sum(candidatekey)
         for item in self._posttrie.iteritems(prefix=candidatekey):
             probility_x = 1.0*item[1]/sumleft
             H_left += -probility_x*math.log(probility_x, 2)
@@ -142,7 +360,7 @@ def test():
     print prop._pretrie.has_key(key2)
     tu.elapsedSeconds()
     tu.reset()
-    print sum(prop._pretrie.itervalues(prefix='additional'))
+    print prop._pretrie.prefix_sum('additional')
     tu.elapsedSeconds()
     tu.reset()
     prop.generateScore()
@@ -6,62 +6,128 @@ This file is to prepare data for generating words from file.
 It can generate n-gram words.
 """
 
-import re
 import os
 import sys
 import glob
+import json
+import time
+import traceback
 import multiprocessing
 import multiprocessing.dummy # for test
 
 from timeutil import TimeUtil
+# gramutil is shared with the scripts of the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from gramutil import (DedupSet, Manifest, PipelineJob, RangeJob, TokenStats, chainGrams,
+                      isCompressed, openGrams, prepareFile, shardFile, shareObjects,
+                      sharedDedup, sharedPhrases, sharedSample)
 
 def chainWords(gram_number, fd, words):
         """Used to chain words into gramNumber
         Args:
             gramNumber, n-gram
             fd, output file
-            words, collections of words
+            words, iterable of words, consumed as a stream
         Return:
             return words left after generate grams
         """
-        assert gram_number > 0, 'gramNumber must be greater than 0'
-        size = len(words)
-        for i in xrange(size - gram_number + 1):
-            fd.write("\t".join(words[i:i+gram_number]))
-            fd.write("\n")
-        return words[-(gramNumber - 1):]
+        return chainGrams([gram_number], [fd], words)[0]
 
 
 def prepareCommon(gram_number, input_file, output_dir):
     """split by non [A-Za-z0-9]+ characters"""
-    words = []
+    prepareMulti(input_file, [(gram_number, output_dir)])
+
+
+def prepareMulti(input_file, outputs, cache_dir=None, use_mmap=False, profile=False,
+                 dedup=False, chars=False, sample=False, phrases=False, shards=None,
+                 combine=False):
+    """Read and tokenize input_file once for several n-grams
+    Args:
+        input_file, text file
+        outputs, list of (gram_number, output_dir)
+        cache_dir, directory of token id caches to read, or build on the way
+        use_mmap, scan a memory map of input_file instead of its lines
+        profile, count rule rejections and time the stages
+        dedup, drop lines met before by the DedupSet shared with the worker
+        chars, write grams of CJK characters instead of words
+        sample, sample the lines with the LineSample shared with the worker
+        phrases, drop the phrases of the PhraseFilter shared with the worker
+        shards, split the gram files into this many shards
+        combine, write "gram\tcount" records instead of a line per gram
+    Return:
+        TokenStats if profile, otherwise None
+    """
+    stats = TokenStats() if profile else None
     filename = os.path.basename(input_file)
-    output_file = os.path.join(output_dir, filename)
-    with open(output_file, 'w') as ofd:
-        with open(input_file, 'r') as ifd:
-            for line in ifd:
-                words.extend(re.split(r'[^0-9A-Za-z]+', line.strip()))
-                words = map(lambda word:word.lower(), words)
-                # empty or single character
-                words = filter(lambda word:len(word) > 1, words)
-                # pure number
-                words = filter(lambda word:not re.match(r'^[0-9]+$', word), words)
-                # number & a-z combination
-                words = filter(lambda word:not re.search(r'.*([0-9][a-z])|([a-z][0-9]).*', word), words)
-                # single repeated character
-                words = filter(lambda word: not re.match(r'^([a-z])\1*$', word), words)
-                # include character repeated > 3
-                words = filter(lambda word: not re.search(r'([a-z])\1{2,}', word), words)
-                words = chainWords(gram_number, ofd, words)
-        if words:
-            ofd.write("\t".join(words))
-            ofd.write("\n")
+    gram_numbers = [gram_number for gram_number, _ in outputs]
+    cache_prefix = os.path.join(cache_dir, filename) if cache_dir else None
+    ofds = [openGrams(os.path.join(output_dir, filename), shards, combine)
+            for _, output_dir in outputs]
+    try:
+        prepareFile(input_file, gram_numbers, ofds, cache_prefix, use_mmap, stats,
+                    sharedDedup() if dedup else None, chars,
+                    sharedSample() if sample else None,
+                    sharedPhrases() if phrases else None)
+    finally:
+        for ofd in ofds:
+            ofd.close()
+    return stats
+
+def prepareBatch(jobs):
+    """Run prepareMulti for several files in one task
+    Args:
+        jobs, list of prepareMulti arguments
+    Return:
+        list of (input_file, seconds, error, stats), error is the formatted
+        traceback of a failed file or None, stats the TokenStats of a
+        profiled file or None
+    """
+    report = []
+    for args in jobs:
+        start = time.time()
+        stats = error = None
+        try:
+            stats = prepareMulti(*args)
+        except Exception:
+            error = traceback.format_exc()
+        report.append((args[0], time.time() - start, error, stats))
+    return report
 
 class PrepareWords(object):
     """Prepare gram file and candidate file"""
     PROCESS_LIMIT = 20
+    CHUNK_SIZE = 64 << 20
+    BATCH_SIZE = 4 << 20
 
-    def __init__(self, input, output_gram_dir, output_candidate_dir):
+    def __init__(self, input, output_gram_dir, output_candidate_dir,
+                 chunk_size=CHUNK_SIZE, cache_dir=None, use_mmap=False,
+                 batch_size=BATCH_SIZE, manifest_file=None, profile=False,
+                 dedup=False, chars=False, sample=None, phrases=None, shards=None,
+                 pipeline=False, combine=False):
+        """
+        Files ending with .gz, .bz2, .xz or .lzma are read compressed, and
+        their grams written compressed the same way.  The options are
+        documented at the top of gramutil.
+        Args:
+            chunk_size, files larger than this are split into byte ranges
+            batch_size, files smaller than this are grouped into tasks of
+                about this many bytes
+            cache_dir, directory of token id caches, one per input file
+            use_mmap, tokenize memory maps of the files
+            manifest_file, if given, only files new or modified since the
+                run recording them here, or missing an output, are prepared.
+                Outputs of recorded files no longer among the inputs are
+                removed.
+            profile, report rule rejections and stage timings as JSON
+            dedup, True or a DedupSet, drop repeated lines across the files
+            chars, prepare grams of CJK characters instead of words
+            sample, a LineSample, prepare a sample of the lines of the files
+            phrases, a PhraseFilter, drop its phrases from the words
+            shards, write each gram file as this many shards, name.shardK
+            pipeline, prepare large files with a PipelineJob
+            combine, write "gram\tcount" records instead of a line per gram
+        """
 
         self._input_files = []
         if os.path.isfile(input):
@@ -77,6 +143,22 @@ class PrepareWords(object):
         self._output_candidate_dir = output_candidate_dir
         assert os.path.exists(output_gram_dir), "Gram directory not exists"
         assert os.path.exists(output_candidate_dir), "Candidate directory not exists"
+        self._chunk_size = chunk_size
+        self._batch_size = batch_size
+        self._cache_dir = cache_dir
+        self._use_mmap = use_mmap
+        self._manifest = Manifest(manifest_file) if manifest_file else None
+        self._profile = profile
+        self._dedup = DedupSet() if dedup is True else dedup or None
+        self._chars = chars
+        assert not (chars and cache_dir), "Character grams are not cached"
+        self._sample = sample
+        assert not (sample and cache_dir), "Samples are not cached"
+        self._phrases = phrases
+        self._shards = shards
+        self._pipeline = pipeline
+        self._combine = combine
+        assert cache_dir is None or os.path.exists(cache_dir), "Cache directory not exists"
         self._args = []
 
     def chainWords(self, gramNumber, fd, words):
@@ -88,35 +170,13 @@ class PrepareWords(object):
         Return:
             return words left after generate grams
         """
-        assert gramNumber > 0, 'gramNumber must be greater than 0'
-        size = len(words)
-        for i in xrange(size - gramNumber + 1):
-            fd.write("\t".join(words[i:i+gramNumber]))
-            fd.write("\n")
-        return words[-(gramNumber - 1):]
+        return chainWords(gramNumber, fd, words)
 
-    def prepareCommon(gramNumber, inputFile, outputFile):
+    def prepareCommon(self, gram_number, input_file, output_dir):
         """split by non [A-Za-z0-9]+ characters"""
-        print "Start preparing: %s" % str(gramNumber)
-        words = []
-        with open(outputFile, 'w') as outFd:
-            with open(inputFile) as inFd:
-                for line in inFd:
-                    words.extend(re.split(r'[^0-9A-Za-z]+', line.strip()))
-                    words = map(lambda word:word.lower(), words)
-                    # empty or single character
-                    words = filter(lambda word:len(word) > 1, words)
-                    # pure number
-                    words = filter(lambda word:not re.match(r'^[0-9]+$', word), words)
-                    # number & a-z combination
-                    words = filter(lambda word:not re.search(r'.*([0-9][a-z])|([a-z][0-9]).*', word), words)
-                    # single repeated character
-                    words = filter(lambda word: not re.match(r'^([a-z])\1*$', word), words)
-                    words = self.chainWords(gramNumber, outFd, words)
-            if words:
-                outFd.write("\t".join(words))
-                outFd.write("\n")
-        print "End preparing: %s" % str(gramNumber)
+        print "Start preparing: %s" % str(gram_number)
+        prepareCommon(gram_number, input_file, output_dir)
+        print "End preparing: %s" % str(gram_number)
 
     def prepareGram(self, gram_number):
         """generate gram_number specified file
@@ -153,15 +213,189 @@ class PrepareWords(object):
         for file in self._input_files:
             self._args.append((candidate_number, file, self._output_candidate_dir))
 
+    def prepareGrams(self, gram_numbers, output_dir_pattern):
+        """generate several n-gram directories from the same tokenization pass
+        Args:
+            gram_numbers, list of n-gram, e.g. range(1, 6)
+            output_dir_pattern, output directory with %s replaced by n
+        """
+        for gram_number in gram_numbers:
+            output_dir = output_dir_pattern % gram_number
+            assert os.path.exists(output_dir), "Directory %s not exists" % output_dir
+            for file in self._input_files:
+                self._args.append((gram_number, file, output_dir))
+
+    def outputFile(self, output_dir, filename):
+        """Output written for filename, its first shard if sharded"""
+        return self.outputFiles(output_dir, filename)[0]
+
+    def outputFiles(self, output_dir, filename):
+        """Outputs written for filename, its shards if sharded"""
+        output_file = os.path.join(output_dir, filename)
+        if self._shards:
+            return [shardFile(output_file, shard) for shard in xrange(self._shards)]
+        return [output_file]
+
+    def removeOutputs(self, output_dirs):
+        """Remove the outputs of the files recorded by the manifest which are
+        no longer inputs, so their grams are not counted any more, and forget
+        the files
+        Return:
+            number of files forgotten
+        """
+        inputs = set(map(os.path.abspath, self._input_files))
+        filenames = set(map(os.path.basename, self._input_files))
+        removed = 0
+        for file in self._manifest.files():
+            if file in inputs:
+                continue
+            filename = os.path.basename(file)
+            # outputs are named after the file, an input of the same name
+            # owns them now
+            if filename not in filenames:
+                for output_dir in output_dirs:
+                    for output_file in self.outputFiles(output_dir, filename):
+                        if os.path.exists(output_file):
+                            os.remove(output_file)
+            self._manifest.remove(file)
+            removed += 1
+        return removed
+
+    def schedule(self, outputs):
+        """Group prepareMulti jobs into pool tasks, largest first
+        Args:
+            outputs, dict of input file to its list of (gram_number, output_dir)
+        Return:
+            list of tasks, each a list of prepareMulti arguments
+        """
+        jobs = sorted(((os.path.getsize(file),
+                        (file, args, self._cache_dir, self._use_mmap, self._profile,
+                         self._dedup is not None, self._chars, self._sample is not None,
+                         self._phrases is not None, self._shards, self._combine))
+                       for file, args in outputs.items()), reverse=True)
+        tasks = []
+        batch, batch_bytes = [], 0
+        for size, job in jobs:
+            if size >= self._batch_size:
+                tasks.append([job])
+                continue
+            batch.append(job)
+            batch_bytes += size
+            if batch_bytes >= self._batch_size:
+                tasks.append(batch)
+                batch, batch_bytes = [], 0
+        if batch:
+            tasks.append(batch)
+        return tasks
+
     def run(self):
-        process_num = min(len(self._input_files), PrepareWords.PROCESS_LIMIT)
+        """Prepare every input file
+        Return:
+            list of (input_file, seconds, error, stats), slowest first.
+            Seconds of a file split into byte ranges are counted until it is
+            stitched.
+        """
+        # one job per input file, feeding all its requested n-grams
+        outputs = {}
+        for gram_number, file, output_dir in self._args:
+            outputs.setdefault(file, []).append((gram_number, output_dir))
+        for args in outputs.values():
+            output_dirs = [os.path.abspath(output_dir) for _, output_dir in args]
+            assert len(set(output_dirs)) == len(output_dirs), "Duplicated output %s" % output_dirs
+        if self._manifest:
+            for file, args in outputs.items():
+                filename = os.path.basename(file)
+                if not (self._manifest.changed(file) or
+                        any(not os.path.exists(self.outputFile(output_dir, filename))
+                            for _, output_dir in args)):
+                    del outputs[file]
+            print "%d of %d files to prepare" % (len(outputs), len(self._input_files))
+            removed = self.removeOutputs(set(output_dir for _, _, output_dir in self._args))
+            if removed:
+                print "Removed the outputs of %d files no longer in the inputs" % removed
+        if self._sample:
+            self._sample.total_bytes = sum(os.path.getsize(file) for file in outputs)
+        # large files are prepared in byte ranges, or pipelined
+        jobs = []
+        for file, args in outputs.items():
+            large = (not self._cache_dir and os.path.getsize(file) > self._chunk_size
+                     and (self._pipeline or not isCompressed(file)))
+            if large and self._phrases is not None:
+                print "Warning: %s is prepared by a single worker, as phrases may cross" \
+                    " its byte ranges" % file
+            if large and self._phrases is None:
+                filename = os.path.basename(file)
+                files = [(gram_number, os.path.join(output_dir, filename))
+                         for gram_number, output_dir in args]
+                if self._pipeline:
+                    job = PipelineJob(file, files, profile=self._profile,
+                                      dedup=self._dedup is not None, chars=self._chars,
+                                      sample=self._sample is not None, shards=self._shards,
+                                      combine=self._combine)
+                else:
+                    job = RangeJob(file, files, self._chunk_size, self._profile,
+                                   self._dedup is not None, self._chars,
+                                   self._sample is not None, self._shards, self._combine)
+                jobs.append((file, job))
+                del outputs[file]
+        # ranges are the largest tasks, so they go first
+        tasks = self.schedule(outputs)
+        process_num = min(len(tasks) + sum(len(job) for _, job in jobs), PrepareWords.PROCESS_LIMIT)
+        process_num = max(process_num, 1)
         module=multiprocessing
-        pool = module.Pool(processes = process_num)
-        for args in self._args:
-            pool.apply_async(prepareCommon, args)
+        pool = module.Pool(processes = process_num, initializer=shareObjects,
+                           initargs=(self._dedup, self._sample, self._phrases))
+        start = time.time()
+        for _, job in jobs:
+            job.submit(pool)
+        results = [pool.apply_async(prepareBatch, (task,)) for task in tasks]
+        report = []
+        for file, job in jobs:
+            stats = error = None
+            try:
+                stats = job.finish()
+            except Exception:
+                error = traceback.format_exc()
+            report.append((file, time.time() - start, error, stats))
+        # pipelines queue their blocks until they finish
         pool.close()
+        for task, result in zip(tasks, results):
+            try:
+                report.extend(result.get())
+            except Exception:
+                # the task itself could not run, e.g. arguments not pickled
+                error = traceback.format_exc()
+                report.extend((args[0], 0.0, error, None) for args in task)
         pool.join()
-
+        report.sort(key=lambda item: item[1], reverse=True)
+        for file, seconds, error, _ in report:
+            print "%s\t%.2fs\t%s" % (file, seconds, "failed" if error else "ok")
+        failed = [(file, error) for file, _, error, _ in report if error]
+        for file, error in failed:
+            print >> sys.stderr, "Failed preparing %s\n%s" % (file, error)
+        print "Prepared %d files in %d tasks, %d failed" % (
+            len(report), len(tasks) + len(jobs), len(failed))
+        if self._profile:
+            total = TokenStats()
+            files = {}
+            for file, _, _, stats in report:
+                if stats is not None:
+                    total.add(stats)
+                    files[file] = stats.report()
+            print json.dumps({'total': total.report(), 'files': files},
+                             indent=1, sort_keys=True)
+        if self._dedup:
+            print "Removed %(removed_lines)d duplicated lines, %(removed_bytes)d bytes" % (
+                self._dedup.report())
+        if self._sample:
+            print "Sampled %(kept_lines)d of %(seen_lines)d lines, rate %(rate).6f" % (
+                self._sample.report())
+        if self._manifest:
+            for file, _, error, _ in report:
+                if not error:
+                    self._manifest.update(file)
+            self._manifest.save()
+        return report
 
 def test():
     gram_number = 3
@@ -20,46 +20,205 @@ import os
 import sys
 import math
 import glob
-import pickle
+import Queue
 import argparse
+import operator
+import itertools
 import multiprocessing
 
 import pygtrie
 from  timeutil import TimeUtil
+# gramutil is shared with the scripts of the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from gramutil import (GramCounter, Manifest, dumpTrieFile, gramShard, loadTrieFile, openFile,
+                      prepareFile, shareObjects, sharedSample, splitCompressed, splitCount,
+                      splitShard)
 
 SEP = '\t'
 
-def getTrieFile(file, pickle_dir):
-    return os.path.join(pickle_dir, "%s-trie" % file)
+def getTrieFile(file, pickle_dir, mapped=False):
+    """Trie file of a gram file, compressed the same way unless mapped"""
+    name, ext = splitCompressed(file)
+    if mapped:
+        ext = ''
+    return os.path.join(pickle_dir, "%s-trie%s" % (name, ext))
 
-def buildTrieSingle(file, pickle_dir):
-    """Build trie, dumps using pickle
+def newTrie(chars=False):
+    """Trie counting grams of words, or of CJK characters if chars, keeping
+    the sum of counts under every prefix
     """
-    trie_file = getTrieFile(os.path.basename(file), pickle_dir)
-    trie = pygtrie.StringTrie(separator=SEP)
-    with open(file) as fd:
-        for line in fd:
-            key = line.strip()
-            trie.setdefault(key, 0)
-            trie[key] += 1
-    with open(trie_file, 'w') as fd:
-        pickle.dump(trie, fd, protocol = 2)
+    if chars:
+        return pygtrie.CharCountingTrie()
+    return pygtrie.StringCountingTrie(separator=SEP)
+
+def frozenTrie(trie):
+    """Compact read-only trie of a loaded trie, summing counts under
+    prefixes even if pickled before sums were kept
+    """
+    if isinstance(trie, pygtrie.FrozenTrie):
+        return trie
+    return trie.freeze()
+
+def countingTrie(trie, chars=False):
+    """Mutable counting trie of a loaded trie, which may be frozen, mapped or
+    pickled before sums were kept
+    """
+    if isinstance(trie, pygtrie.CountingTrie):
+        return trie
+    counting = newTrie(chars)
+    counting.bulk_load(trie.iteritems())
+    return counting
+
+def getShardTrieFile(shard, files, pickle_dir, mapped=False):
+    """Trie file of a shard of the gram files, compressed as they are unless
+    mapped
+    """
+    return getTrieFile("shard%03d%s" % (shard, splitCompressed(files[0])[1]), pickle_dir,
+                       mapped)
+
+def getMergedTrieFile(pickle_dir, mapped=False):
+    """Trie file all the tries are merged into by Process.mergeTries"""
+    return getTrieFile("merged", pickle_dir, mapped)
+
+def getTrieKey(key, chars=False):
+    """Key in the trie of a tab separated gram, the unicode string of its
+    characters if chars
+    """
+    if chars:
+        return key.replace(SEP, '').decode('utf-8')
+    return key
+
+def buildTrieSingle(file, pickle_dir, chars=False, mapped=False):
+    """Build trie, dumps using pygtrie.dump, or in the mapped format if mapped
+    """
+    buildTrieFiles([file], getTrieFile(os.path.basename(file), pickle_dir, mapped), chars,
+                   mapped)
+
+def buildTrieFiles(files, trie_file, chars=False, mapped=False):
+    """Build one trie of several gram files, e.g. the same shard of each
+    input, dumps using pygtrie.dump, or in the mapped format if mapped.  Files
+    may be of combined "gram\tcount" records.
+    """
+    trie = newTrie(chars)
+    countTrieFiles(trie, files, chars)
+    dumpTrieFile(trie, trie_file, mapped)
+
+def updateTrieFiles(files, trie_file, chars=False, mapped=False):
+    """Count several gram files, e.g. the new ones of a shard, into the trie
+    of trie_file, dumps as buildTrieFiles does.  The trie is dumped to a
+    temporary file renamed over trie_file, so it is never half written.
+    """
+    loaded = loadTrieFile(trie_file)
+    trie = countingTrie(loaded, chars)
+    if isinstance(loaded, pygtrie.MappedTrie):
+        loaded.close()
+    countTrieFiles(trie, files, chars)
+    name, ext = splitCompressed(trie_file)
+    tmp_file = "%s.tmp%s" % (name, ext)
+    dumpTrieFile(trie, tmp_file, mapped)
+    os.rename(tmp_file, trie_file)
+
+def countTrieFiles(trie, files, chars=False):
+    """Count the grams of gram files, possibly of combined records, into a
+    counting trie
+    """
+    for file in files:
+        with openFile(file) as fd:
+            trie.increment_items((getTrieKey(gram, chars), count)
+                                 for gram, count in itertools.imap(splitCount, fd))
+
+def buildTrieFused(file, pickle_dir, gram_number, gram_dir=None, cache_dir=None,
+                   chars=False, sample=False, mapped=False):
+    """Tokenize a source file and count its grams in memory, dumps using
+    pygtrie.dump, or in the mapped format if mapped.  Gram file is written
+    to gram_dir only if given.  Words are read from the token id cache in
+    cache_dir if given, which is built on the first run.  Grams are of CJK
+    characters if chars.  Lines are sampled with the LineSample shared with
+    the worker if sample.
+    """
+    filename = os.path.basename(file)
+    trie_file = getTrieFile(filename, pickle_dir, mapped)
+    cache_prefix = os.path.join(cache_dir, filename) if cache_dir else None
+    gram_fd = openFile(os.path.join(gram_dir, filename), 'w') if gram_dir else None
+    try:
+        counter = GramCounter(gram_fd)
+        prepareFile(file, [gram_number], [counter], cache_prefix, chars=chars,
+                    sample=sharedSample() if sample else None)
+    finally:
+        if gram_fd:
+            gram_fd.close()
+    counts = counter.counts
+    trie = newTrie(chars)
+    # counts are freed as the sorted grams are loaded
+    trie.bulk_load(((getTrieKey(line.strip(), chars), counts.pop(line))
+                    for line in sorted(counts)), presorted=True)
+    dumpTrieFile(trie, trie_file, mapped)
+
+
+def mergeTrieFiles(trie_files, merged_file, chars=False, mapped=False):
+    """Merge the tries of trie files into one, adding the counts of grams in
+    several, dumps using pygtrie.dump, or in the mapped format if mapped.
+    Subtries of grams only in one trie are moved over, not copied.
+    """
+    merged = None
+    for trie_file in trie_files:
+        trie = countingTrie(loadTrieFile(trie_file), chars)
+        if merged is None:
+            merged = trie
+        else:
+            merged.merge(trie, operator.add)
+    dumpTrieFile(merged, merged_file, mapped)
+
+def mergeTrieJob(trie_files, merged_file, chars=False, mapped=False):
+    """mergeTrieFiles for a pool, returning (trie_files, merged_file, error)
+    instead of raising, as apply_async has no error callback
+    """
+    try:
+        mergeTrieFiles(trie_files, merged_file, chars, mapped)
+        return trie_files, merged_file, None
+    except Exception as e:
+        return trie_files, merged_file, "%s" % e
 
 
 class Process(object):
-    """Generate score with gram file and candidate file"""
+    """Generate score with gram file and candidate file.
+    Files ending with .gz, .bz2, .xz or .lzma are read and written compressed.
+    """
     PROCESS_LIMIT = 20
+    MANIFEST_FILE = 'manifest.json'
 
-    def __init__(self, grams, candidates, score_dir, pickle_dir):
-        self._gram_files = self.detectFiles(grams)
+    def __init__(self, grams, candidates, score_dir, pickle_dir, chars=False,
+                 sample_rate=1.0, mapped=False):
+        """
+        Args:
+            grams, gram files; may be None when tries are built from
+                sources with buildTrie(sources=...).  Shards written by
+                PrepareWords with shards=N are grouped into one trie per
+                shard, so a prefix sum reads a single trie.
+            chars, grams are of CJK characters, as prepared with chars=True.
+                They are counted in CharTries keyed by the unicode string of
+                their characters.
+            sample_rate, rate of the lines the grams were prepared from, as
+                printed by PrepareWords.run with a sample.  Counts are
+                scaled by it to estimate the full corpus.
+            mapped, tries are written in the format of pygtrie.MappedTrie
+                instead of pickled, uncompressed.  loadTrie then opens them
+                in place, in no time, and scoring processes of a host share
+                their pages.  Tries of either format are loaded.
+        """
+        self._chars = chars
+        self._sample_rate = sample_rate
+        self._mapped = mapped
+        self._gram_files = self.detectFiles(grams) if grams else []
+        self._shard_files = self.groupShards(self._gram_files)
         self._candidate_files = self.detectFiles(candidates)
         self._score_dir = score_dir
         self._pickle_dir = pickle_dir
         self._tries = []
+        self._merged = False
         self._global_cache = {} # cache for keys after generating from tries
         self._total = None
-        self._cache = {} # cache keys in each trie
-        assert len(self._gram_files) > 0, "gram file %s not exists %s" % grams
+        assert grams is None or len(self._gram_files) > 0, "gram file %s not exists" % grams
         assert len(self._candidate_files) > 0, "candidate file %s not exists" % candidates
         print "Gram: ", self._gram_files
         print "Candidate: " , self._candidate_files
@@ -80,50 +239,260 @@ class Process(object):
                 output.append(file)
         return output
 
+    def groupShards(self, files):
+        """Group shards of gram files by shard
+        Return:
+            list of the files of each shard, None if files are not shards
+        """
+        shards = {}
+        for file in files:
+            shard = splitShard(file)[1]
+            if shard is not None:
+                shards.setdefault(shard, []).append(file)
+        if not shards:
+            return None
+        assert sum(map(len, shards.values())) == len(files), "Gram files mix shards and not"
+        return [sorted(shards.get(shard, [])) for shard in xrange(max(shards) + 1)]
+
     def buildTrieSingle(self, file):
         """Build trie, dumps using pickle
         """
         pass
 
-    def buildTrie(self):
-        """Generate StringTrie"""
+    def buildTrie(self, sources=None, gram_number=3, gram_dir=None, cache_dir=None,
+                  incremental=False, sample=None):
+        """Generate StringTrie
+        Args:
+            sources, if given, source text files whose grams are counted
+                straight from the tokenizer in each worker (fused mode)
+            gram_number, n-gram used with sources
+            gram_dir, with sources, also write gram files to this directory
+            cache_dir, with sources, directory of token id caches to read,
+                or build on the way
+            incremental, only build tries of files new or modified since
+                the last build, recorded in pickle_dir/manifest.json.  Tries
+                of the other files are kept and loaded by loadTrie as before.
+                A shard trie only counts its new files in; it is rebuilt
+                from all its files once one it was built of changed or was
+                removed.
+            sample, with sources, a LineSample the lines are sampled with.
+                Its rate becomes the sample rate of the scores.
+            Sharded gram files are built into one trie per shard.  With
+            sources, tries are built per source file and are not sharded.
+        """
+        assert not (sample and incremental), "Samples are not built incrementally"
+        if sources:
+            # tries are named after the source files, as gram files are
+            self._gram_files = self.detectFiles(sources)
+            self._shard_files = None
+            # jobs are (files read, trie file, func, args)
+            jobs = [([file], getTrieFile(os.path.basename(file), self._pickle_dir, self._mapped),
+                     buildTrieFused, (file, self._pickle_dir, gram_number, gram_dir, cache_dir,
+                                      self._chars, sample is not None, self._mapped))
+                    for file in self._gram_files]
+            if sample:
+                sample.total_bytes = sum(os.path.getsize(file) for file in self._gram_files)
+        elif self._shard_files:
+            jobs = []
+            for shard, files in enumerate(self._shard_files):
+                if not files:
+                    continue
+                trie_file = getShardTrieFile(shard, files, self._pickle_dir, self._mapped)
+                jobs.append((files, trie_file, buildTrieFiles,
+                             (files, trie_file, self._chars, self._mapped)))
+        else:
+            jobs = [([file], getTrieFile(os.path.basename(file), self._pickle_dir, self._mapped),
+                     buildTrieSingle, (file, self._pickle_dir, self._chars, self._mapped))
+                    for file in self._gram_files]
+        manifest = None
+        removed = {}
+        if incremental:
+            manifest = Manifest(os.path.join(self._pickle_dir, Process.MANIFEST_FILE))
+            jobs, removed = self.incrementalJobs(jobs, manifest)
+            print "%d of %d tries to build or update" % (
+                len(jobs), len(filter(None, self._shard_files or self._gram_files)))
         module = multiprocessing
-        process_num = min(len(self._gram_files), Process.PROCESS_LIMIT)
-        pool = module.Pool(processes=process_num)
-        for file in self._gram_files:
-            pool.apply_async(buildTrieSingle, (file, self._pickle_dir))
+        process_num = max(min(len(jobs), Process.PROCESS_LIMIT), 1)
+        pool = module.Pool(processes=process_num, initializer=shareObjects,
+                           initargs=(None, sample))
+        results = [(files, trie_file, pool.apply_async(func, args))
+                   for files, trie_file, func, args in jobs]
         pool.close()
         pool.join()
+        for files, trie_file, result in results:
+            try:
+                result.get()
+            except Exception as e:
+                print >> sys.stderr, "Failed building trie of %s: %s" % (", ".join(files), e)
+                continue
+            if manifest:
+                for file in files:
+                    manifest.update(file)
+                for file in removed.get(trie_file, []):
+                    manifest.remove(file)
+        if manifest:
+            manifest.save()
+        if sample:
+            self._sample_rate = sample.rate
+
+    def incrementalJobs(self, jobs, manifest):
+        """Jobs of the tries to build or update since the last build
+        Args:
+            jobs, list of (files read, trie file, func, args) building every
+                trie
+            manifest, Manifest of the files the tries were built of
+        Return:
+            (jobs, removed), the jobs left, where a shard trie whose only
+            changes are new files counts them into the trie as it is, and
+            for each trie file rebuilt the recorded files no longer there.
+            Tries of recorded files no longer there which are not rebuilt,
+            as no file is left for them, are removed and the files
+            forgotten.
+        """
+        current = set(os.path.abspath(file) for files, _, _, _ in jobs for file in files)
+        gone = {}
+        for file in manifest.files():
+            if file in current:
+                continue
+            shard = splitShard(file)[1] if self._shard_files else None
+            if shard is not None:
+                trie_file = getShardTrieFile(shard, [file], self._pickle_dir, self._mapped)
+            else:
+                trie_file = getTrieFile(os.path.basename(file), self._pickle_dir, self._mapped)
+            gone.setdefault(trie_file, []).append(file)
+        left = []
+        removed = {}
+        for files, trie_file, func, args in jobs:
+            changed = [file for file in files if manifest.changed(file)]
+            added = [file for file in changed if file not in manifest]
+            if not os.path.exists(trie_file) or trie_file in gone or len(added) < len(changed):
+                # a trie is rebuilt from all its files once one it was built
+                # of changed or was removed
+                left.append((files, trie_file, func, args))
+                removed[trie_file] = gone.pop(trie_file, [])
+            elif added and self._shard_files:
+                left.append((added, trie_file, updateTrieFiles,
+                             (added, trie_file, self._chars, self._mapped)))
+            elif added:
+                left.append((files, trie_file, func, args))
+        for trie_file, files in gone.items():
+            if os.path.exists(trie_file):
+                os.remove(trie_file)
+            for file in files:
+                manifest.remove(file)
+        return left, removed
+
+    def getShard(self, key):
+        """Shard of the grams a trie key is a prefix of"""
+        if self._chars:
+            token = key[:1].encode('utf-8')
+        else:
+            token = key.split(SEP, 1)[0]
+        return gramShard(token, len(self._shard_files))
 
     def lazySum(self, key):
 
         if key is None:
             # means total
             if self._total is None:
-                self._total = 0
-                for index, trie in enumerate(self._tries):
-                    self._total += sum(trie.itervalues())
+                self._total = sum(trie.prefix_sum() for trie in self._tries)
             return self._total
 
         if not self._global_cache.has_key(key):
             value = 0
-            for index, trie in enumerate(self._tries):
-                file_key = "%s$$$$%s" % (index, key)
-                if not self._cache.has_key(file_key):
-                    if trie.has_node(key):
-                        self._cache[file_key] = sum(trie.itervalues(prefix=key))
-                    else:
-                        self._cache[file_key] = 0
-                value += self._cache[file_key]
+            if self._shard_files and not self._merged:
+                # only the shard of its first token holds the key
+                tries = [self._tries[self.getShard(key)]]
+            else:
+                tries = self._tries
+            # sums under the key are kept by the counting tries
+            for trie in tries:
+                value += trie.prefix_sum(key)
             self._global_cache[key] = value
         return self._global_cache[key]
 
-    def loadTrie(self):
-        """load trie from pickle dumped file"""
-        for file in self._gram_files:
-            trie_file = getTrieFile(os.path.basename(file), self._pickle_dir)
-            with open(trie_file, 'rb') as fd:
-                self._tries.append(pickle.load(fd))
+    def getTrieFiles(self):
+        """Trie files built by buildTrie, None for a shard without files"""
+        if self._shard_files:
+            return [getShardTrieFile(shard, files, self._pickle_dir, self._mapped)
+                    if files else None
+                    for shard, files in enumerate(self._shard_files)]
+        return [getTrieFile(os.path.basename(file), self._pickle_dir, self._mapped)
+                for file in self._gram_files]
+
+    def mergeTries(self):
+        """Merge the tries built by buildTrie into one with a parallel tree
+        reduce, so scoring reads a single trie.  Pairs of tries are merged by
+        the workers, and each merged trie is paired again with the next one
+        ready as soon as its worker finishes.  Tries built are kept, only
+        intermediate merges are removed.
+        Return:
+            True if merged, for loadTrie(merged=True)
+        """
+        pending = [file for file in self.getTrieFiles() if file is not None]
+        merged_file = getMergedTrieFile(self._pickle_dir, self._mapped)
+        if not pending:
+            dumpTrieFile(newTrie(self._chars), merged_file, self._mapped)
+            return True
+        # intermediate tries are dumped uncompressed, not mapped, to be
+        # loaded mutable by the next merge
+        intermediates = set()
+        done = Queue.Queue()
+        running = 0
+        process_num = max(min(len(pending) / 2, Process.PROCESS_LIMIT), 1)
+        pool = multiprocessing.Pool(processes=process_num)
+        try:
+            while len(pending) + running > 1:
+                while len(pending) >= 2:
+                    pair = [pending.pop(), pending.pop()]
+                    if not pending and not running:
+                        output, mapped = merged_file, self._mapped
+                    else:
+                        output = getTrieFile("merge%03d" % len(intermediates), self._pickle_dir)
+                        intermediates.add(output)
+                        mapped = False
+                    pool.apply_async(mergeTrieJob, (pair, output, self._chars, mapped),
+                                     callback=done.put)
+                    running += 1
+                trie_files, output, error = done.get()
+                running -= 1
+                if error is not None:
+                    print >> sys.stderr, "Failed merging tries %s: %s" % (
+                        ", ".join(trie_files), error)
+                    return False
+                for file in trie_files:
+                    if file in intermediates:
+                        os.remove(file)
+                pending.append(output)
+        finally:
+            pool.terminate()
+            pool.join()
+            for file in intermediates:
+                if os.path.exists(file):
+                    os.remove(file)
+        if pending[0] != merged_file:
+            # a single trie
+            mergeTrieFiles(pending, merged_file, self._chars, self._mapped)
+        return True
+
+    def loadTrie(self, merged=False):
+        """load trie from file dumped by pygtrie.dump or pickle, kept frozen
+        for scoring, or open it in place if of the mapped format
+        Args:
+            merged, load only the trie merged by mergeTries, so every key is
+                summed from a single trie
+        """
+        self._merged = merged
+        if merged:
+            trie_files = [getMergedTrieFile(self._pickle_dir, self._mapped)]
+        else:
+            trie_files = self.getTrieFiles()
+        for trie_file in trie_files:
+            if trie_file is None:
+                # no file of the shard, so no grams
+                self._tries.append(newTrie(self._chars).freeze())
+                continue
+            self._tries.append(frozenTrie(loadTrieFile(trie_file)))
 
     def generateScore(self):
         """Use trie to generate score for candidate.
@@ -133,16 +502,19 @@ class Process(object):
         for file in self._candidate_files:
             filename = os.path.basename(file)
             score_file = os.path.join(self._score_dir, filename)
-            with open(score_file, 'w') as ofd:
-                with open(file) as ifd:
+            with openFile(score_file, 'w') as ofd:
+                with openFile(file) as ifd:
                     for line in ifd:
-                        words = line.strip().split('\t')
-                        if len(words) < 2 or any(map(lambda word:len(word)<2, words)):
+                        # candidates may be combined records, scored once each
+                        line = splitCount(line)[0]
+                        words = line.split('\t')
+                        if len(words) < 2 or (not self._chars and
+                                              any(map(lambda word:len(word)<2, words))):
                             continue
 
-                        XFreq = self.lazySum(words[0])
-                        YFreq = self.lazySum(words[1])
-                        XYFreq = self.lazySum(line.strip())
+                        XFreq = self.lazySum(getTrieKey(words[0], self._chars))
+                        YFreq = self.lazySum(getTrieKey(words[1], self._chars))
+                        XYFreq = self.lazySum(getTrieKey(line.strip(), self._chars))
                         # frequences filter
                         #if XYFreq < 2 or XYFreq > 24:
                         #    continue
@@ -152,23 +524,29 @@ class Process(object):
                         PX = XFreq * 1.0 / totalFreq
                         PY = YFreq * 1.0 / totalFreq
                         PXY = XYFreq * 1.0 / totalFreq
-                        score = math.log(PXY/PX/PY, 2) * XYFreq
+                        # probabilities of a sample estimate the full ones,
+                        # its counts are scaled up
+                        score = math.log(PXY/PX/PY, 2) * XYFreq / self._sample_rate
                         #print "Freq:", XFreq, YFreq, XYFreq
                         result = "{0}\t{1:.2f}\n".format(line.strip(), score)
                         ofd.write(result)
 
-def test():
+def test(incremental=False, mapped=False, merge=False):
     grams = './data/grams/'
     candidates = './data/candidates/'
     score_dir = './data/scores/'
     pickle_dir = './data/pickles/'
-    prop = Process(grams, candidates, score_dir, pickle_dir)
+    prop = Process(grams, candidates, score_dir, pickle_dir, mapped=mapped)
     tu = TimeUtil()
     tu.start()
-    prop.buildTrie()
+    prop.buildTrie(incremental=incremental)
     tu.elapsedSeconds()
     tu.reset()
-    prop.loadTrie()
+    if merge:
+        merge = prop.mergeTries()
+        tu.elapsedSeconds()
+        tu.reset()
+    prop.loadTrie(merged=merge)
     tu.elapsedSeconds()
     tu.reset()
     prop.generateScore()
@@ -178,6 +556,8 @@ def test():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-u', action='store_true', default=False)
+    parser.add_argument('-m', action='store_true', default=False)
+    parser.add_argument('-g', action='store_true', default=False)
     opts = parser.parse_args(sys.argv[1:])
-    test()
+    test(incremental=opts.u, mapped=opts.m, merge=opts.g)
 
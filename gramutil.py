@@ -0,0 +1,1659 @@
+#!/bin/env python
+
+# Helpers shared by the scripts of this directory and of folder-support:
+# tokenizers, gram chaining, parallel range and pipeline jobs, line dedup,
+# sampling and phrase filtering, sharded and combined gram files, trie files
+# and the manifest of incremental runs.
+#
+# The prepare scripts, data_preparation.py and folder-support/prepare.py,
+# share the following options:
+#   chunk size, inputs larger than this are split into line aligned byte
+#       ranges tokenized in parallel by a RangeJob.  Compressed inputs are
+#       not split, unless with pipeline.
+#   cache, TokenCache of an input, built by the first run and read instead
+#       of the input by later runs with the same dedup, rebuilt otherwise.
+#       Inputs using the cache are not split into byte ranges.
+#   mmap, tokenize a memory map of the input instead of iterating its
+#       lines, see Tokenizer.scanFile.  Byte ranges are always scanned so.
+#   profile, count the words each rule of ProfilingTokenizer rejects and
+#       time the stages in every worker, printed by run() as JSON.  The
+#       rules are then applied one by one, which is slower.
+#   dedup, drop lines repeated across the inputs, e.g. crawled boilerplate,
+#       with a DedupSet before tokenizing.  Which copy of a line is kept
+#       depends on the worker order.
+#   chars, prepare grams of CJK characters with a CharTokenizer, e.g. for
+#       Chinese new word discovery.  Grams never cross a run of CJK
+#       characters.  It does not work with a cache.
+#   sample, prepare the lines kept by a LineSample for a fast approximate
+#       run.  run() prints the rate of lines kept, which Process scales the
+#       counts with.  It does not work with a cache.
+#   phrases, drop the phrases of a PhraseFilter from the words before making
+#       grams.  Inputs are then not split into byte ranges, as a phrase may
+#       cross them, and run() warns of the large ones.
+#   shards, write each gram file as shards split by the first word of the
+#       grams, see ShardedWriter.
+#   pipeline, prepare large inputs, compressed ones too, with a PipelineJob,
+#       so reading and writing overlap with tokenizing.
+#   combine, write "gram\tcount" records with a CombiningWriter.  Byte
+#       ranges and blocks are combined each on their own, so a gram may have
+#       several records, which Process adds up.
+
+import os
+import re
+import sys
+import bz2
+import gzip
+import mmap
+import time
+import zlib
+import json
+import pickle
+import Queue
+import random
+import array
+import struct
+import ctypes
+import hashlib
+import shutil
+import itertools
+import threading
+import multiprocessing
+import collections
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import pygtrie
+except ImportError:
+    pygtrie = None
+
+from timeutil import TimeUtil
+
+
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.xz', '.lzma')
+
+
+def splitCompressed(path):
+    """Split path into (path without compression extension, extension)"""
+    base, ext = os.path.splitext(path)
+    if ext in COMPRESSED_EXTENSIONS:
+        return base, ext
+    return path, ''
+
+
+def isCompressed(path):
+    return splitCompressed(path)[1] != ''
+
+
+def openFile(path, mode='r', threaded=True):
+    """Open path, compressed with gzip, bz2 or lzma if its extension says so
+    Args:
+        mode, 'r' or 'w', possibly with 'b'
+        threaded, read compressed files through a ThreadedReader, so
+            decompression overlaps with the caller.  Needs to be False for
+            readers using read()/readline(), e.g. pickle.
+    """
+    ext = splitCompressed(path)[1]
+    if not ext:
+        return open(path, mode)
+    mode = mode[0] + 'b'
+    if ext == '.gz':
+        fd = gzip.open(path, mode)
+    elif ext == '.bz2':
+        fd = bz2.BZ2File(path, mode)
+    else:
+        assert lzma is not None, 'lzma module is needed to open %s' % path
+        fd = lzma.LZMAFile(path, mode)
+    if threaded and mode[0] == 'r':
+        return ThreadedReader(fd)
+    return fd
+
+
+SHARD_PATTERN = re.compile(r'^(.*)\.shard(\d+)(%s)?$' %
+                           '|'.join(re.escape(ext) for ext in COMPRESSED_EXTENSIONS))
+
+
+def shardFile(path, shard):
+    """Path of a shard of a gram file, compressed the same way"""
+    name, ext = splitCompressed(path)
+    return "%s.shard%03d%s" % (name, shard, ext)
+
+
+def splitShard(path):
+    """Split the path of a shard into (gram file path, shard), shard is None
+    if path is not a shard
+    """
+    match = SHARD_PATTERN.match(path)
+    if not match:
+        return path, None
+    return match.group(1) + (match.group(3) or ''), int(match.group(2))
+
+
+def gramShard(token, shards):
+    """Shard of the grams starting with token, a str"""
+    return (zlib.crc32(token) & 0xffffffff) % shards
+
+
+class ShardedWriter(object):
+    """
+    Gram file split into shards by a stable hash of the first token of each
+    gram, so all the grams sharing a first word go to the same shard.
+    """
+
+    def __init__(self, path, shards):
+        self.fds = [openFile(shardFile(path, shard), 'w') for shard in xrange(shards)]
+
+    def write(self, line):
+        tab = line.find('\t')
+        token = line[:tab] if tab >= 0 else line.rstrip('\n')
+        self.fds[gramShard(token, len(self.fds))].write(line)
+
+    def close(self):
+        for fd in self.fds:
+            fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CombiningWriter(object):
+    """
+    Gram file of "gram\tcount" records instead of a line per occurrence.
+
+    Counts are kept in memory and spilled to the file once SPILL_LIMIT
+    distinct grams are met, so a gram may have several records, which
+    readers add up with splitCount.
+    """
+    SPILL_LIMIT = 1 << 20
+
+    def __init__(self, fd, limit=SPILL_LIMIT):
+        """
+        Args:
+            fd, gram file or ShardedWriter the records are written to
+            limit, distinct grams counted before spilling
+        """
+        self._fd = fd
+        self._limit = limit
+        self._counts = collections.defaultdict(int)
+        self.fds = outputFds(fd)
+
+    def write(self, line):
+        counts = self._counts
+        counts[line] += 1
+        if len(counts) >= self._limit:
+            self.spill()
+
+    def spill(self):
+        """Write the records of the grams counted so far"""
+        write = self._fd.write
+        for line, count in self._counts.iteritems():
+            write("%s\t%d\n" % (line[:-1], count))
+        self._counts.clear()
+
+    def close(self):
+        try:
+            self.spill()
+        finally:
+            self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def openGrams(path, shards=None, combine=False):
+    """Open a gram file for writing, split into shards if given, of combined
+    "gram\tcount" records if combine
+    """
+    fd = ShardedWriter(path, shards) if shards else openFile(path, 'w')
+    if combine:
+        return CombiningWriter(fd)
+    return fd
+
+
+def outputFds(fd):
+    """Files under a gram file opened by openGrams, one per shard, which
+    text already made of gram lines or records is written to
+    """
+    return getattr(fd, 'fds', [fd])
+
+
+def splitCount(line):
+    """Split a gram line into (gram, count), count is 1 unless the line is a
+    record of a combined gram file.  Words are never numbers, so a last
+    field of digits is a count.
+    """
+    line = line.strip()
+    gram, sep, count = line.rpartition('\t')
+    if sep and count.isdigit():
+        return gram, int(count)
+    return line, 1
+
+
+def dumpTrieFile(trie, path, mapped=False):
+    """Write a trie to path with pygtrie.dump, compressed as its name says,
+    or if mapped, write it frozen in the uncompressed format of
+    pygtrie.MappedTrie.  Unlike pickling, pygtrie.dump streams the nodes
+    so it takes no memory beyond the trie.
+    """
+    assert pygtrie is not None, "Tries need pygtrie"
+    if mapped:
+        frozen = trie if isinstance(trie, pygtrie.FrozenTrie) else trie.freeze()
+        with open(path, 'wb') as fd:
+            frozen.dump_mapped(fd)
+        return
+    with openFile(path, 'wb') as fd:
+        pygtrie.dump(trie, fd)
+
+
+def loadTrieFile(path):
+    """Trie of a file written by dumpTrieFile, or pickled before.  Formats
+    are told by their magic numbers.  A mapped trie is opened in place in no
+    time however big, and its pages are shared by all processes of the host
+    opening it.
+    """
+    assert pygtrie is not None, "Tries need pygtrie"
+    if pygtrie.MappedTrie.is_mapped(path):
+        return pygtrie.MappedTrie(path)
+    with openFile(path, 'rb', threaded=False) as fd:
+        dumped = fd.read(len(pygtrie.DUMP_MAGIC)) == pygtrie.DUMP_MAGIC
+    with openFile(path, 'rb', threaded=False) as fd:
+        if dumped:
+            return pygtrie.load(fd)
+        return pickle.load(fd)
+
+
+class Manifest(object):
+    """
+    Record of ingested input files, kept as JSON.
+
+    A file is taken as unchanged while its size and mtime match the record.
+    Otherwise its md5 is compared, so a touched but identical file is not
+    ingested again.  Only new or modified files are read, keeping refreshes
+    proportional to the new data.
+    """
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        self._pending = {}
+        if os.path.exists(path):
+            with open(path) as fd:
+                self._entries = json.load(fd)
+
+    def _key(self, file):
+        return os.path.abspath(file)
+
+    def _stat(self, file):
+        st = os.stat(file)
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def _hash(self, file):
+        md5 = hashlib.md5()
+        with open(file, 'rb') as fd:
+            for block in iter(lambda: fd.read(self.BLOCK_SIZE), ''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def changed(self, file):
+        """Whether file is new or modified since it was recorded"""
+        key = self._key(file)
+        entry = self._stat(file)
+        old = self._entries.get(key)
+        if old and old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+            return False
+        entry['md5'] = self._hash(file)
+        if old and old['md5'] == entry['md5']:
+            self._entries[key] = entry
+            return False
+        self._pending[key] = entry
+        return True
+
+    def __contains__(self, file):
+        """Whether file was recorded, changed since or not"""
+        return self._key(file) in self._entries
+
+    def files(self):
+        """Absolute paths of the recorded files"""
+        return self._entries.keys()
+
+    def remove(self, file):
+        """Forget file, e.g. once removed from the inputs"""
+        key = self._key(file)
+        self._entries.pop(key, None)
+        self._pending.pop(key, None)
+
+    def update(self, file):
+        """Record file as ingested"""
+        key = self._key(file)
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            entry = self._stat(file)
+            entry['md5'] = self._hash(file)
+        self._entries[key] = entry
+
+    def save(self):
+        tmp_file = self._path + '.tmp'
+        with open(tmp_file, 'w') as fd:
+            json.dump(self._entries, fd, indent=1, sort_keys=True)
+        os.rename(tmp_file, self._path)
+
+
+class ThreadedReader(object):
+    """
+    Iterate lines of a file read by a background thread.
+
+    Blocks are read, and decompressed, by a daemon thread into a bounded
+    queue while the caller consumes lines.
+    """
+    BLOCK_SIZE = 1 << 20
+    QUEUE_SIZE = 16
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._queue = Queue.Queue(self.QUEUE_SIZE)
+        self._closed = False
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self):
+        try:
+            while not self._closed:
+                data = self._fd.read(self.BLOCK_SIZE)
+                self._queue.put(data)
+                if not data:
+                    break
+        except Exception as e:
+            self._queue.put(e)
+
+    def blocks(self):
+        """Yield blocks of whole lines"""
+        left = ''
+        while True:
+            data = self._queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if not data:
+                break
+            data = left + data
+            cut = data.rfind('\n') + 1
+            left = data[cut:]
+            if cut:
+                yield data[:cut]
+        if left:
+            yield left
+
+    def __iter__(self):
+        for block in self.blocks():
+            lines = block.split('\n')
+            last = lines.pop()
+            for line in lines:
+                yield line + '\n'
+            if last:
+                yield last
+
+    def close(self):
+        self._closed = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Tokenizer(object):
+    """
+    Split text into words in a single pass.
+
+    Words are split by non [A-Za-z0-9]+ characters and lowered, then the
+    following are rejected: empty or single character, pure number,
+    number & a-z combination, single repeated character and character
+    repeated >= 3 times.
+
+    A word passing the first four rules is a run of at least two letters
+    which is not glued to a digit, so WORD_PATTERN finds exactly those and
+    only REPEAT_PATTERN has to be checked for each match.  The verdict is
+    cached per distinct word since natural text repeats a small vocabulary.
+    """
+    WORD_PATTERN = re.compile(r'(?<![0-9a-z])[a-z]{2,}(?![0-9a-z])')
+    # WORD_PATTERN before lowering, used to scan raw buffers
+    RAW_WORD_PATTERN = re.compile(r'(?<![0-9A-Za-z])[A-Za-z]{2,}(?![0-9A-Za-z])')
+    # single repeated character | character repeated >= 3
+    REPEAT_PATTERN = re.compile(r'^([a-z])\1$|([a-z])\2{2,}')
+    CACHE_LIMIT = 1 << 20
+    BLOCK_SIZE = 1 << 24
+
+    def __init__(self):
+        self._accepted = {}
+        self._lowered = {}
+
+    def tokenize(self, lines):
+        """Yield accepted words of lines one by one
+        Args:
+            lines, iterable of text lines, e.g. an opened file
+        """
+        for words in self.splitLines(lines):
+            for word in words:
+                yield word
+
+    def splitLines(self, lines):
+        """Yield the list of accepted words of each line"""
+        findall = self.WORD_PATTERN.findall
+        repeated = self.REPEAT_PATTERN.search
+        accepted = self._accepted
+        for line in lines:
+            if len(accepted) >= self.CACHE_LIMIT:
+                accepted.clear()
+            words = findall(line.lower())
+            for word in words:
+                if word not in accepted:
+                    accepted[word] = not repeated(word)
+            yield [word for word in words if accepted[word]]
+
+    def scanFile(self, input_file, start=0, end=None, filters=()):
+        """Yield accepted words of input_file from a memory map of it.
+        Lines are never split out of the file, only accepted words are
+        turned into strings.
+        Args:
+            input_file, text file
+            start, end, byte range to scan, both at line boundaries
+            filters, DedupSet or SampleStream the lines are filtered through
+                in turn.  Blocks are then copied out of the map.
+        """
+        with open(input_file, 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            end = size if end is None else min(end, size)
+            if start >= end:
+                return
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if not filters:
+                    blocks = self.scanBuffer(mm, start, end)
+                else:
+                    texts = (mm[pos:stop] for pos, stop in self.splitBlocks(mm, start, end))
+                    for line_filter in filters:
+                        texts = line_filter.filterBlocks(texts)
+                    blocks = (words for text in texts
+                              for words in self.scanBuffer(text, 0, len(text)))
+                for words in blocks:
+                    for word in words:
+                        yield word
+            finally:
+                mm.close()
+
+    def scanBuffer(self, buffer, start, end):
+        """Yield the list of accepted words of each block of buffer
+        Args:
+            buffer, str or mmap
+            start, end, range to scan, both at line boundaries
+        """
+        findall = self.RAW_WORD_PATTERN.findall
+        repeated = self.REPEAT_PATTERN.search
+        # raw word -> lowered word, or '' if rejected
+        lowered = self._lowered
+        for pos, stop in self.splitBlocks(buffer, start, end):
+            if len(lowered) >= self.CACHE_LIMIT:
+                lowered.clear()
+            raws = findall(buffer, pos, stop)
+            for raw in raws:
+                if raw not in lowered:
+                    word = raw.lower()
+                    lowered[raw] = '' if repeated(word) else word
+            yield filter(None, map(lowered.__getitem__, raws))
+
+    def splitBlocks(self, buffer, start, end):
+        """Yield (start, end) of blocks of about BLOCK_SIZE bytes of buffer,
+        ending at line boundaries
+        """
+        pos = start
+        while pos < end:
+            stop = buffer.find('\n', min(pos + self.BLOCK_SIZE, end) - 1, end)
+            stop = end if stop < 0 else stop + 1
+            yield pos, stop
+            pos = stop
+
+
+class CharTokenizer(Tokenizer):
+    """
+    Split UTF-8 text into CJK characters, for character n-grams.
+
+    Each run of CJK characters is yielded character by character and
+    followed by None, which chainGrams takes as a break, so no gram crosses
+    punctuation, spaces or other text.  Anything but CJK is dropped.
+    Characters are yielded UTF-8 encoded.  Since every run ends with a
+    break, byte ranges of a file need no stitching.
+    """
+    # CJK unified ideographs, extension A and compatibility, kana and hangul
+    RUN_PATTERN = re.compile(u'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff'
+                             u'\uac00-\ud7af\uf900-\ufaff]+')
+
+    def splitText(self, text):
+        """List of the characters of text, each run ending with None"""
+        chars = []
+        for run in self.RUN_PATTERN.findall(text.decode('utf-8', 'ignore')):
+            chars.extend([char.encode('utf-8') for char in run])
+            chars.append(None)
+        return chars
+
+    def splitLines(self, lines):
+        """Yield the list of characters of each line"""
+        for line in lines:
+            yield self.splitText(line)
+
+    def scanBuffer(self, buffer, start, end):
+        """Yield the list of characters of each block of buffer"""
+        for pos, stop in self.splitBlocks(buffer, start, end):
+            yield self.splitText(buffer[pos:stop])
+
+
+class TokenStats(object):
+    """
+    Counters and timings collected by ProfilingTokenizer and prepareFile.
+    Stats of several files or workers are summed with add(), so seconds
+    of merged stats are worker seconds, not wall time.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.rejected = collections.Counter()
+        self.seconds = collections.Counter()
+
+    def add(self, other):
+        self.counts.update(other.counts)
+        self.rejected.update(other.rejected)
+        self.seconds.update(other.seconds)
+        return self
+
+    def report(self):
+        """Stats as a dict ready for json"""
+        report = dict(self.counts)
+        report['rejected'] = dict(self.rejected)
+        report['seconds'] = dict((stage, round(seconds, 3))
+                                 for stage, seconds in self.seconds.iteritems())
+        total = self.seconds['total']
+        if total:
+            report['lines_per_second'] = round(self.counts['lines'] / total, 1)
+            report['tokens_per_second'] = round(self.counts['tokens_in'] / total, 1)
+        return report
+
+
+class ProfilingTokenizer(Tokenizer):
+    """
+    Tokenizer applying the filter rules one by one, to count the words
+    each rule rejects and time every stage into a TokenStats.  Words are
+    the same as the ones of Tokenizer, at a fraction of its speed.
+    """
+    SPLIT_PATTERN = re.compile(r'[^0-9a-z]+')
+    # rules in the order they are applied, a word is rejected by the first
+    # one returning true
+    RULES = [
+        ('length', lambda word: len(word) < 2),
+        ('number', re.compile(r'^[0-9]+$').match),
+        ('alnum', re.compile(r'[0-9][a-z]|[a-z][0-9]').search),
+        ('single_repeat', re.compile(r'^([a-z])\1*$').match),
+        ('triple_repeat', re.compile(r'([a-z])\1{2,}').search),
+    ]
+
+    def __init__(self, stats):
+        Tokenizer.__init__(self)
+        self.stats = stats
+
+    def splitLines(self, lines):
+        """Yield the list of accepted words of each line"""
+        counts = self.stats.counts
+        rejected = self.stats.rejected
+        seconds = self.stats.seconds
+        split = self.SPLIT_PATTERN.split
+        clock = time.time
+        for line in lines:
+            start = now = clock()
+            words = filter(None, split(line.lower()))
+            counts['lines'] += line.count('\n') or 1
+            counts['tokens_in'] += len(words)
+            last, now = now, clock()
+            seconds['split'] += now - last
+            for name, rule in self.RULES:
+                kept = [word for word in words if not rule(word)]
+                rejected[name] += len(words) - len(kept)
+                words = kept
+                last, now = now, clock()
+                seconds[name] += now - last
+            counts['tokens_out'] += len(words)
+            seconds['tokenize'] += now - start
+            yield words
+
+    def scanBuffer(self, buffer, start, end):
+        """Yield the list of accepted words of each line of buffer"""
+        for pos, stop in self.splitBlocks(buffer, start, end):
+            for words in self.splitLines(buffer[pos:stop].splitlines()):
+                yield words
+
+
+class DedupSet(object):
+    """
+    Set of normalized line fingerprints shared by pool workers.
+
+    Lines are lowered and their whitespace collapsed, then hashed to 64 bit
+    fingerprints, the first 8 bytes of their md5, kept in an open addressing
+    table in shared memory.  Fingerprints are the same in every process and
+    Python build.  A
+    line repeated anywhere in the inputs is passed on only the first time a
+    worker meets it, so boilerplate is tokenized and counted once.  The set
+    reaches pool workers by inheritance, see shareDedup.
+
+    Lines shorter than min_length once normalized are always kept.  When
+    capacity fingerprints are stored, new lines are kept without being
+    stored.
+    """
+    FINGERPRINT = struct.Struct('<Q')
+    BATCH_SIZE = 4096
+
+    def __init__(self, capacity=1 << 22, min_length=20):
+        size = 1
+        while size < capacity * 2:
+            size <<= 1
+        self._slot_mask = size - 1
+        self._capacity = capacity
+        self._min_length = min_length
+        self._table = multiprocessing.RawArray(ctypes.c_uint64, size)
+        # stored fingerprints, removed lines, removed bytes
+        self._counters = multiprocessing.RawArray(ctypes.c_uint64, 3)
+        self._lock = multiprocessing.Lock()
+
+    @property
+    def stored(self):
+        return self._counters[0]
+
+    @property
+    def removed_lines(self):
+        return self._counters[1]
+
+    @property
+    def removed_bytes(self):
+        return self._counters[2]
+
+    @classmethod
+    def fingerprint(cls, key):
+        """Stable 64 bit fingerprint of a normalized line, never 0"""
+        return cls.FINGERPRINT.unpack_from(hashlib.md5(key).digest())[0] or 1
+
+    def unique(self, lines):
+        """Return the list of lines not met before"""
+        min_length = self._min_length
+        fingerprint = self.fingerprint
+        fingerprints = []
+        for line in lines:
+            key = ' '.join(line.lower().split())
+            fingerprints.append(fingerprint(key) if len(key) >= min_length else 0)
+        table = self._table
+        slot_mask = self._slot_mask
+        kept = []
+        removed = removed_bytes = 0
+        with self._lock:
+            stored = self._counters[0]
+            for line, fingerprint in zip(lines, fingerprints):
+                if fingerprint:
+                    slot = fingerprint & slot_mask
+                    value = table[slot]
+                    while value and value != fingerprint:
+                        slot = (slot + 1) & slot_mask
+                        value = table[slot]
+                    if value:
+                        removed += 1
+                        removed_bytes += len(line)
+                        continue
+                    if stored < self._capacity:
+                        table[slot] = fingerprint
+                        stored += 1
+                kept.append(line)
+            self._counters[0] = stored
+            self._counters[1] += removed
+            self._counters[2] += removed_bytes
+        return kept
+
+    def filter(self, lines):
+        """Yield lines not met before"""
+        lines = iter(lines)
+        while True:
+            batch = list(itertools.islice(lines, self.BATCH_SIZE))
+            if not batch:
+                return
+            for line in self.unique(batch):
+                yield line
+
+    def filterBlock(self, block):
+        """Return block without the lines met before"""
+        return ''.join(self.unique(block.splitlines(True)))
+
+    def filterBlocks(self, blocks):
+        """Yield blocks without the lines met before"""
+        return itertools.imap(self.filterBlock, blocks)
+
+    def report(self):
+        return {'stored_lines': self.stored, 'removed_lines': self.removed_lines,
+                'removed_bytes': self.removed_bytes}
+
+
+class LineSample(object):
+    """
+    Seeded sample of the input lines, taken before tokenizing so the whole
+    pipeline runs on a subset.
+
+    With rate, each line is kept with probability rate.  With size, a
+    reservoir of about size lines is kept over all the inputs: each input,
+    or byte range of one, holds a share of it in proportion to its bytes
+    out of total_bytes, and passes its lines on in input order once it is
+    read, so they are held in memory.  The lines seen and kept are counted
+    in shared memory; their ratio is the rate Process scales counts with.
+    """
+
+    def __init__(self, rate=None, size=None, seed=0):
+        assert (rate is None) != (size is None), "Either rate or size is given"
+        assert rate is None or 0 < rate <= 1, "Rate must be in (0, 1]"
+        assert size is None or size > 0, "Size must be greater than 0"
+        self._rate = rate
+        self._size = size
+        self._seed = seed
+        self.total_bytes = 0
+        # lines seen, lines kept
+        self._counters = multiprocessing.RawArray(ctypes.c_uint64, 2)
+        self._lock = multiprocessing.Lock()
+
+    @property
+    def seen(self):
+        return self._counters[0]
+
+    @property
+    def kept(self):
+        return self._counters[1]
+
+    @property
+    def rate(self):
+        """Fraction of the lines kept"""
+        if not self.seen:
+            return self._rate or 1.0
+        return float(self.kept) / self.seen
+
+    def count(self, seen, kept):
+        with self._lock:
+            self._counters[0] += seen
+            self._counters[1] += kept
+
+    def stream(self, input_file, start=0, length=None):
+        """SampleStream of input_file, or of the byte range of it at start"""
+        if length is None:
+            length = os.path.getsize(input_file)
+        seed = zlib.crc32('%s:%d' % (os.path.basename(input_file), start)) & 0xffffffff
+        size = self._size
+        if size is not None and self.total_bytes:
+            size = max(1, int(round(size * float(length) / self.total_bytes)))
+        return SampleStream(self, random.Random(self._seed * (1 << 32) + seed),
+                            self._rate, size)
+
+    def report(self):
+        return {'seen_lines': self.seen, 'kept_lines': self.kept, 'rate': self.rate}
+
+
+class SampleStream(object):
+    """Sample of the lines of one input, given by LineSample.stream"""
+
+    def __init__(self, sample, rng, rate, size):
+        self._sample = sample
+        self._rng = rng
+        self._rate = rate
+        self._size = size
+
+    def filter(self, lines):
+        """Yield the sampled lines"""
+        random = self._rng.random
+        seen = 0
+        if self._size is None:
+            rate = self._rate
+            kept = []
+            for line in lines:
+                seen += 1
+                if random() < rate:
+                    kept.append(line)
+                    if len(kept) >= DedupSet.BATCH_SIZE:
+                        self._sample.count(seen, len(kept))
+                        seen = 0
+                        for kept_line in kept:
+                            yield kept_line
+                        kept = []
+        else:
+            size = self._size
+            kept = []
+            for line in lines:
+                if seen < size:
+                    kept.append((seen, line))
+                else:
+                    index = int(random() * (seen + 1))
+                    if index < size:
+                        kept[index] = (seen, line)
+                seen += 1
+            kept.sort()
+            kept = [line for _, line in kept]
+        self._sample.count(seen, len(kept))
+        for line in kept:
+            yield line
+
+    def filterBlocks(self, blocks):
+        """Yield blocks of the sampled lines"""
+        if self._size is None:
+            for block in blocks:
+                yield ''.join(self.filter(block.splitlines(True)))
+        else:
+            yield ''.join(self.filter(line for block in blocks
+                                      for line in block.splitlines(True)))
+
+
+_shared = {}
+
+def shareObjects(dedup=None, sample=None, phrases=None):
+    """Pool initializer giving the workers the DedupSet and LineSample of
+    the parent, which live in shared memory, and its PhraseFilter, which
+    is too large to be pickled with every task
+    """
+    _shared['dedup'] = dedup
+    _shared['sample'] = sample
+    _shared['phrases'] = phrases
+
+def sharedDedup():
+    """DedupSet given to shareObjects in this process"""
+    assert _shared.get('dedup') is not None, "No DedupSet shared with this process"
+    return _shared['dedup']
+
+def sharedSample():
+    """LineSample given to shareObjects in this process"""
+    assert _shared.get('sample') is not None, "No LineSample shared with this process"
+    return _shared['sample']
+
+def sharedPhrases():
+    """PhraseFilter given to shareObjects in this process"""
+    assert _shared.get('phrases') is not None, "No PhraseFilter shared with this process"
+    return _shared['phrases']
+
+
+class PhraseFilter(object):
+    """
+    Blacklist of phrases dropped from a stream of words in a single pass.
+
+    Phrases are tokenized like the text and kept in a pygtrie.Trie keyed by
+    their words.  Its nodes become the states of an Aho-Corasick automaton,
+    so every word is looked at once whatever the number of phrases.  Words
+    are held back while they may still be part of a phrase; a matched
+    phrase is dropped and a break (None) is put in its place, so no gram
+    spans it.
+    """
+
+    def __init__(self, phrases, chars=False):
+        """
+        Args:
+            phrases, iterable of phrases, one per line, e.g. an opened file
+            chars, phrases are of CJK characters
+        """
+        assert pygtrie is not None, "PhraseFilter needs pygtrie"
+        tokenizer = CharTokenizer() if chars else Tokenizer()
+        trie = pygtrie.Trie()
+        for words in tokenizer.splitLines(phrases):
+            words = tuple(word for word in words if word is not None)
+            if words:
+                trie[words] = True
+        # goto transitions, depth and length of the longest phrase ending
+        # at each state, 0 being the root
+        goto, depth, match, steps = [], [], [], []
+
+        def node(path_conv, path, children, value=False):
+            state = len(goto)
+            goto.append({})
+            depth.append(len(path))
+            match.append(len(path) if value else 0)
+            steps.append(path[-1] if path else None)
+            for child in children:
+                goto[state][steps[child]] = child
+            return state
+
+        trie.traverse(node)
+        self._goto = goto
+        self._depth = depth
+        self._match = match
+        self._fail = [0] * len(self._goto)
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, child in self._goto[state].iteritems():
+                fail = self._fail[state]
+                while fail and word not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(word, 0)
+                self._match[child] = max(self._match[child], self._match[self._fail[child]])
+                queue.append(child)
+
+    def __len__(self):
+        """Number of automaton states"""
+        return len(self._goto)
+
+    def filter(self, words):
+        """Yield words without the phrases, a matched phrase becomes None
+        Args:
+            words, iterable of words, None breaks it
+        """
+        goto = self._goto
+        root = goto[0]
+        fail = self._fail
+        depth = self._depth
+        match = self._match
+        pending = collections.deque()
+        state = 0
+        for word in words:
+            if word is None:
+                while pending:
+                    yield pending.popleft()
+                state = 0
+                yield None
+                continue
+            if not state and word not in root:
+                yield word
+                continue
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+            pending.append(word)
+            if match[state]:
+                for _ in xrange(match[state]):
+                    pending.pop()
+                while pending:
+                    yield pending.popleft()
+                yield None
+                state = 0
+            else:
+                while len(pending) > depth[state]:
+                    yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+
+def chainGrams(gram_numbers, fds, words):
+    """Chain one stream of words into grams of every gram number
+    Args:
+        gram_numbers, list of n-gram
+        fds, output file for each gram number
+        words, iterable of words, consumed as a stream, None breaks it
+    Return:
+        words left after generating grams, one list for each gram number
+    """
+    assert min(gram_numbers) > 0, 'gramNumber must be greater than 0'
+    window = collections.deque(maxlen=max(gram_numbers))
+    sinks = [(n, fd.write) for n, fd in zip(gram_numbers, fds)]
+    for word in words:
+        if word is None:
+            # a break, e.g. the end of a CJK run: grams never cross it and
+            # the words left are written as at the end of the stream
+            for (n, write), left in zip(sinks, leftWords(gram_numbers, window)):
+                if left:
+                    write("\t".join(left) + "\n")
+            window.clear()
+            continue
+        window.append(word)
+        size = len(window)
+        grams = tuple(window)
+        for n, write in sinks:
+            if size >= n:
+                write("\t".join(grams[size - n:]) + "\n")
+    return leftWords(gram_numbers, window)
+
+
+def leftWords(gram_numbers, window):
+    """Words of window left after generating grams, for each gram number"""
+    words = list(window)
+    size = len(words)
+    return [words[size - n + 1:] if size >= n else words
+            for n in gram_numbers]
+
+
+class TokenCache(object):
+    """
+    Tokenized corpus stored as a vocabulary file and a token id stream.
+
+    prefix.vocab holds one word per line, the word on line i has id i.
+    prefix.ids holds little endian uint32 ids, LINE_END marks the end of
+    each input line.  The id stream is read back memory-mapped, so later
+    runs skip the tokenizer and only do sequential integer reads.
+    prefix.options holds, as JSON, the options changing the words cached,
+    i.e. whether repeated lines were dropped.
+    """
+    LINE_END = 0
+    TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self, prefix):
+        self.vocab_file = prefix + '.vocab'
+        self.ids_file = prefix + '.ids'
+        self.options_file = prefix + '.options'
+
+    def options(self):
+        """Options the cache was built with, None if not recorded"""
+        if not os.path.exists(self.options_file):
+            return None
+        with open(self.options_file) as fd:
+            return json.load(fd)
+
+    def exists(self, source=None, dedup=False):
+        """Whether the cache was built, with dedup or not as given, and is
+        not older than source
+        """
+        if not (os.path.exists(self.vocab_file) and os.path.exists(self.ids_file)):
+            return False
+        if self.options() != {'dedup': dedup}:
+            return False
+        return source is None or os.path.getmtime(self.ids_file) >= os.path.getmtime(source)
+
+    def _flush(self, ids, fd):
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        ids.tofile(fd)
+        del ids[:]
+
+    def write(self, word_lines, dedup=False):
+        """Build the cache, yielding words as they go by
+        Args:
+            word_lines, iterable of list of words, one list per input line
+            dedup, whether repeated lines were dropped from word_lines
+        """
+        vocab = {}
+        ids = array.array(self.TYPECODE)
+        tmp_file = self.ids_file + '.tmp'
+        with open(tmp_file, 'wb') as fd:
+            for words in word_lines:
+                for word in words:
+                    id = vocab.get(word)
+                    if id is None:
+                        id = vocab[word] = len(vocab) + 1
+                    ids.append(id)
+                    yield word
+                ids.append(self.LINE_END)
+                if len(ids) >= self.BLOCK_SIZE:
+                    self._flush(ids, fd)
+            self._flush(ids, fd)
+        words = [None] * (len(vocab) + 1)
+        for word, id in vocab.iteritems():
+            words[id] = word
+        with open(self.vocab_file, 'w') as fd:
+            for word in words[1:]:
+                fd.write(word + '\n')
+        with open(self.options_file, 'w') as fd:
+            json.dump({'dedup': dedup}, fd)
+        os.rename(tmp_file, self.ids_file)
+
+    def vocab(self):
+        """List of words indexed by id, LINE_END maps to None"""
+        with open(self.vocab_file) as fd:
+            return [None] + [line.rstrip('\n') for line in fd]
+
+    def words(self):
+        """Yield the cached words memory-mapped, across line ends"""
+        vocab = self.vocab()
+        with open(self.ids_file, 'rb') as fd:
+            if not os.fstat(fd.fileno()).st_size:
+                return
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                step = self.BLOCK_SIZE * 4
+                for start in xrange(0, len(mm), step):
+                    ids = array.array(self.TYPECODE, mm[start:start+step])
+                    if sys.byteorder == 'big':
+                        ids.byteswap()
+                    for word in [vocab[id] for id in ids if id]:
+                        yield word
+            finally:
+                mm.close()
+
+
+def prepareFile(input_file, gram_numbers, fds, cache_prefix=None, use_mmap=False,
+                stats=None, dedup=None, chars=False, sample=None, phrases=None):
+    """Tokenize input_file once and write grams of every gram number
+    Args:
+        input_file, text file
+        gram_numbers, list of n-gram
+        fds, output file, or any object with write(), for each gram number
+        cache_prefix, if given, words are read from this TokenCache when it
+            is up to date and was built with the same dedup, otherwise the
+            cache is built on the way
+        use_mmap, scan a memory map of input_file instead of its lines,
+            ignored when cache_prefix is given or input_file is compressed
+        stats, if given, a TokenStats the words are profiled into, with a
+            ProfilingTokenizer
+        dedup, if given, a DedupSet repeated lines are dropped with before
+            tokenizing.  Words read from a cache built with dedup are
+            taken as they are.
+        chars, write grams of CJK characters with a CharTokenizer instead
+            of words.  It does not work with a cache.
+        sample, if given, a LineSample the lines are sampled with before
+            tokenizing.  It does not work with a cache.
+        phrases, if given, a PhraseFilter whose phrases are dropped from
+            the words
+    """
+    assert not (chars and cache_prefix), "Character grams are not cached"
+    assert not (sample and cache_prefix), "Samples are not cached"
+    filters = [line_filter for line_filter in
+               (sample and sample.stream(input_file), dedup) if line_filter]
+    start = time.time()
+    if chars:
+        tokenizer = CharTokenizer()
+    else:
+        tokenizer = Tokenizer() if stats is None else ProfilingTokenizer(stats)
+    with openFile(input_file) as ifd:
+        if cache_prefix is None:
+            if isCompressed(input_file):
+                blocks = ifd.blocks()
+                for line_filter in filters:
+                    blocks = line_filter.filterBlocks(blocks)
+                words = tokenizer.tokenize(blocks)
+            elif use_mmap:
+                words = tokenizer.scanFile(input_file, filters=filters)
+            else:
+                lines = ifd
+                for line_filter in filters:
+                    lines = line_filter.filter(lines)
+                words = tokenizer.tokenize(lines)
+        else:
+            cache = TokenCache(cache_prefix)
+            if cache.exists(input_file, dedup is not None):
+                words = cache.words()
+            else:
+                words = cache.write(tokenizer.splitLines(
+                    ifd if dedup is None else dedup.filter(ifd)), dedup is not None)
+        if phrases is not None:
+            words = phrases.filter(words)
+        lefts = chainGrams(gram_numbers, fds, words)
+    for fd, words in zip(fds, lefts):
+        if words:
+            fd.write("\t".join(words) + "\n")
+    if stats is not None:
+        stats.seconds['total'] += time.time() - start
+        stats.counts['files'] += 1
+
+
+class GramCounter(object):
+    """
+    File like sink counting gram lines written to it.
+
+    Used in place of a gram file so grams go straight from the tokenizer
+    into counts.  Keys of counts keep the trailing newline.
+    """
+
+    def __init__(self, fd=None):
+        """
+        Args:
+            fd, if given, lines are also written to it
+        """
+        self.counts = collections.defaultdict(int)
+        self._fd = fd
+
+    def write(self, line):
+        self.counts[line] += 1
+        if self._fd:
+            self._fd.write(line)
+
+
+def splitRanges(input_file, chunk_size):
+    """Split input_file into byte ranges of about chunk_size
+    Return:
+        list of (start, end), each range ends at a line boundary
+    """
+    size = os.path.getsize(input_file)
+    ranges = []
+    with open(input_file, 'rb') as fd:
+        start = 0
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                fd.seek(end - 1)
+                fd.readline()
+                end = fd.tell()
+            end = min(end, size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def prepareRange(input_file, start, end, outputs, profile=False, dedup=False,
+                 chars=False, sample=False, shards=None, combine=False):
+    """Write grams lying inside one byte range of input_file
+    Args:
+        input_file, text file
+        start, end, byte range given by splitRanges
+        outputs, list of (gram_number, part_file)
+        profile, profile the words into a TokenStats
+        dedup, drop lines met before by the DedupSet shared with the worker
+        chars, write grams of CJK characters
+        sample, sample the lines with the LineSample shared with the worker
+        shards, split the part files into this many shards
+        combine, write the part files as "gram\tcount" records
+    Return:
+        (head, tail, stats), the first max(n) words and the last max(n) - 1
+        words of the range, which RangeJob needs to stitch grams across
+        ranges, and the TokenStats or None
+    """
+    began = time.time()
+    stats = TokenStats() if profile else None
+    if chars:
+        tokenizer = CharTokenizer()
+    else:
+        tokenizer = ProfilingTokenizer(stats) if profile else Tokenizer()
+    gram_numbers = [gram_number for gram_number, _ in outputs]
+    largest = max(gram_numbers)
+    filters = []
+    if sample:
+        filters.append(sharedSample().stream(input_file, start, end - start))
+    if dedup:
+        filters.append(sharedDedup())
+    words = tokenizer.scanFile(input_file, start, end, filters)
+    head = list(itertools.islice(words, largest))
+    ofds = [openGrams(part_file, shards, combine) for _, part_file in outputs]
+    try:
+        lefts = chainGrams(gram_numbers, ofds, itertools.chain(head, words))
+    finally:
+        for ofd in ofds:
+            ofd.close()
+    if profile:
+        stats.seconds['total'] += time.time() - began
+    return head, lefts[gram_numbers.index(largest)], stats
+
+
+class GramStitcher(object):
+    """
+    Rebuild the grams crossing the boundaries of the consecutive parts of
+    one word stream, each part chained into grams on its own.  Parts are
+    given by their head, the first max(n) words, and their tail, the last
+    max(n) - 1 words.
+    """
+
+    def __init__(self, gram_numbers, fds):
+        self._gram_numbers = gram_numbers
+        self._fds = fds
+        self._largest = max(gram_numbers)
+        self._carry = []
+        self._total = 0
+
+    def add(self, head, tail):
+        """Write the grams starting in the previous parts and ending in the
+        head of the next one, before the grams of the part are written
+        """
+        carry = self._carry
+        words = carry + head
+        for gram_number, fd in zip(self._gram_numbers, self._fds):
+            for i in xrange(max(len(carry) - gram_number + 1, 0), len(carry)):
+                if i + gram_number <= len(words):
+                    fd.write("\t".join(words[i:i+gram_number]) + "\n")
+        carry = carry + tail
+        largest = self._largest
+        self._carry = carry[max(len(carry) - largest + 1, 0):] if largest > 1 else []
+        self._total = min(self._total + len(head), largest)
+
+    def finish(self):
+        """Write the words left at the end of the stream"""
+        carry = self._carry
+        for gram_number, fd in zip(self._gram_numbers, self._fds):
+            words = carry[len(carry) - gram_number + 1:] if self._total >= gram_number else carry
+            if words:
+                fd.write("\t".join(words) + "\n")
+
+
+class RangeJob(object):
+    """
+    Prepare a single large input in parallel.
+
+    The input is split into line aligned byte ranges which are tokenized
+    by prepareRange on a pool.  Grams crossing a range boundary are rebuilt
+    from the words carried over from the previous ranges and the head words
+    of the next one, so the stitched output is identical to a sequential
+    pass over the file.
+    """
+
+    def __init__(self, input_file, outputs, chunk_size, profile=False, dedup=False,
+                 chars=False, sample=False, shards=None, combine=False):
+        """
+        Args:
+            input_file, text file
+            outputs, list of (gram_number, output_file)
+            chunk_size, bytes per range
+            profile, profile the ranges, finish() then returns a TokenStats
+            dedup, drop lines met before by the DedupSet shared with the
+                pool workers
+            chars, write grams of CJK characters
+            sample, sample the lines with the LineSample shared with the
+                pool workers
+            shards, split the output files into this many shards
+            combine, write the output files as "gram\tcount" records,
+                combined within each range
+        """
+        self._input_file = input_file
+        self._outputs = outputs
+        self._profile = profile
+        self._dedup = dedup
+        self._chars = chars
+        self._sample = sample
+        self._shards = shards
+        self._combine = combine
+        self._ranges = splitRanges(input_file, chunk_size)
+        self._results = []
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def partFile(self, output_file, index):
+        return '%s.part%d' % (output_file, index)
+
+    def submit(self, pool):
+        """Queue every range on pool"""
+        for index, (start, end) in enumerate(self._ranges):
+            parts = [(gram_number, self.partFile(output_file, index))
+                     for gram_number, output_file in self._outputs]
+            self._results.append(pool.apply_async(prepareRange,
+                (self._input_file, start, end, parts, self._profile, self._dedup,
+                 self._chars, self._sample, self._shards, self._combine)))
+
+    def finish(self):
+        """Wait for the ranges and stitch them into the output files
+        Return:
+            TokenStats of all the ranges if profiled, otherwise None
+        """
+        stats = TokenStats() if self._profile else None
+        gram_numbers = [gram_number for gram_number, _ in self._outputs]
+        ofds = [openGrams(output_file, self._shards, self._combine)
+                for _, output_file in self._outputs]
+        stitcher = GramStitcher(gram_numbers, ofds)
+        try:
+            for index, result in enumerate(self._results):
+                head, tail, range_stats = result.get()
+                if stats is not None:
+                    stats.add(range_stats)
+                stitcher.add(head, tail)
+                for (gram_number, output_file), ofd in zip(self._outputs, ofds):
+                    part_file = self.partFile(output_file, index)
+                    if self._shards:
+                        parts = [(shardFile(part_file, shard), fd)
+                                 for shard, fd in enumerate(outputFds(ofd))]
+                    else:
+                        parts = [(part_file, outputFds(ofd)[0])]
+                    for part_file, fd in parts:
+                        with open(part_file) as pfd:
+                            shutil.copyfileobj(pfd, fd, 1 << 20)
+                        os.remove(part_file)
+            stitcher.finish()
+        finally:
+            for ofd in ofds:
+                ofd.close()
+        if stats is not None:
+            stats.counts['files'] += 1
+        return stats
+
+
+class GramBuffer(object):
+    """
+    File like sink keeping gram lines in memory, split into shards by the
+    first word if given, so they are written by one call per shard.  Lines
+    are combined into "gram\tcount" records if combine.
+    """
+
+    def __init__(self, shards=None, combine=False):
+        self._lines = [[] for _ in xrange(shards or 1)]
+        self._counts = collections.defaultdict(int) if combine else None
+        if combine:
+            self.write = self._count
+        elif not shards:
+            self.write = self._lines[0].append
+
+    def _count(self, line):
+        self._counts[line] += 1
+
+    def _append(self, line):
+        tab = line.find('\t')
+        token = line[:tab] if tab >= 0 else line.rstrip('\n')
+        self._lines[gramShard(token, len(self._lines))].append(line)
+
+    write = _append
+
+    def texts(self):
+        """Text of each shard"""
+        if self._counts:
+            append = self._lines[0].append if len(self._lines) == 1 else self._append
+            for line, count in self._counts.iteritems():
+                append("%s\t%d\n" % (line[:-1], count))
+            self._counts.clear()
+        return [''.join(lines) for lines in self._lines]
+
+
+def prepareBlock(input_file, start, block, gram_numbers, profile=False, dedup=False,
+                 chars=False, sample=False, shards=None, combine=False):
+    """Chain the words of one block of lines of input_file into grams
+    Args:
+        input_file, text file the block is read from
+        start, offset of the block in the text, seeding its sample
+        block, str of whole lines
+        gram_numbers, list of n-gram
+        profile, profile the words into a TokenStats
+        dedup, drop lines met before by the DedupSet shared with the worker
+        chars, make grams of CJK characters
+        sample, sample the lines with the LineSample shared with the worker
+        shards, split the grams into this many shards
+        combine, combine the grams into "gram\tcount" records
+    Return:
+        (head, tail, texts, stats), head and tail as prepareRange returns
+        them, for each gram number the list of gram text of each shard, and
+        the TokenStats or None
+    """
+    began = time.time()
+    stats = TokenStats() if profile else None
+    if chars:
+        tokenizer = CharTokenizer()
+    else:
+        tokenizer = ProfilingTokenizer(stats) if profile else Tokenizer()
+    texts = [block]
+    if sample:
+        texts = sharedSample().stream(input_file, start, len(block)).filterBlocks(texts)
+    if dedup:
+        texts = sharedDedup().filterBlocks(texts)
+    words = (word for text in texts
+             for words in tokenizer.scanBuffer(text, 0, len(text))
+             for word in words)
+    head = list(itertools.islice(words, max(gram_numbers)))
+    buffers = [GramBuffer(shards, combine) for _ in gram_numbers]
+    lefts = chainGrams(gram_numbers, buffers, itertools.chain(head, words))
+    if profile:
+        stats.seconds['total'] += time.time() - began
+    return (head, lefts[gram_numbers.index(max(gram_numbers))],
+            [buffer.texts() for buffer in buffers], stats)
+
+
+class PipelineJob(object):
+    """
+    Prepare a single large input, compressed or not, as a pipeline.
+
+    A reader thread cuts the input into blocks of whole lines and hands
+    them to prepareBlock on a pool, while a writer thread takes the grams
+    of the blocks back in order, stitches them as RangeJob does and writes
+    them with one call per block.  At most QUEUE_SIZE blocks are in flight,
+    so the reader waits for busy workers and the workers for a slow disk.
+    """
+    BLOCK_SIZE = 4 << 20
+    QUEUE_SIZE = 8
+
+    def __init__(self, input_file, outputs, block_size=BLOCK_SIZE, profile=False,
+                 dedup=False, chars=False, sample=False, shards=None, combine=False):
+        """
+        Args:
+            input_file, text file
+            outputs, list of (gram_number, output_file)
+            block_size, bytes per block
+            profile, profile the blocks, finish() then returns a TokenStats
+            dedup, drop lines met before by the DedupSet shared with the
+                pool workers
+            chars, write grams of CJK characters
+            sample, sample the lines with the LineSample shared with the
+                pool workers
+            shards, split the output files into this many shards
+            combine, write the output files as "gram\tcount" records,
+                combined within each block
+        """
+        self._input_file = input_file
+        self._outputs = outputs
+        self._block_size = block_size
+        self._options = (profile, dedup, chars, sample, shards, combine)
+        self._profile = profile
+        self._shards = shards
+        self._combine = combine
+        self._queue = Queue.Queue(self.QUEUE_SIZE)
+        # set by the writer on error, so the reader stops queueing blocks
+        self._stop = threading.Event()
+        self._errors = []
+        self._stats = None
+        self._threads = []
+
+    def __len__(self):
+        return max(os.path.getsize(self._input_file) // self._block_size, 1)
+
+    def blocks(self):
+        """Yield (start, block) of whole lines of the input"""
+        with openFile(self._input_file, 'rb', threaded=False) as fd:
+            start = 0
+            left = ''
+            while True:
+                data = fd.read(self._block_size)
+                if not data:
+                    break
+                data = left + data
+                cut = data.rfind('\n') + 1
+                left = data[cut:]
+                if cut:
+                    yield start, data[:cut]
+                    start += cut
+            if left:
+                yield start, left
+
+    def _read(self, pool):
+        gram_numbers = [gram_number for gram_number, _ in self._outputs]
+        try:
+            for start, block in self.blocks():
+                if self._stop.is_set():
+                    break
+                self._queue.put(pool.apply_async(prepareBlock,
+                    (self._input_file, start, block, gram_numbers) + self._options))
+        except Exception as e:
+            self._queue.put(e)
+        self._queue.put(None)
+
+    def _write(self):
+        stats = TokenStats() if self._profile else None
+        gram_numbers = [gram_number for gram_number, _ in self._outputs]
+        ofds = []
+        done = False
+        try:
+            ofds = [openGrams(output_file, self._shards, self._combine)
+                    for _, output_file in self._outputs]
+            stitcher = GramStitcher(gram_numbers, ofds)
+            while True:
+                result = self._queue.get()
+                if result is None:
+                    done = True
+                    break
+                if isinstance(result, Exception):
+                    raise result
+                head, tail, texts, block_stats = result.get()
+                if stats is not None:
+                    stats.add(block_stats)
+                stitcher.add(head, tail)
+                for ofd, shard_texts in zip(ofds, texts):
+                    for fd, text in zip(outputFds(ofd), shard_texts):
+                        fd.write(text)
+            stitcher.finish()
+        except Exception as e:
+            self._errors.append(e)
+            # stop the reader, and let it put the blocks queued so far
+            self._stop.set()
+            while not done:
+                done = self._queue.get() is None
+        finally:
+            for ofd in ofds:
+                ofd.close()
+        if stats is not None:
+            stats.counts['files'] += 1
+        self._stats = stats
+
+    def submit(self, pool):
+        """Start the reader and the writer, blocks are queued on pool,
+        which is kept open until finish()
+        """
+        self._threads = [threading.Thread(target=self._read, args=(pool,)),
+                         threading.Thread(target=self._write)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def finish(self):
+        """Wait for the pipeline to write every block
+        Return:
+            TokenStats of all the blocks if profiled, otherwise None
+        """
+        for thread in self._threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+        return self._stats
+
+
+def legacyTokenize(lines):
+    """The filter chain Tokenizer replaces, kept for benchmark"""
+    words = []
+    for line in lines:
+        words = re.split(r'[^0-9A-Za-z]+', line.strip())
+        words = map(lambda word:word.lower(), words)
+        words = filter(lambda word:len(word) > 1, words)
+        words = filter(lambda word:not re.match(r'^[0-9]+$', word), words)
+        words = filter(lambda word:not re.search(r'.*([0-9][a-z])|([a-z][0-9]).*', word), words)
+        words = filter(lambda word: not re.match(r'^([a-z])\1*$', word), words)
+        words = filter(lambda word: not re.search(r'([a-z])\1{2,}', word), words)
+        for word in words:
+            yield word
+
+
+def benchmark(input_file):
+    """Print tokens/sec of legacyTokenize and Tokenizer on the same input"""
+    with open(input_file) as fd:
+        lines = fd.readlines()
+    tu = TimeUtil()
+    results = []
+    for name, tokenize in (('legacy', legacyTokenize),
+                           ('tokenizer', Tokenizer().tokenize)):
+        tu.start()
+        words = list(tokenize(lines))
+        seconds = tu.elapsed().total_seconds()
+        results.append(words)
+        print "%-10s %10d tokens %8.2f s %12.0f tokens/sec" % (
+            name, len(words), seconds, len(words) / seconds)
+    assert results[0] == results[1], 'Tokenizer output differs from legacy'
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1])
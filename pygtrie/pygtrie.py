@@ -7,10 +7,14 @@ of a node have a common prefix (associated with that node).
 
 The trie module contains :class:`pygtrie.Trie`, :class:`pygtrie.CharTrie` and
 :class:`pygtrie.StringTrie` classes each implementing a mutable mapping
-interface, i.e. :class:`dict` interface.  As such, in most circumstances,
-:class:`pygtrie.Trie` could be used as a drop-in replacement for
-a :class:`dict`, but the prefix nature of the data structure is trie’s real
-strength.
+interface, i.e. :class:`dict` interface.  Their counting variants,
+:class:`pygtrie.CountingTrie`, :class:`pygtrie.CharCountingTrie` and
+:class:`pygtrie.StringCountingTrie`, also keep the sum of values under every
+node, and :class:`pygtrie.FrozenTrie` is a compact read-only copy of any of
+them, which :class:`pygtrie.MappedTrie` reads in place from a file.  As
+such, in most circumstances, :class:`pygtrie.Trie` could be used as a drop-in
+replacement for a :class:`dict`, but the prefix nature of the data structure
+is trie’s real strength.
 
 The module also contains :class:`pygtrie.PrefixSet` class which uses a trie to
 store a set of prefixes such that a key is contained in the set if it or its
@@ -39,13 +43,26 @@ __author__ = 'Michal Nazarewicz <mina86@mina86.com>'
 __copyright__ = 'Copyright 2014 Google Inc.'
 
 
+import array as _array
+import bisect as _bisect
 import collections as _collections
+import copy as _copy
+import ctypes as _ctypes
+import itertools as _itertools
+import mmap as _mmap
+import operator as _operator
+import pickle as _pickle
+import struct as _struct
+import zlib as _zlib
 
 # Python 2.x and 3.x compatibility stuff
 if hasattr(dict, 'iteritems'):
     # pylint: disable=invalid-name
     _iteritems = lambda d: d.iteritems()
     _iterkeys = lambda d: d.iterkeys()
+    _range = xrange  # pylint: disable=invalid-name,undefined-variable
+    _text = unicode  # pylint: disable=invalid-name,undefined-variable
+    _integer_types = (int, long)  # pylint: disable=invalid-name,undefined-variable
     def _sorted_iteritems(d):
         """Returns d's items in sorted order."""
         items = d.items()
@@ -55,6 +72,9 @@ else:
     _sorted_iteritems = lambda d: sorted(d.items())  # pylint: disable=invalid-name
     _iteritems = lambda d: iter(d.items())  # pylint: disable=invalid-name
     _iterkeys = lambda d: iter(d.keys())  # pylint: disable=invalid-name
+    _range = range  # pylint: disable=invalid-name
+    _text = str  # pylint: disable=invalid-name
+    _integer_types = (int,)  # pylint: disable=invalid-name
 
 
 class ShortKeyError(KeyError):
@@ -269,6 +289,40 @@ class _Node(object):
                 stack[-1].value = next(state)
 
 
+class _CountNode(_Node):
+    """A node of a counting trie.
+
+    In addition to :class:`_Node`, stores the sum of the values of the node and
+    all of its descendants.  The sum is not pickled but computed again when
+    unpickling.
+    """
+    __slots__ = ('total',)
+
+    def __init__(self):
+        self.children = {}
+        self.value = _SENTINEL
+        self.total = 0
+
+    def update_totals(self):
+        """Computes sums of the node and all of its descendants from scratch."""
+        # Like iterate, we don't recurse so this works on deep tries.  Nodes
+        # are listed parents first, so going backwards children are done
+        # before their parents.
+        nodes = [self]
+        for node in nodes:
+            nodes.extend(node.children.values())
+        for node in reversed(nodes):
+            total = 0 if node.value is _SENTINEL else node.value
+            for child in node.children.values():
+                total += child.total
+            node.total = total
+
+    def __setstate__(self, state):
+        """Unpickles node.  See :func:`_Node.__getstate__`."""
+        super(_CountNode, self).__setstate__(state)
+        self.update_totals()
+
+
 _NONE_PAIR = type('NonePair', (tuple,), {
     '__nonzero__': lambda _: False,
     '__bool__': lambda _: False,
@@ -290,13 +344,17 @@ class Trie(_collections.MutableMapping):
     :class:`pygtrie.Trie` with string keys.
     """
 
+    # Class of the nodes, may be overridden by subclasses keeping more data in
+    # each node.
+    _NODE_CLS = _Node
+
     def __init__(self, *args, **kwargs):
         """Initialises the trie.
 
         Arguments are interpreted the same way :func:`Trie.update` interprets
         them.
         """
-        self._root = _Node()
+        self._root = self._NODE_CLS()
         self._sorted = False
         self.update(*args, **kwargs)
 
@@ -337,7 +395,7 @@ class Trie(_collections.MutableMapping):
 
     def clear(self):
         """Removes all the values from the trie."""
-        self._root = _Node()
+        self._root = self._NODE_CLS()
 
     def update(self, *args, **kwargs):
         """Updates stored values.  Works like :func:`dict.update`."""
@@ -356,10 +414,124 @@ class Trie(_collections.MutableMapping):
             args = ()
         super(Trie, self).update(*args, **kwargs)
 
+    def bulk_load(self, items, presorted=False):
+        """Sets values of many keys in one sweep.
+
+        Nodes on the path shared by a key with the key before it are not
+        walked again, so loading keys in sorted order, where neighbours share
+        long prefixes, is much faster than setting them one by one.  If a key
+        is given more than once, its last value is kept, like with
+        :func:`Trie.update`.
+
+        Args:
+            items: An iterable of ``(key, value)`` pairs.
+            presorted: Whether ``items`` are already sorted by key, or ordered
+                so that keys sharing a prefix are next to each other.  If
+                ``False``, they are sorted first, which holds all of them in
+                memory.  The order only affects speed, not the result.
+        """
+        if not presorted:
+            items = sorted(items, key=_operator.itemgetter(0))
+        path_from_key = self._path_from_key
+        node_cls = self._NODE_CLS
+        # Path of the previous key and the nodes along it, root included.
+        last = ()
+        nodes = [self._root]
+        for key, value in items:
+            path = path_from_key(key)
+            if not isinstance(path, _collections.Sequence):
+                path = tuple(path)
+            depth = 0
+            limit = min(len(last), len(path))
+            while depth < limit and last[depth] == path[depth]:
+                depth += 1
+            del nodes[depth + 1:]
+            node = nodes[depth]
+            for step in path[depth:]:
+                child = node.children.get(step)
+                if child is None:
+                    child = node.children[step] = node_cls()
+                nodes.append(child)
+                node = child
+            node.value = value
+            last = path
+
+    def merge(self, other, combine=None):
+        """Moves all keys of another trie into the trie.
+
+        The tries are walked together.  Where only ``other`` has a child, the
+        whole subtrie is moved over as is, without walking or copying it, so
+        merging tries with few keys in common takes about the time of walking
+        their common part.  For example::
+
+            >>> import operator, pygtrie
+            >>> t = pygtrie.StringTrie()
+            >>> t['foo/bar'] = 1
+            >>> u = pygtrie.StringTrie()
+            >>> u['foo/bar'] = 2
+            >>> u['foo/baz'] = 4
+            >>> t.merge(u, operator.add)
+            >>> sorted(t.items())
+            [('foo/bar', 3), ('foo/baz', 4)]
+
+        Since its nodes are taken over, ``other`` is left empty.  Both tries
+        must convert keys to paths the same way.
+
+        Args:
+            other: A trie of the same node class to merge, for instance of the
+                same class.
+            combine: A function taking a value of the trie and a value of
+                ``other`` for the same key and returning the merged value.  If
+                ``None``, values of ``other`` replace those of the trie, like
+                with :func:`Trie.update`.
+
+        Raises:
+            TypeError: If nodes of ``other`` are of a different class.
+        """
+        self._merge_nodes(other, combine)
+
+    def _merge_nodes(self, other, combine):
+        """Merges other into the trie.  See :func:`Trie.merge`.
+
+        Returns:
+            A list of nodes of the trie which were walked, i.e. whose children
+            or values may have changed, parents before their children.
+        """
+        # pylint: disable=protected-access
+        if other._NODE_CLS is not self._NODE_CLS:
+            raise TypeError('Cannot merge tries of %s nodes into %s nodes' % (
+                other._NODE_CLS.__name__, self._NODE_CLS.__name__))
+        walked = []
+        # Like iterate, we don't recurse so merging works on deep tries.
+        stack = [(self._root, other._root)]
+        while stack:
+            node, theirs = stack.pop()
+            walked.append(node)
+            if theirs.value is not _SENTINEL:
+                if node.value is _SENTINEL or combine is None:
+                    node.value = theirs.value
+                else:
+                    node.value = combine(node.value, theirs.value)
+            for step, child in _iteritems(theirs.children):
+                own = node.children.get(step)
+                if own is None:
+                    node.children[step] = child
+                else:
+                    stack.append((own, child))
+        other._root = other._NODE_CLS()
+        return walked
+
     def copy(self):
         """Returns a shallow copy of the trie."""
         return self.__class__(self)
 
+    def freeze(self):
+        """Returns a read-only copy of the trie kept in compact arrays.
+
+        See :class:`pygtrie.FrozenTrie`.
+        """
+        return FrozenTrie(self)
+
     @classmethod
     def fromkeys(cls, keys, value=None):
         """Creates a new trie with given keys set.
@@ -403,7 +575,10 @@ class Trie(_collections.MutableMapping):
         trace = [(None, node)]
         for step in self.__path_from_key(key):
             if create:
-                node = node.children.setdefault(step, _Node())
+                child = node.children.get(step)
+                if child is None:
+                    child = node.children[step] = self._NODE_CLS()
+                node = child
             else:
                 node = node.children.get(step)
                 if not node:
@@ -739,6 +914,71 @@ class Trie(_collections.MutableMapping):
         """
         return self._set(key, value, only_if_missing=True)
 
+    def increment(self, key, delta=1):
+        """Adds delta to value of a given key, taking a missing value as 0.
+
+        The path to the node is walked, and created if needed, only once, as
+        opposed to the ``setdefault``, ``__getitem__`` and ``__setitem__``
+        sequence, so it is the method to use for counting.  For example::
+
+            >>> import pygtrie
+            >>> t = pygtrie.StringTrie()
+            >>> t.increment('foo/bar')
+            1
+            >>> t.increment('foo/bar', 2)
+            3
+
+        Args:
+            key: Key to increment value of.
+            delta: Value to add.
+
+        Returns:
+            New value of the node.
+        """
+        node = self._root
+        for step in self._path_from_key(key):
+            child = node.children.get(step)
+            if child is None:
+                child = node.children[step] = self._NODE_CLS()
+            node = child
+        node.value = delta if node.value is _SENTINEL else node.value + delta
+        return node.value
+
+    def increment_keys(self, keys, delta=1):
+        """Increments value of each of given keys.
+
+        This is equivalent to calling :func:`Trie.increment` for each key but
+        faster.
+
+        Args:
+            keys: An iterable of keys, each counted as many times as it is
+                present.
+            delta: Value to add for each key.
+        """
+        self.increment_items((key, delta) for key in keys)
+
+    def increment_items(self, items):
+        """Increments value of each key by a delta given with it.
+
+        This is equivalent to calling :func:`Trie.increment` for each pair but
+        faster.
+
+        Args:
+            items: An iterable of ``(key, delta)`` pairs.
+        """
+        root = self._root
+        path_from_key = self._path_from_key
+        node_cls = self._NODE_CLS
+        for key, delta in items:
+            node = root
+            for step in path_from_key(key):
+                child = node.children.get(step)
+                if child is None:
+                    child = node.children[step] = node_cls()
+                node = child
+            node.value = (delta if node.value is _SENTINEL
+                          else node.value + delta)
+
     @staticmethod
     def _cleanup_trace(trace):
         """Removes empty nodes present on specified trace.
@@ -1237,6 +1477,933 @@ class StringTrie(Trie):
         return self._separator.join(path)
 
 
+class CountingTrie(Trie):
+    """A :class:`pygtrie.Trie` of numbers which keeps their sums per subtrie.
+
+    Every node keeps the sum of its value and the values of all of its
+    descendants, updated by every change of the trie, so the sum of the values
+    of all keys with a given prefix is read by :func:`CountingTrie.prefix_sum`
+    after walking the prefix only, instead of iterating over the subtrie.
+    For example::
+
+        >>> import pygtrie
+        >>> t = pygtrie.StringCountingTrie()
+        >>> t.increment('foo/bar', 2)
+        2
+        >>> t.increment('foo/baz')
+        1
+        >>> t.prefix_sum('foo')
+        3
+
+    Values must be numbers.  Each change costs a walk of the key's path, and
+    bulk loading or unpickling computes all the sums in a single pass.
+    """
+
+    _NODE_CLS = _CountNode
+
+    def prefix_sum(self, prefix=_SENTINEL):
+        """Returns sum of values of all keys with given prefix.
+
+        Args:
+            prefix: Prefix to sum values under, the whole trie by default.
+
+        Returns:
+            Sum of the values of the prefix and the keys it is a prefix of, or
+            0 if there are no such keys.
+        """
+        node = self._root
+        if prefix is not _SENTINEL:
+            for step in self._path_from_key(prefix):
+                node = node.children.get(step)
+                if node is None:
+                    return 0
+        return node.total
+
+    def increment(self, key, delta=1):
+        node_cls = self._NODE_CLS
+        node = self._root
+        node.total += delta
+        for step in self._path_from_key(key):
+            child = node.children.get(step)
+            if child is None:
+                child = node.children[step] = node_cls()
+            node = child
+            node.total += delta
+        node.value = delta if node.value is _SENTINEL else node.value + delta
+        return node.value
+
+    increment.__doc__ = Trie.increment.__doc__
+
+    def increment_items(self, items):
+        increment = self.increment
+        for key, delta in items:
+            increment(key, delta)
+
+    increment_items.__doc__ = Trie.increment_items.__doc__
+
+    def bulk_load(self, items, presorted=False):
+        super(CountingTrie, self).bulk_load(items, presorted=presorted)
+        self._root.update_totals()
+
+    bulk_load.__doc__ = Trie.bulk_load.__doc__
+
+    def merge(self, other, combine=None):
+        # Moved subtries keep their sums, only the walked nodes are summed
+        # again, children first.
+        for node in reversed(self._merge_nodes(other, combine)):
+            total = 0 if node.value is _SENTINEL else node.value
+            for child in node.children.values():
+                total += child.total
+            node.total = total
+
+    merge.__doc__ = Trie.merge.__doc__
+
+    def _set(self, key, value, only_if_missing=False, clear_children=False):
+        node, trace = self._get_node(key, create=True)
+        before = node.total
+        old = 0 if node.value is _SENTINEL else node.value
+        if not only_if_missing or node.value is _SENTINEL:
+            node.value = value
+        if clear_children:
+            node.children.clear()
+            after = node.value
+        else:
+            after = before - old + node.value
+        delta = after - before
+        if delta:
+            for _, parent in trace:
+                parent.total += delta
+        return node.value
+
+    def _pop_from_node(self, node, trace, default=_SENTINEL):
+        had_value = node.value is not _SENTINEL
+        value = super(CountingTrie, self)._pop_from_node(node, trace, default)
+        if had_value:
+            for _, parent in trace:
+                parent.total -= value
+        return value
+
+    def __delitem__(self, key_or_slice):
+        key, is_slice = self._slice_maybe(key_or_slice)
+        node, trace = self._get_node(key)
+        if is_slice:
+            removed = node.total
+        else:
+            removed = 0 if node.value is _SENTINEL else node.value
+        super(CountingTrie, self).__delitem__(key_or_slice)
+        for _, parent in trace:
+            parent.total -= removed
+
+    __delitem__.__doc__ = Trie.__delitem__.__doc__
+
+
+class CharCountingTrie(CountingTrie, CharTrie):
+    """A :class:`pygtrie.CountingTrie` accepting strings as keys, like
+    :class:`pygtrie.CharTrie`.
+    """
+    pass
+
+
+class StringCountingTrie(CountingTrie, StringTrie):
+    """A :class:`pygtrie.CountingTrie` accepting strings with a separator as
+    keys, like :class:`pygtrie.StringTrie`.
+    """
+    pass
+
+
+# Magic number starting a trie written by :func:`dump`.
+DUMP_MAGIC = b'PYGTRIS\x01'
+
+# Kinds of values in node headers.
+_NO_VALUE, _INT_VALUE, _PICKLED_VALUE = range(3)
+# Kinds of new steps in the step dictionary.
+_BYTES_STEP, _TEXT_STEP, _PICKLED_STEP = range(3)
+
+
+def _append_varint(out, number):
+    """Appends a non-negative number to a bytearray as a varint."""
+    while number > 0x7f:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def dump(trie, fd, chunk=1 << 16):
+    """Writes a trie to a file object a node at a time.
+
+    Unlike pickling, which builds the state of the whole trie in memory
+    first, nodes are encoded as they are walked and written a chunk at a
+    time, so dumping takes no memory beyond the trie.  The file holds:
+
+    - :data:`DUMP_MAGIC`,
+    - a varint length and a pickle of an empty copy of the trie, which
+      restores its class and attributes such as the separator,
+    - the nodes in preorder.  Each node is a varint of its number of children
+      shifted left by two bits, or-ed with the kind of its value, followed by
+      the value, a zigzag varint for integers or a varint length and a pickle
+      for anything else.  Each child is preceded by its step: a varint ``i``
+      referring to the ``i``-th step met so far, or ``0`` followed by a new
+      step, a byte of its kind, a varint length and its bytes, utf-8 text or
+      pickle.
+
+    Args:
+        trie: A :class:`pygtrie.Trie` to write.
+        fd: A file object open for writing in binary mode.
+        chunk: Number of bytes encoded before they are written.
+    """
+    empty = _copy.copy(trie)
+    empty._root = trie._NODE_CLS()  # pylint: disable=protected-access
+    out = bytearray(DUMP_MAGIC)
+    header = _pickle.dumps(empty, protocol=2)
+    _append_varint(out, len(header))
+    out.extend(header)
+
+    step_ids = {}
+    node = trie._root  # pylint: disable=protected-access
+    stack = []
+    while True:
+        value = node.value
+        if value is _SENTINEL:
+            _append_varint(out, len(node.children) << 2 | _NO_VALUE)
+        elif type(value) in _integer_types:  # pylint: disable=unidiomatic-typecheck
+            _append_varint(out, len(node.children) << 2 | _INT_VALUE)
+            _append_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+        else:
+            _append_varint(out, len(node.children) << 2 | _PICKLED_VALUE)
+            data = _pickle.dumps(value, protocol=2)
+            _append_varint(out, len(data))
+            out.extend(data)
+        if len(out) >= chunk:
+            fd.write(bytes(out))
+            del out[:]
+        stack.append(_iteritems(node.children))
+
+        while True:
+            try:
+                step, node = next(stack[-1])
+                break
+            except StopIteration:
+                stack.pop()
+            except IndexError:
+                fd.write(bytes(out))
+                return
+
+        step_id = step_ids.get(step)
+        if step_id is not None:
+            _append_varint(out, step_id)
+            continue
+        step_ids[step] = len(step_ids) + 1
+        out.append(0)
+        if isinstance(step, bytes):
+            out.append(_BYTES_STEP)
+            data = step
+        elif isinstance(step, _text):
+            out.append(_TEXT_STEP)
+            data = step.encode('utf-8')
+        else:
+            out.append(_PICKLED_STEP)
+            data = _pickle.dumps(step, protocol=2)
+        _append_varint(out, len(data))
+        out.extend(data)
+
+
+class _Reader(object):
+    """Buffered reader of a file written by :func:`dump`."""
+
+    def __init__(self, fd, chunk=1 << 16):
+        self._fd = fd
+        self._chunk = chunk
+        self._buf = bytearray()
+        self._pos = 0
+
+    def _fill(self, size):
+        """Makes sure at least size bytes past position are buffered."""
+        del self._buf[:self._pos]
+        self._pos = 0
+        while len(self._buf) < size:
+            data = self._fd.read(max(self._chunk, size - len(self._buf)))
+            if not data:
+                raise EOFError('Trie file is truncated')
+            self._buf.extend(data)
+
+    def read(self, size):
+        """Returns next size bytes."""
+        if self._pos + size > len(self._buf):
+            self._fill(size)
+        data = bytes(self._buf[self._pos:self._pos + size])
+        self._pos += size
+        return data
+
+    def varint(self):
+        """Returns next varint."""
+        buf, pos = self._buf, self._pos
+        number = shift = 0
+        while True:
+            if pos == len(buf):
+                self._pos = pos
+                self._fill(1)
+                buf, pos = self._buf, 0
+            byte = buf[pos]
+            pos += 1
+            number |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                self._pos = pos
+                return number
+            shift += 7
+
+
+def load(fd):
+    """Reads a trie written by :func:`dump` from a file object.
+
+    Nodes are created as they are read, so loading takes no memory beyond the
+    trie.  Sums of counting tries are computed once all nodes are read.
+
+    Args:
+        fd: A file object open for reading in binary mode.
+
+    Returns:
+        The trie, of the class it was dumped from.
+
+    Raises:
+        ValueError: If the file was not written by :func:`dump`.
+        EOFError: If the file is truncated.
+    """
+    if fd.read(len(DUMP_MAGIC)) != DUMP_MAGIC:
+        raise ValueError('Not a dumped trie')
+    reader = _Reader(fd)
+    trie = _pickle.loads(reader.read(reader.varint()))
+    node_cls = trie._NODE_CLS  # pylint: disable=protected-access
+    root = trie._root  # pylint: disable=protected-access
+    varint = reader.varint
+    steps = [None]
+    # Like iterate, we don't recurse so loading works on deep tries.  Stack
+    # holds nodes and the number of their children yet to be read.
+    node, stack = root, []
+    while True:
+        header = varint()
+        kind = header & 3
+        if kind == _INT_VALUE:
+            value = varint()
+            node.value = -(value + 1 >> 1) if value & 1 else value >> 1
+        elif kind == _PICKLED_VALUE:
+            node.value = _pickle.loads(reader.read(varint()))
+        stack.append([node, header >> 2])
+
+        while stack and not stack[-1][1]:
+            stack.pop()
+        if not stack:
+            break
+        parent = stack[-1]
+        parent[1] -= 1
+
+        step_id = varint()
+        if step_id:
+            step = steps[step_id]
+        else:
+            step_kind = varint()
+            step = reader.read(varint())
+            if step_kind == _TEXT_STEP:
+                step = step.decode('utf-8')
+            elif step_kind == _PICKLED_STEP:
+                step = _pickle.loads(step)
+            steps.append(step)
+        node = parent[0].children[step] = node_cls()
+
+    if isinstance(root, _CountNode):
+        root.update_totals()
+    return trie
+
+
+class FrozenTrie(_collections.Mapping):
+    """A read-only copy of a :class:`pygtrie.Trie` kept in compact arrays.
+
+    Instead of a node object with a dictionary of children per node, nodes are
+    numbered in breadth-first order so children of every node are consecutive,
+    and each node takes an entry in a few flat arrays:
+
+    - ``_first[i]`` is the number of the first child of node ``i``, its
+      children ending where the children of node ``i + 1`` start,
+    - ``_steps[i]`` is the step leading to node ``i``, children of each node
+      being sorted by it so a child is found by bisection.  Equal steps are
+      a single shared object,
+    - ``_values[i]`` is the value of node ``i`` if ``_has_value[i]`` is set.
+      Integer values are kept in an array, any other in a list.
+
+    This takes a fraction of the memory of the trie it is created from, for
+    example by :func:`Trie.freeze`::
+
+        >>> import pygtrie
+        >>> t = pygtrie.StringTrie()
+        >>> t['foo/bar'] = 1
+        >>> t['foo/baz'] = 2
+        >>> f = t.freeze()
+        >>> f['foo/bar'], f.has_subtrie('foo'), f.prefix_sum('foo')
+        (1, True, 3)
+
+    Steps must be orderable.  Keys are converted the way the trie converts them
+    and items are yielded in sorted order.
+    """
+
+    HAS_VALUE = Trie.HAS_VALUE
+    HAS_SUBTRIE = Trie.HAS_SUBTRIE
+
+    def __init__(self, trie):
+        """Initialises the trie from a trie.
+
+        Args:
+            trie: A :class:`pygtrie.Trie` to copy.
+        """
+        # An empty copy of the trie converts keys to paths and back.
+        self._keys = _copy.copy(trie)
+        self._keys._root = _Node()  # pylint: disable=protected-access
+
+        root = trie._root  # pylint: disable=protected-access
+        counting = isinstance(root, _CountNode)
+        shared = {}
+        self._first = _array.array('l')
+        self._steps = [None]
+        self._has_value = bytearray()
+        values = []
+        totals = []
+        count = 1
+        queue = _collections.deque([root])
+        while queue:
+            node = queue.popleft()
+            self._first.append(count)
+            if node.value is _SENTINEL:
+                self._has_value.append(0)
+                values.append(0)
+            else:
+                self._has_value.append(1)
+                values.append(node.value)
+            if counting:
+                totals.append(node.total)
+            children = node.children
+            for step in sorted(children):
+                self._steps.append(shared.setdefault(step, step))
+                queue.append(children[step])
+            count += len(children)
+        self._first.append(count)
+        self._len = self._has_value.count(b'\x01')
+        self._values = self._array_maybe(values)
+        self._totals = self._array_maybe(totals) if counting else None
+
+    @staticmethod
+    def _array_maybe(values):
+        """Returns an array of values if they are integers, else the list."""
+        try:
+            return _array.array('l', values)
+        except (TypeError, OverflowError):
+            return values
+
+    @classmethod
+    def join(cls, tries):
+        """Returns a trie of all keys of frozen tries sharing no root child.
+
+        Children of the roots become children of a single root.  Their
+        subtries are copied over level by level as runs of the arrays of the
+        tries they come from, so no key is walked or inserted again.  For
+        example::
+
+            >>> import pygtrie
+            >>> t = pygtrie.StringTrie()
+            >>> t['foo/bar'] = 1
+            >>> u = pygtrie.StringTrie()
+            >>> u['qux'] = 2
+            >>> f = pygtrie.FrozenTrie.join([t.freeze(), u.freeze()])
+            >>> sorted(f.items()), f.prefix_sum()
+            ([('foo/bar', 1), ('qux', 2)], 3)
+
+        Args:
+            tries: Non-empty iterable of :class:`pygtrie.FrozenTrie` objects
+                converting keys to paths the same way.  Keys are converted the
+                way the first of them converts them.
+
+        Returns:
+            A :class:`pygtrie.FrozenTrie`.
+
+        Raises:
+            ValueError: If no trie is given, if two tries share a root child or
+                if more than one has a value for the empty key.
+        """
+        tries = list(tries)
+        if not tries:
+            raise ValueError('No trie to join')
+        # pylint: disable=protected-access
+        root = [index for index, trie in enumerate(tries) if trie._has_value[0]]
+        if len(root) > 1:
+            raise ValueError('More than one trie has a value for the empty key')
+        children = sorted((trie._steps[node], index, node)
+                          for index, trie in enumerate(tries)
+                          for node in _range(trie._first[0], trie._first[1]))
+        for (step, _, _), (other, _, _) in zip(children, children[1:]):
+            if step == other:
+                raise ValueError('Tries share the root child %r' % (step,))
+        counting = all(trie._totals is not None for trie in tries)
+
+        joined = cls.__new__(cls)
+        joined._keys = tries[0]._keys
+        joined._len = sum(trie._len for trie in tries)
+        joined._first = _array.array('l', [1])
+        joined._steps = [None]
+        joined._has_value = bytearray(1)
+        values = [0]
+        totals = [sum(trie._totals[0] for trie in tries)] if counting else None
+        if root:
+            joined._has_value[0] = 1
+            values[0] = tries[root[0]]._values[0]
+
+        # Nodes of a level come in the order of their parents, so the nodes
+        # of each trie a run of parents leads to are a run too.
+        runs = []
+        for _, index, node in children:
+            if runs and runs[-1][0] == index and runs[-1][2] == node:
+                runs[-1][2] = node + 1
+            else:
+                runs.append([index, node, node + 1])
+        shared = {}
+        count = 1 + len(children)
+        while runs:
+            next_runs = []
+            for index, start, end in runs:
+                trie = tries[index]
+                first = trie._first
+                shift = count - first[start]
+                joined._first.extend(first[node] + shift
+                                     for node in _range(start, end))
+                joined._steps.extend(shared.setdefault(step, step)
+                                     for step in trie._steps[start:end])
+                joined._has_value.extend(trie._has_value[start:end])
+                values.extend(trie._values[start:end])
+                if counting:
+                    totals.extend(trie._totals[start:end])
+                if first[start] < first[end]:
+                    if next_runs and next_runs[-1][0] == index and \
+                            next_runs[-1][2] == first[start]:
+                        next_runs[-1][2] = first[end]
+                    else:
+                        next_runs.append([index, first[start], first[end]])
+                count += first[end] - first[start]
+            runs = next_runs
+        joined._first.append(count)
+        joined._values = cls._array_maybe(values)
+        joined._totals = cls._array_maybe(totals) if counting else None
+        return joined
+
+    def _find(self, key):
+        """Returns number of the node for given key, or -1 if there is none."""
+        first, steps = self._first, self._steps
+        node = 0
+        if key is _SENTINEL:
+            return node
+        for step in self._keys._path_from_key(key):  # pylint: disable=protected-access
+            end = first[node + 1]
+            node = _bisect.bisect_left(steps, step, first[node], end)
+            if node == end or steps[node] != step:
+                return -1
+        return node
+
+    def _get_node(self, key):
+        """Returns number of the node for given key or raises KeyError."""
+        node = self._find(key)
+        if node < 0:
+            raise KeyError(key)
+        return node
+
+    def _iterate(self, node, path, shallow):
+        """Yields ``(path, value)`` of nodes with values in a subtrie.
+
+        Like :func:`_Node.iterate`, it doesn't recurse.
+        """
+        first, steps = self._first, self._steps
+        has_value, values = self._has_value, self._values
+        stack = []
+        while True:
+            if has_value[node]:
+                yield path, values[node]
+
+            if ((not shallow or not has_value[node]) and
+                    first[node] < first[node + 1]):
+                stack.append(iter(_range(first[node], first[node + 1])))
+                path.append(None)
+
+            while True:
+                try:
+                    node = next(stack[-1])
+                    path[-1] = steps[node]
+                    break
+                except StopIteration:
+                    stack.pop()
+                    path.pop()
+                except IndexError:
+                    return
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    # pylint: disable=arguments-differ
+
+    def iteritems(self, prefix=_SENTINEL, shallow=False):
+        """Yields all nodes with associated values with given prefix.
+
+        See :func:`Trie.iteritems`.
+        """
+        node = self._get_node(prefix)
+        path = [] if prefix is _SENTINEL else list(
+            self._keys._path_from_key(prefix))  # pylint: disable=protected-access
+        key_from_path = self._keys._key_from_path  # pylint: disable=protected-access
+        for path, value in self._iterate(node, path, shallow):
+            yield key_from_path(path), value
+
+    def iterkeys(self, prefix=_SENTINEL, shallow=False):
+        """Yields all keys having associated values with given prefix.
+
+        See :func:`Trie.iterkeys`.
+        """
+        for key, _ in self.iteritems(prefix=prefix, shallow=shallow):
+            yield key
+
+    def itervalues(self, prefix=_SENTINEL, shallow=False):
+        """Yields all values associated with keys with given prefix.
+
+        See :func:`Trie.itervalues`.
+        """
+        for _, value in self._iterate(self._get_node(prefix), [], shallow):
+            yield value
+
+    def items(self, prefix=_SENTINEL, shallow=False):
+        return list(self.iteritems(prefix=prefix, shallow=shallow))
+
+    def keys(self, prefix=_SENTINEL, shallow=False):
+        return list(self.iterkeys(prefix=prefix, shallow=shallow))
+
+    def values(self, prefix=_SENTINEL, shallow=False):
+        return list(self.itervalues(prefix=prefix, shallow=shallow))
+
+    # pylint: enable=arguments-differ
+
+    def __len__(self):
+        return self._len
+
+    def __nonzero__(self):
+        return len(self._has_value) > 1 or bool(self._has_value[0])
+
+    __bool__ = __nonzero__
+
+    def has_node(self, key):
+        """Returns whether given node is in the trie.
+
+        See :func:`Trie.has_node`.
+        """
+        node = self._find(key)
+        if node < 0:
+            return 0
+        return ((self.HAS_VALUE * self._has_value[node]) |
+                (self.HAS_SUBTRIE *
+                 int(self._first[node] < self._first[node + 1])))
+
+    def has_key(self, key):
+        """Indicates whether given key has value associated with it."""
+        return bool(self.has_node(key) & self.HAS_VALUE)
+
+    def has_subtrie(self, key):
+        """Returns whether given key is a prefix of another key in the trie."""
+        return bool(self.has_node(key) & self.HAS_SUBTRIE)
+
+    def __contains__(self, key):
+        return self.has_key(key)
+
+    def __getitem__(self, key_or_slice):
+        """Returns value associated with given key or raises KeyError.
+
+        See :func:`Trie.__getitem__`.
+        """
+        if Trie._slice_maybe(key_or_slice)[1]:  # pylint: disable=protected-access
+            return self.itervalues(key_or_slice.start)
+        node = self._get_node(key_or_slice)
+        if not self._has_value[node]:
+            raise ShortKeyError(key_or_slice)
+        return self._values[node]
+
+    def prefix_sum(self, prefix=_SENTINEL):
+        """Returns sum of values of all keys with given prefix.
+
+        Sums of a trie frozen from a :class:`pygtrie.CountingTrie` are kept,
+        for any other trie they are computed once on the first call.
+
+        Args:
+            prefix: Prefix to sum values under, the whole trie by default.
+
+        Returns:
+            Sum of the values of the prefix and the keys it is a prefix of, or
+            0 if there are no such keys.
+        """
+        node = self._find(prefix)
+        if node < 0:
+            return 0
+        if self._totals is None:
+            self._totals = self._sum_totals()
+        return self._totals[node]
+
+    def _sum_totals(self):
+        """Returns sums of values under every node."""
+        first, has_value, values = self._first, self._has_value, self._values
+        totals = [0] * len(has_value)
+        # Children are numbered after their parents so going backwards they
+        # are done first.
+        for node in _range(len(has_value) - 1, -1, -1):
+            total = values[node] if has_value[node] else 0
+            for child in _range(first[node], first[node + 1]):
+                total += totals[child]
+            totals[node] = total
+        return self._array_maybe(totals)
+
+    def __str__(self):
+        return 'FrozenTrie(%s)' % (
+            ', '.join('%s: %s' % item for item in self.iteritems()))
+
+    def __repr__(self):
+        if self:
+            return 'FrozenTrie((%s,))' % (
+                ', '.join('(%r, %r)' % item for item in self.iteritems()))
+        else:
+            return 'FrozenTrie()'
+
+    def dump_mapped(self, fd):
+        """Writes the trie to a file in the format :class:`pygtrie.MappedTrie`
+        opens in place.
+
+        Steps must be all byte strings or all unicode strings and values must
+        be integers.
+
+        Args:
+            fd: A file object open for writing in binary mode.
+
+        Raises:
+            TypeError: If steps are not strings or values are not integers.
+        """
+        table = sorted(set(_itertools.islice(self._steps, 1, None)))
+        if all(isinstance(step, bytes) for step in table):
+            flags = 0
+            encoded = table
+        elif all(isinstance(step, _text) for step in table):
+            flags = MappedTrie.TEXT_STEPS
+            encoded = [step.encode('utf-8') for step in table]
+        else:
+            raise TypeError('Only tries of string steps can be mapped')
+        if not all(isinstance(value, _integer_types) for value in self._values):
+            raise TypeError('Only tries of integer values can be mapped')
+        ids = dict((step, i) for i, step in enumerate(table))
+        slots = 1
+        while slots < 2 * len(encoded):
+            slots <<= 1
+        hashed = [-1] * slots
+        for step_id, step in enumerate(encoded):
+            slot = _step_hash(step, slots - 1)
+            while hashed[slot] >= 0:
+                slot = (slot + 1) & (slots - 1)
+            hashed[slot] = step_id
+        if self._totals is None:
+            self._totals = self._sum_totals()
+
+        keys = _pickle.dumps(self._keys, protocol=2)
+        nodes = len(self._has_value)
+        fd.write(MappedTrie.HEADER.pack(MappedTrie.MAGIC, nodes, len(encoded),
+                                        len(keys), flags, self._len, slots))
+        fd.write(_padded(keys))
+        _write_numbers(fd, '<q', self._first)
+        _write_numbers(fd, '<i', _itertools.chain(
+            [-1], (ids[step]
+                   for step in _itertools.islice(self._steps, 1, None))))
+        fd.write(_padded(bytes(bytearray(self._has_value))))
+        _write_numbers(fd, '<q', self._values)
+        _write_numbers(fd, '<q', self._totals)
+        offsets = [0]
+        for step in encoded:
+            offsets.append(offsets[-1] + len(step))
+        _write_numbers(fd, '<q', offsets)
+        _write_numbers(fd, '<i', hashed)
+        fd.write(b''.join(encoded))
+
+
+def _padded(data):
+    """Returns data padded with zeros to a multiple of eight bytes."""
+    return data + b'\0' * (-len(data) % 8)
+
+
+def _write_numbers(fd, fmt, numbers, chunk=1 << 16):
+    """Writes numbers of a struct format, padded to a multiple of eight bytes.
+
+    Numbers are packed a chunk at a time so a big trie is not copied whole.
+    """
+    numbers = iter(numbers)
+    size = 0
+    while True:
+        batch = list(_itertools.islice(numbers, chunk))
+        if not batch:
+            break
+        data = _struct.pack('%s%d%s' % (fmt[0], len(batch), fmt[1:]), *batch)
+        fd.write(data)
+        size += len(data)
+    fd.write(b'\0' * (-size % 8))
+
+
+def _step_hash(step, mask):
+    """Returns slot of a step's bytes in a hash table of mask + 1 slots."""
+    return _zlib.crc32(step) & mask
+
+
+class _MappedSteps(object):
+    """A read-only sequence of steps of nodes in a mapped trie.
+
+    Steps are kept as indices into a table of distinct steps, which is an
+    array of offsets into their bytes.
+    """
+
+    def __init__(self, ids, offsets, buf, offset, text):
+        self._ids = ids
+        self._offsets = offsets
+        self._buf = buf
+        self._offset = offset
+        self._text = text
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, index):
+        step_id = self._ids[index]
+        if step_id < 0:
+            return None
+        step = self._buf[self._offset + self._offsets[step_id]:
+                         self._offset + self._offsets[step_id + 1]]
+        return step.decode('utf-8') if self._text else step
+
+
+class MappedTrie(FrozenTrie):
+    """A :class:`pygtrie.FrozenTrie` read in place from a memory mapped file.
+
+    The file is written by :func:`FrozenTrie.dump_mapped` and holds the arrays
+    of the frozen trie one after another behind a fixed size header, followed
+    by a hash table of the distinct steps and their bytes.  Opening it takes
+    the same time however big the trie is.  The arrays are used where they are
+    mapped, without copying, so processes mapping the same file share its
+    pages::
+
+        >>> import pygtrie
+        >>> t = pygtrie.StringTrie()
+        >>> t['foo/bar'] = 1
+        >>> with open('trie', 'wb') as fd:
+        ...     t.freeze().dump_mapped(fd)
+        >>> m = pygtrie.MappedTrie('trie')
+        >>> m['foo/bar'], m.prefix_sum('foo')
+        (1, 1)
+
+    Pickling a mapped trie pickles the path of its file.
+    """
+
+    MAGIC = b'PYGTRIE\x01'
+    # magic, nodes, distinct steps, length of pickled keys, flags, values,
+    # slots of the step hash table
+    HEADER = _struct.Struct('<8sqqqqqq')
+    TEXT_STEPS = 1
+
+    def __init__(self, path):  # pylint: disable=super-init-not-called
+        """Opens a trie file.
+
+        Args:
+            path: Path of a file written by :func:`FrozenTrie.dump_mapped`.
+
+        Raises:
+            ValueError: If the file is not of a mapped trie.
+        """
+        self._path = path
+        with open(path, 'rb') as fd:
+            # A private mapping is writable, as ctypes needs, but is never
+            # written so its pages stay shared.
+            self._buf = _mmap.mmap(fd.fileno(), 0, access=_mmap.ACCESS_COPY)
+        buf = self._buf
+        if buf[:len(self.MAGIC)] != self.MAGIC:
+            buf.close()
+            raise ValueError('%s is not a mapped trie' % path)
+        (_, nodes, steps, keys, flags, self._len,
+         slots) = self.HEADER.unpack_from(buf, 0)
+        offset = self.HEADER.size
+        self._keys = _pickle.loads(buf[offset:offset + keys])
+        offset += keys + (-keys % 8)
+        int64 = _ctypes.c_int64.__ctype_le__
+        int32 = _ctypes.c_int32.__ctype_le__
+        self._first, offset = self._array(int64, nodes + 1, offset)
+        self._ids, offset = self._array(int32, nodes, offset)
+        self._has_value, offset = self._array(_ctypes.c_uint8, nodes, offset)
+        self._values, offset = self._array(int64, nodes, offset)
+        self._totals, offset = self._array(int64, nodes, offset)
+        self._step_offsets, offset = self._array(int64, steps + 1, offset)
+        self._slots, offset = self._array(int32, slots, offset)
+        self._step_base = offset
+        self._text = flags & self.TEXT_STEPS
+        self._steps = _MappedSteps(self._ids, self._step_offsets, buf, offset,
+                                   self._text)
+
+    def _array(self, ctype, length, offset):
+        """Returns an array mapped at given offset and the offset past it."""
+        array = (ctype * length).from_buffer(self._buf, offset)
+        size = _ctypes.sizeof(array)
+        return array, offset + size + (-size % 8)
+
+    def _step_id(self, step):
+        """Returns index of a step in the step table, or -1 if it is not."""
+        if self._text:
+            step = step.encode('utf-8')
+        offsets, base, slots = self._step_offsets, self._step_base, self._slots
+        mask = len(slots) - 1
+        slot = _step_hash(step, mask)
+        while True:
+            step_id = slots[slot]
+            if step_id < 0 or self._buf[base + offsets[step_id]:
+                                        base + offsets[step_id + 1]] == step:
+                return step_id
+            slot = (slot + 1) & mask
+
+    def _find(self, key):
+        """Returns number of the node for given key, or -1 if there is none.
+
+        Children are ordered by index of their step, so a step is looked up in
+        the hash table and a child is found by bisecting the mapped indices.
+        """
+        first, ids = self._first, self._ids
+        node = 0
+        if key is _SENTINEL:
+            return node
+        for step in self._keys._path_from_key(key):  # pylint: disable=protected-access
+            step_id = self._step_id(step)
+            if step_id < 0:
+                return -1
+            end = first[node + 1]
+            node = _bisect.bisect_left(ids, step_id, first[node], end)
+            if node == end or ids[node] != step_id:
+                return -1
+        return node
+
+    @classmethod
+    def is_mapped(cls, path):
+        """Returns whether file at given path is of a mapped trie."""
+        with open(path, 'rb') as fd:
+            return fd.read(len(cls.MAGIC)) == cls.MAGIC
+
+    def close(self):
+        """Unmaps the file.  The trie cannot be used afterwards."""
+        # arrays mapping the file go first so it can be closed
+        self._first = self._ids = self._has_value = self._values = None
+        self._totals = self._step_offsets = self._slots = self._steps = None
+        self._buf.close()
+
+    def __reduce__(self):
+        return (self.__class__, (self._path,))
+
+    def __repr__(self):
+        return 'MappedTrie(%r)' % self._path
+
+
 class PrefixSet(_collections.MutableSet):  # pylint: disable=abstract-class-not-used
     """A set of prefixes.
 
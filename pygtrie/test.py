@@ -8,7 +8,10 @@ __copyright__ = 'Copyright 2014 Google Inc.'
 
 import array
 import collections
+import io
+import os
 import pickle
+import tempfile
 import unittest
 
 import pygtrie
@@ -78,6 +81,8 @@ class TrieTestCase(unittest.TestCase):
     # A list of prefixes of _LONG_KEY which are not prefixes of _SHORT_KEY nor
     # _SHORT_KEY itself
     _LONG_PREFIXES = ('foob', 'fooba')
+    # Keys of unicode steps, the first two sharing a prefix
+    _UNICODE_KEYS = (u'\u5929\u5730\u4eba', u'\u5929\u5730', u'\u5c71\u6c34')
 
     @classmethod
     def path_from_key(cls, key):
@@ -174,6 +179,23 @@ class TrieTestCase(unittest.TestCase):
         self.assertEqual('Trie()', str(t))
         self.assertEqual('Trie()', repr(t))
 
+    def lookups(self, keys):
+        """Returns keys, their prefixes and keys they are a prefix of."""
+        lookups = set()
+        for key in keys:
+            path = list(self.path_from_key(key))
+            lookups.update(self.key_from_path(path[:i])
+                           for i in range(len(path) + 1))
+            lookups.add(self.key_from_path(path + path[-1:]))
+        return lookups
+
+    def assertSums(self, t, copy, keys, msg=None):
+        """Asserts prefix sums of copy are the values of t summed."""
+        for key in self.lookups(keys):
+            want = sum(t.itervalues(prefix=key)) if t.has_node(key) else 0
+            self.assertEqual(want, copy.prefix_sum(key), (msg, key))
+        self.assertEqual(sum(t.itervalues()), copy.prefix_sum(), msg)
+
     # pylint: enable=invalid-name
 
     def _do_test_basics(self, trie_factory):
@@ -363,6 +385,330 @@ class TrieTestCase(unittest.TestCase):
         self.assertEqual([long_key], list(ps.iter(self._LONG_KEY)))
         self.assertEqual([other_key], list(ps.iter(self._OTHER_KEY)))
 
+    def test_increment(self):
+        """Tests incrementing values of keys."""
+        t = self._TRIE_CLS()
+        self.assertEqual(1, t.increment(self._LONG_KEY))
+        self.assertEqual(3, t.increment(self._LONG_KEY, 2))
+        self.assertNodeState(t, self._SHORT_KEY, prefix=True)
+        self.assertEqual(5, t.increment(self._SHORT_KEY, 5))
+        self.assertNodeState(t, self._SHORT_KEY, prefix=True, value=5)
+        self.assertNodeState(t, self._LONG_KEY, value=3)
+        self.assertEqual(0, t.increment(self._SHORT_KEY, -5))
+        self.assertNodeState(t, self._SHORT_KEY, prefix=True, value=0)
+
+    def test_increment_batch(self):
+        """Tests incrementing values of many keys at once."""
+        t = self._TRIE_CLS()
+        t.increment_keys([self._SHORT_KEY, self._LONG_KEY, self._SHORT_KEY])
+        t.increment_keys([self._LONG_KEY], 2)
+        t.increment_items([(self._SHORT_KEY, 40), (self._LONG_KEY, 39)])
+        self.assertFullTrie(t)
+
+    def test_increment_matches_set(self):
+        """Tests counting keys gives the trie of setting their counts."""
+        keys = (self._SHORT_KEY, self._LONG_KEY, self._VERY_LONG_KEY,
+                self._OTHER_KEY) + self._UNICODE_KEYS
+        items = [(keys[i * 5 % len(keys)], i % 4 - 1) for i in range(50)]
+        counts = {}
+        t = self._TRIE_CLS()
+        for key, delta in items:
+            counts[key] = counts.get(key, 0) + delta
+            self.assertEqual(counts[key], t.increment(key, delta))
+        u = self._TRIE_CLS()
+        u.increment_items(items)
+        v = self._TRIE_CLS()
+        for key, count in counts.items():
+            v[key] = count
+        self.assertEqual(v, t)
+        self.assertEqual(v, u)
+        if hasattr(v, 'prefix_sum'):
+            self.assertSums(v, t, keys)
+            self.assertSums(v, u, keys)
+
+    def test_bulk_load(self):
+        """Tests loading sorted and unsorted items."""
+        items = [(self._LONG_KEY, 42), (self._OTHER_KEY, 24),
+                 (self._SHORT_KEY, 42), (self._OTHER_KEY, 42)]
+        t = self._TRIE_CLS()
+        t.bulk_load(items)
+        u = self._TRIE_CLS()
+        u.bulk_load(items, presorted=True)
+        for trie in (t, u):
+            self.assertEqual(3, len(trie))
+            self.assertNodeState(trie, self._SHORT_KEY, prefix=True, value=42)
+            self.assertNodeState(trie, self._LONG_KEY, value=42)
+            self.assertNodeState(trie, self._OTHER_KEY, value=42)
+            self.assertNodeState(trie, self._VERY_LONG_KEY)
+        self.assertEqual(t, u)
+        self.assertEqual(self._TRIE_CLS(items), t)
+
+        t.bulk_load([(self._VERY_LONG_KEY, 1), (self._LONG_KEY, 2)])
+        self.assertNodeState(t, self._LONG_KEY, prefix=True, value=2)
+        self.assertNodeState(t, self._VERY_LONG_KEY, value=1)
+
+    def test_bulk_load_unsorted(self):
+        """Tests items given as presorted load right in any order."""
+        items = [(self._OTHER_KEY, 1), (self._VERY_LONG_KEY, 2),
+                 (self._SHORT_KEY, 4), (self._OTHER_KEY, 8),
+                 (self._LONG_KEY, 16), (self._SHORT_KEY, 32)]
+        t = self._TRIE_CLS()
+        t.bulk_load(items, presorted=True)
+        want = self._TRIE_CLS()
+        for key, value in items:
+            want[key] = value
+        self.assertEqual(want, t)
+        self.assertNodeState(t, self._SHORT_KEY, prefix=True, value=32)
+        self.assertNodeState(t, self._LONG_KEY, prefix=True, value=16)
+        self.assertNodeState(t, self._VERY_LONG_KEY, value=2)
+        self.assertNodeState(t, self._OTHER_KEY, value=8)
+
+    def round_trips(self, t):
+        """Yields (name, copy) of a trie through every frozen format."""
+        f = t.freeze()
+        yield 'freeze', f
+        yield 'pickled', pickle.loads(pickle.dumps(f, protocol=2))
+        fd = io.BytesIO()
+        pygtrie.dump(t, fd)
+        fd.seek(0)
+        loaded = pygtrie.load(fd)
+        self.assertIs(type(t), type(loaded))
+        self.assertEqual(t, loaded)
+        yield 'dumped', loaded.freeze()
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as fd:
+                f.dump_mapped(fd)
+            mapped = pygtrie.MappedTrie(path)
+            yield 'mapped', mapped
+            mapped.close()
+        finally:
+            os.remove(path)
+
+    def test_round_trips(self):
+        """Tests frozen, dumped and mapped tries read like the trie."""
+        for keys in ((self._SHORT_KEY, self._LONG_KEY, self._VERY_LONG_KEY,
+                      self._OTHER_KEY), self._UNICODE_KEYS, ()):
+            t = self._TRIE_CLS()
+            for i, key in enumerate(keys):
+                t[key] = 1 << i
+            for name, copy in self.round_trips(t):
+                self.assertEqual(len(t), len(copy), name)
+                self.assertEqual(bool(t), bool(copy), name)
+                self.assertEqual(sorted(t.iteritems()),
+                                 sorted(copy.iteritems()), name)
+                for key in self.lookups(keys):
+                    self.assertEqual(t.has_node(key), copy.has_node(key),
+                                     (name, key))
+                    self.assertEqual(t.get(key), copy.get(key), (name, key))
+                self.assertSums(t, copy, keys, name)
+
+    def test_freeze(self):
+        """Tests a frozen trie looks the same as the trie."""
+        t = self._TRIE_CLS()
+        t[self._SHORT_KEY] = 1
+        t[self._LONG_KEY] = 2
+        t[self._VERY_LONG_KEY] = 4
+        t[self._OTHER_KEY] = 8
+        f = t.freeze()
+        u = pickle.loads(pickle.dumps(f, protocol=2))
+        for frozen in (f, u):
+            self.assertEqual(4, len(frozen))
+            self.assertEqual(dict(t.iteritems()), dict(frozen.iteritems()))
+            self.assertEqual(sorted(t.itervalues(prefix=self._SHORT_KEY)),
+                             sorted(frozen.itervalues(prefix=self._SHORT_KEY)))
+            self.assertEqual(sorted(t.items(shallow=True)),
+                             sorted(frozen.items(shallow=True)))
+            for key in self._LONG_PREFIXES + (self._VERY_LONG_KEY,
+                                              self._OTHER_KEY):
+                self.assertEqual(t.has_node(key), frozen.has_node(key))
+                self.assertEqual(t.get(key), frozen.get(key))
+                self.assertEqual(sum(t.itervalues(prefix=key)),
+                                 frozen.prefix_sum(key))
+            self.assertRaises(pygtrie.ShortKeyError,
+                              lambda: frozen[self._LONG_PREFIXES[-1]])
+            self.assertRaises(KeyError, lambda: frozen[self._OTHER_KEY * 2])
+            self.assertEqual(0, frozen.has_node(self._OTHER_KEY * 2))
+            self.assertEqual(0, frozen.prefix_sum(self._OTHER_KEY * 2))
+            self.assertEqual(15, frozen.prefix_sum())
+        self.assertFalse(self._TRIE_CLS().freeze())
+
+    def test_mapped(self):
+        """Tests a mapped trie reads the same as the frozen trie."""
+        t = self._TRIE_CLS()
+        t[self._SHORT_KEY] = 1
+        t[self._LONG_KEY] = 2
+        t[self._VERY_LONG_KEY] = 4
+        t[self._OTHER_KEY] = 8
+        f = t.freeze()
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as fd:
+                f.dump_mapped(fd)
+            self.assertTrue(pygtrie.MappedTrie.is_mapped(path))
+            m = pygtrie.MappedTrie(path)
+            for mapped in (m, pickle.loads(pickle.dumps(m))):
+                self.assertEqual(4, len(mapped))
+                self.assertEqual(f.items(), mapped.items())
+                self.assertEqual(f.items(prefix=self._SHORT_KEY, shallow=True),
+                                 mapped.items(prefix=self._SHORT_KEY,
+                                              shallow=True))
+                for key in self._LONG_PREFIXES + (self._VERY_LONG_KEY,
+                                                  self._OTHER_KEY * 2):
+                    self.assertEqual(f.has_node(key), mapped.has_node(key))
+                    self.assertEqual(f.get(key), mapped.get(key))
+                    self.assertEqual(f.prefix_sum(key), mapped.prefix_sum(key))
+                self.assertRaises(pygtrie.ShortKeyError,
+                                  lambda: mapped[self._LONG_PREFIXES[-1]])
+                self.assertEqual(15, mapped.prefix_sum())
+                mapped.close()
+        finally:
+            os.remove(path)
+
+        t[self._OTHER_KEY] = 8.5
+        self.assertRaises(TypeError, t.freeze().dump_mapped, None)
+
+    def test_join(self):
+        """Tests joining frozen tries gives the trie of all their keys."""
+        t = self._TRIE_CLS()
+        for i, key in enumerate((self._SHORT_KEY, self._LONG_KEY,
+                                 self._VERY_LONG_KEY, self._OTHER_KEY,
+                                 self._OTHER_KEY * 2, 'x' + self._OTHER_KEY)):
+            t[key] = 1 << i
+        parts = {}
+        for key, value in t.iteritems():
+            first = list(self.path_from_key(key))[0]
+            parts.setdefault(first, self._TRIE_CLS())[key] = value
+        parts = [part.freeze() for part in parts.values()]
+        parts.append(self._TRIE_CLS().freeze())
+        f = t.freeze()
+        joined = pygtrie.FrozenTrie.join(parts)
+        self.assertEqual(len(f), len(joined))
+        self.assertEqual(f.items(), joined.items())
+        for key in (self._SHORT_PREFIXES + self._LONG_PREFIXES +
+                    (self._VERY_LONG_KEY, self._OTHER_KEY * 3)):
+            self.assertEqual(f.has_node(key), joined.has_node(key))
+            self.assertEqual(f.get(key), joined.get(key))
+            self.assertEqual(f.prefix_sum(key), joined.prefix_sum(key))
+        self.assertEqual(63, joined.prefix_sum())
+
+        self.assertRaises(ValueError, pygtrie.FrozenTrie.join, [])
+        self.assertRaises(ValueError, pygtrie.FrozenTrie.join, [f, f])
+
+        if list(self.path_from_key('')):
+            return
+        # The empty key is the root, which one trie only may have a value of.
+        empty = self._TRIE_CLS()
+        empty[''] = 64
+        joined = pygtrie.FrozenTrie.join([empty.freeze()] + parts)
+        self.assertEqual(64, joined[''])
+        self.assertEqual(127, joined.prefix_sum())
+        self.assertRaises(ValueError, pygtrie.FrozenTrie.join,
+                          [empty.freeze(), empty.freeze()])
+
+    def test_dump(self):
+        """Tests a dumped trie loads the same."""
+        t = self._TRIE_CLS()
+        t[self._SHORT_KEY] = 1
+        t[self._LONG_KEY] = -2
+        t[self._VERY_LONG_KEY] = 1 << 70
+        t[self._OTHER_KEY] = 8.5
+        fd = io.BytesIO()
+        pygtrie.dump(t, fd, chunk=4)
+        fd.seek(0)
+        u = pygtrie.load(fd)
+        self.assertIs(self._TRIE_CLS, type(u))
+        self.assertEqual(t, u)
+        self.assertNodeState(u, self._SHORT_KEY, prefix=True, value=1)
+        self.assertNodeState(u, self._LONG_KEY, prefix=True, value=-2)
+        self.assertNodeState(u, self._VERY_LONG_KEY, value=1 << 70)
+        self.assertNodeState(u, self._OTHER_KEY, value=8.5)
+
+        self.assertRaises(ValueError, pygtrie.load, io.BytesIO(b'trie'))
+        self.assertRaises(EOFError, pygtrie.load,
+                          io.BytesIO(fd.getvalue()[:-1]))
+
+    def test_merge(self):
+        """Tests merging tries with and without a combine function."""
+        t = self._TRIE_CLS()
+        t[self._SHORT_KEY] = 1
+        t[self._OTHER_KEY] = 2
+        u = self._TRIE_CLS()
+        u[self._SHORT_KEY] = 4
+        u[self._LONG_KEY] = 8
+        u[self._VERY_LONG_KEY] = 16
+        subtrie = u._root
+        for step in self.path_from_key(self._LONG_KEY):
+            subtrie = subtrie.children[step]
+
+        t.merge(u, lambda a, b: a + b)
+        self.assertEqual(4, len(t))
+        self.assertNodeState(t, self._SHORT_KEY, prefix=True, value=5)
+        self.assertNodeState(t, self._LONG_KEY, prefix=True, value=8)
+        self.assertNodeState(t, self._VERY_LONG_KEY, value=16)
+        self.assertNodeState(t, self._OTHER_KEY, value=2)
+        self.assertEqual(0, len(u))
+        # Subtries only in the other trie are moved, not copied.
+        moved = t._root
+        for step in self.path_from_key(self._LONG_KEY):
+            moved = moved.children[step]
+        self.assertIs(subtrie, moved)
+
+        v = self._TRIE_CLS()
+        v[self._SHORT_KEY] = 32
+        t.merge(v)
+        self.assertNodeState(t, self._SHORT_KEY, prefix=True, value=32)
+
+        other = (pygtrie.Trie if self._TRIE_CLS._NODE_CLS is pygtrie._CountNode
+                 else pygtrie.CountingTrie)
+        self.assertRaises(TypeError, t.merge, other())
+
+    def test_merge_disjoint(self):
+        """Tests merging tries sharing no node but the root."""
+        t = self._TRIE_CLS()
+        t[self._SHORT_KEY] = 1
+        t[self._LONG_KEY] = 2
+        u = self._TRIE_CLS()
+        u['x' + self._OTHER_KEY] = 4
+        subtrie = u._root.children[self.path_from_key('x' + self._OTHER_KEY)[0]]
+        t.merge(u)
+        self.assertEqual(3, len(t))
+        self.assertNodeState(t, self._SHORT_KEY, prefix=True, value=1)
+        self.assertNodeState(t, self._LONG_KEY, value=2)
+        self.assertNodeState(t, 'x' + self._OTHER_KEY, value=4)
+        self.assertIs(subtrie, t._root.children[
+            self.path_from_key('x' + self._OTHER_KEY)[0]])
+        self.assertEqual(0, len(u))
+
+        # Merging into or from an empty trie.
+        v = self._TRIE_CLS()
+        v.merge(t)
+        self.assertEqual(3, len(v))
+        self.assertEqual(0, len(t))
+        v.merge(self._TRIE_CLS())
+        self.assertEqual(3, len(v))
+
+    def test_merge_combine(self):
+        """Tests combine is only called for keys in both tries."""
+        t = self._TRIE_CLS()
+        t[self._SHORT_KEY] = 1
+        t[self._LONG_KEY] = 8
+        u = self._TRIE_CLS()
+        u[self._SHORT_KEY] = 4
+        u[self._LONG_KEY] = 2
+        u[self._OTHER_KEY] = 16
+        calls = []
+
+        def combine(a, b):
+            calls.append((a, b))
+            return max(a, b)
+
+        t.merge(u, combine)
+        self.assertEqual([(1, 4), (8, 2)], sorted(calls))
+        self.assertNodeState(t, self._SHORT_KEY, prefix=True, value=4)
+        self.assertNodeState(t, self._LONG_KEY, value=8)
+        self.assertNodeState(t, self._OTHER_KEY, value=16)
+
     def test_equality(self):
         """Tests equality comparison."""
         d = dict.fromkeys((self._SHORT_KEY, self._LONG_KEY), 42)
@@ -429,6 +775,139 @@ class StringTrieTestCase(TrieTestCase):
         return '/'.join(path)
 
 
+class CountingTrieTestCase(TrieTestCase):
+    _TRIE_CLS = pygtrie.CountingTrie
+
+    def assertNodeState(self, t, key, prefix=False, value=None):
+        """Also asserts the sum kept for the node matches its subtrie."""
+        super(CountingTrieTestCase, self).assertNodeState(
+                t, key, prefix=prefix, value=value)
+        expected = sum(t.itervalues(prefix=key)) if t.has_node(key) else 0
+        self.assertEqual(expected, t.prefix_sum(key))
+        self.assertEqual(sum(t.itervalues()), t.prefix_sum())
+
+    def test_prefix_sum(self):
+        t = self._TRIE_CLS()
+        t[self._SHORT_KEY] = 1
+        t[self._LONG_KEY] = 2
+        t.increment(self._VERY_LONG_KEY, 4)
+        t[self._OTHER_KEY] = 8
+        self.assertEqual(15, t.prefix_sum())
+        self.assertEqual(7, t.prefix_sum(self._SHORT_KEY))
+        self.assertEqual(6, t.prefix_sum(self._LONG_PREFIXES[-1]))
+        self.assertEqual(4, t.prefix_sum(self._VERY_LONG_KEY))
+        self.assertEqual(0, t.prefix_sum(self._VERY_LONG_KEY + self._OTHER_KEY))
+
+        t[self._LONG_KEY] = 16
+        self.assertEqual(21, t.prefix_sum(self._SHORT_KEY))
+        t[self._LONG_KEY:] = 32
+        self.assertEqual(33, t.prefix_sum(self._SHORT_KEY))
+        del t[self._SHORT_KEY]
+        self.assertEqual(32, t.prefix_sum(self._SHORT_KEY))
+        del t[self._SHORT_KEY:]
+        self.assertEqual(0, t.prefix_sum(self._SHORT_KEY))
+        self.assertEqual(8, t.prefix_sum())
+
+    def test_increment_node_class(self):
+        class Node(pygtrie._CountNode):  # pylint: disable=protected-access
+            __slots__ = ()
+
+        class Trie(self._TRIE_CLS):
+            _NODE_CLS = Node
+
+        t = Trie()
+        t.increment(self._LONG_KEY, 2)
+        t[self._OTHER_KEY] = 4
+        nodes = [t._root]  # pylint: disable=protected-access
+        while nodes:
+            node = nodes.pop()
+            self.assertIs(Node, type(node))
+            nodes.extend(node.children.values())
+        u = Trie()
+        u.increment(self._VERY_LONG_KEY)
+        t.merge(u)
+        self.assertEqual(7, t.prefix_sum())
+
+    def test_merge_sums(self):
+        t = self._TRIE_CLS()
+        t[self._SHORT_KEY] = 1
+        t[self._VERY_LONG_KEY] = 2
+        u = self._TRIE_CLS()
+        u[self._SHORT_KEY] = 4
+        u[self._LONG_KEY] = 8
+        u[self._OTHER_KEY] = 16
+        t.merge(u, lambda a, b: a + b)
+        self.assertEqual(31, t.prefix_sum())
+        self.assertEqual(15, t.prefix_sum(self._SHORT_KEY))
+        self.assertEqual(10, t.prefix_sum(self._LONG_KEY))
+        self.assertEqual(2, t.prefix_sum(self._VERY_LONG_KEY))
+        self.assertEqual(16, t.prefix_sum(self._OTHER_KEY))
+        # Sums are kept up to date after the merge.
+        t.increment(self._VERY_LONG_KEY, 32)
+        self.assertEqual(42, t.prefix_sum(self._LONG_KEY))
+        self.assertEqual(63, t.prefix_sum())
+        self.assertEqual(0, u.prefix_sum())
+
+    def test_prefix_sum_changes(self):
+        """Tests sums after every kind of change, deletes included."""
+        t = self._TRIE_CLS()
+        keys = (self._SHORT_KEY, self._LONG_KEY, self._VERY_LONG_KEY,
+                self._OTHER_KEY)
+        changes = [
+            lambda: t.__setitem__(self._LONG_KEY, 3),
+            lambda: t.increment(self._VERY_LONG_KEY, 5),
+            lambda: t.setdefault(self._SHORT_KEY, 7),
+            lambda: t.setdefault(self._SHORT_KEY, 100),
+            lambda: t.pop(self._LONG_KEY),
+            lambda: t.pop(self._LONG_KEY, None),
+            lambda: t.__delitem__(self._VERY_LONG_KEY),
+            lambda: self.assertRaises(KeyError, t.__delitem__,
+                                      self._VERY_LONG_KEY),
+            lambda: t.__setitem__(self._LONG_KEY, 6),
+            lambda: t.__setitem__(slice(self._SHORT_KEY, None), 2),
+            lambda: t.update({self._OTHER_KEY: 4, self._LONG_KEY: 1}),
+            lambda: t.popitem(),
+            lambda: t.__setitem__(self._VERY_LONG_KEY, 9),
+            lambda: t.__delitem__(slice(self._SHORT_KEY, None)),
+            lambda: t.clear(),
+        ]
+        for i, change in enumerate(changes):
+            change()
+            self.assertSums(t, t, keys, i)
+
+    def test_prefix_sum_unpickled(self):
+        t = self._TRIE_CLS()
+        t.bulk_load([(self._SHORT_KEY, 1), (self._LONG_KEY, 2),
+                     (self._OTHER_KEY, 4)])
+        self.assertEqual(3, t.prefix_sum(self._SHORT_KEY))
+        u = pickle.loads(pickle.dumps(t, protocol=2))
+        self.assertEqual(t, u)
+        self.assertEqual(3, u.prefix_sum(self._SHORT_KEY))
+        self.assertEqual(7, u.prefix_sum())
+
+
+class CharCountingTrieTestCase(CountingTrieTestCase):
+    _TRIE_CLS = pygtrie.CharCountingTrie
+
+    @classmethod
+    def key_from_path(cls, path):
+        return ''.join(path)
+
+
+class StringCountingTrieTestCase(CountingTrieTestCase):
+    _TRIE_CLS = pygtrie.StringCountingTrie
+
+    _SHORT_KEY = StringTrieTestCase._SHORT_KEY
+    _LONG_KEY = StringTrieTestCase._LONG_KEY
+    _VERY_LONG_KEY = StringTrieTestCase._VERY_LONG_KEY
+    _OTHER_KEY = StringTrieTestCase._OTHER_KEY
+    _SHORT_PREFIXES = StringTrieTestCase._SHORT_PREFIXES
+    _LONG_PREFIXES = StringTrieTestCase._LONG_PREFIXES
+
+    path_from_key = StringTrieTestCase.path_from_key
+    key_from_path = StringTrieTestCase.key_from_path
+
+
 class SortTest(unittest.TestCase):
 
     def test_enable_sorting(self):
@@ -581,6 +1060,12 @@ class RecursionTest(unittest.TestCase):
     def test_copy(self):
         self.create_trie().copy()
 
+    def test_dump(self):
+        fd = io.BytesIO()
+        pygtrie.dump(self.create_trie(), fd)
+        fd.seek(0)
+        pygtrie.load(fd)
+
 
 if __name__ == '__main__':
     unittest.main()
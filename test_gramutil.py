@@ -0,0 +1,971 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for gramutil and the scripts built on it."""
+
+import os
+import sys
+import math
+import random
+import shutil
+import StringIO
+import tempfile
+import unittest
+import contextlib
+import collections
+import multiprocessing.dummy
+
+import pygtrie
+import gramutil
+import data_process
+import data_preparation
+# scripts of folder-support, which import gramutil from this directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'folder-support'))
+import prepare as folder_prepare
+import process as folder_process
+
+
+WORDS = ['love', 'to', 'embrace', 'challenge', 'trie', 'gram', 'Hello', 'WORLD',
+         'x', '42', 'abc1', 'aaa', 'zz']
+CHARS = [u'天', u'地', u'人', u'和', u'山', u'水', u'ア',
+         u'가']
+
+
+def randomText(rng, lines, chars=False):
+    """Lines of random words, rejected tokens and punctuation included, or
+    of CJK runs broken by ASCII when chars
+    """
+    text = []
+    for _ in xrange(lines):
+        if chars:
+            line = u''.join(rng.choice(CHARS + [u' ', u'ab', u'，'])
+                            for _ in xrange(rng.randint(0, 12)))
+            text.append(line.encode('utf-8'))
+        else:
+            text.append(rng.choice([' ', ', ', '-']).join(
+                rng.choice(WORDS) for _ in xrange(rng.randint(0, 8))))
+    return '\n'.join(text) + rng.choice(['', '\n'])
+
+
+def countLines(path):
+    """Counts of the grams of a gram file, records of combined files added up"""
+    counts = collections.Counter()
+    with gramutil.openFile(path) as fd:
+        for line in fd:
+            gram, count = gramutil.splitCount(line)
+            counts[gram] += count
+    return counts
+
+
+@contextlib.contextmanager
+def captured(stream='stdout'):
+    """Capture what is written to sys.stdout, or sys.stderr"""
+    saved = getattr(sys, stream)
+    setattr(sys, stream, StringIO.StringIO())
+    try:
+        yield getattr(sys, stream)
+    finally:
+        setattr(sys, stream, saved)
+
+
+class GramTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def writeInput(self, text, name='input.txt'):
+        path = self.path(name)
+        with open(path, 'wb') as fd:
+            fd.write(text)
+        return path
+
+    def readLines(self, path):
+        with open(path) as fd:
+            return fd.readlines()
+
+    def prepareSequential(self, input_file, gram_numbers, **kwargs):
+        """Grams of a sequential pass, by PrepareMulti"""
+        outputs = [(n, self.path('seq%d' % n)) for n in gram_numbers]
+        data_preparation.PrepareMulti(input_file, outputs, **kwargs)
+        return outputs
+
+    def runJob(self, job, dedup=None, sample=None):
+        pool = multiprocessing.dummy.Pool(2, initializer=gramutil.shareObjects,
+                                          initargs=(dedup, sample))
+        try:
+            job.submit(pool)
+            return job.finish()
+        finally:
+            pool.close()
+            pool.join()
+
+
+class RangeJobTest(GramTestCase):
+
+    GRAM_NUMBERS = range(1, 6)
+
+    def checkRanges(self, text, chunk_sizes, chars=False, combine=False):
+        input_file = self.writeInput(text)
+        expected = self.prepareSequential(input_file, self.GRAM_NUMBERS, chars=chars,
+                                          combine=combine)
+        for chunk_size in chunk_sizes:
+            outputs = [(n, self.path('range%d-%d' % (n, chunk_size)))
+                       for n in self.GRAM_NUMBERS]
+            job = gramutil.RangeJob(input_file, outputs, chunk_size, chars=chars,
+                                    combine=combine)
+            self.runJob(job)
+            for (n, want), (_, got) in zip(expected, outputs):
+                msg = 'n=%d, chunk_size=%d' % (n, chunk_size)
+                if combine:
+                    # records are combined within each range
+                    self.assertEqual(countLines(want), countLines(got), msg)
+                else:
+                    self.assertEqual(self.readLines(want), self.readLines(got), msg)
+
+    def testSplitRanges(self):
+        text = 'one line\n\ntwo\nthree lines\nfour'
+        input_file = self.writeInput(text)
+        for chunk_size in (1, 3, 9, 100):
+            ranges = gramutil.splitRanges(input_file, chunk_size)
+            self.assertEqual(0, ranges[0][0])
+            self.assertEqual(len(text), ranges[-1][1])
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, start)
+                self.assertEqual('\n', text[end - 1])
+
+    def testWords(self):
+        text = randomText(random.Random(3), 300)
+        self.checkRanges(text, [1, 5, 17, 64, 1000, 1 << 20])
+
+    def testFewWords(self):
+        # ranges holding fewer words than the largest gram
+        self.checkRanges('love\n\nto\nembrace x\n\n\nchallenge trie\ngram', [1, 4, 9])
+
+    def testEmpty(self):
+        self.checkRanges('', [1, 10])
+        self.checkRanges('\n\n42 x\n', [1, 10])
+
+    def testChars(self):
+        text = randomText(random.Random(5), 200, chars=True)
+        self.checkRanges(text, [1, 7, 40, 1 << 20], chars=True)
+
+    def testCombine(self):
+        text = randomText(random.Random(7), 300)
+        self.checkRanges(text, [1, 23, 200, 1 << 20], combine=True)
+
+
+class PipelineJobTest(GramTestCase):
+
+    GRAM_NUMBERS = range(1, 6)
+
+    def checkBlocks(self, text, block_sizes, chars=False, combine=False, name='input.txt'):
+        input_file = self.writeInput(text, 'plain.txt')
+        if gramutil.isCompressed(name):
+            with gramutil.openFile(self.path(name), 'w') as fd:
+                fd.write(text)
+        else:
+            self.writeInput(text, name)
+        expected = self.prepareSequential(input_file, self.GRAM_NUMBERS, chars=chars,
+                                          combine=combine)
+        for block_size in block_sizes:
+            outputs = [(n, self.path('pipeline%d-%d' % (n, block_size)))
+                       for n in self.GRAM_NUMBERS]
+            job = gramutil.PipelineJob(self.path(name), outputs, block_size, chars=chars,
+                                       combine=combine)
+            self.runJob(job)
+            for (n, want), (_, got) in zip(expected, outputs):
+                msg = 'n=%d, block_size=%d' % (n, block_size)
+                if combine:
+                    self.assertEqual(countLines(want), countLines(got), msg)
+                else:
+                    self.assertEqual(self.readLines(want), self.readLines(got), msg)
+
+    def testWords(self):
+        text = randomText(random.Random(13), 300)
+        self.checkBlocks(text, [1, 6, 33, 1000, 1 << 20])
+
+    def testCompressed(self):
+        text = randomText(random.Random(17), 300)
+        self.checkBlocks(text, [1, 50, 1 << 20], name='input.txt.gz')
+
+    def testFewWords(self):
+        self.checkBlocks('love\n\nto\nembrace x\n\n\nchallenge trie\ngram', [1, 4, 9])
+        self.checkBlocks('', [1, 10])
+
+    def testChars(self):
+        text = randomText(random.Random(19), 200, chars=True)
+        self.checkBlocks(text, [1, 9, 1 << 20], chars=True)
+
+    def testCombine(self):
+        text = randomText(random.Random(23), 300)
+        self.checkBlocks(text, [1, 40, 1 << 20], combine=True)
+
+    def testWriteError(self):
+        input_file = self.writeInput('love to embrace challenge\n' * 1000)
+        outputs = [(2, self.path('missing/grams.txt'))]
+        job = gramutil.PipelineJob(input_file, outputs, 26)
+        pool = CountingPool()
+        try:
+            job.submit(pool)
+            self.assertRaises(IOError, job.finish)
+        finally:
+            pool.close()
+            pool.join()
+        # the reader stops queueing blocks once the writer failed
+        self.assertTrue(pool.submitted <= gramutil.PipelineJob.QUEUE_SIZE + 2, pool.submitted)
+
+
+class CountingPool(object):
+    """Thread pool counting the tasks submitted to it"""
+
+    def __init__(self):
+        self._pool = multiprocessing.dummy.Pool(2)
+        self.submitted = 0
+
+    def apply_async(self, func, args):
+        self.submitted += 1
+        return self._pool.apply_async(func, args)
+
+    def close(self):
+        self._pool.close()
+
+    def join(self):
+        self._pool.join()
+
+
+class TokenCacheTest(GramTestCase):
+
+    def prepare(self, input_file, dedup=None):
+        fd = Sink()
+        gramutil.prepareFile(input_file, [2], [fd], self.path('cache'), dedup=dedup)
+        return fd.lines
+
+    def testDedup(self):
+        input_file = self.writeInput('love to embrace challenge\n' * 3)
+        plain = self.prepare(input_file)
+        self.assertEqual({'dedup': False}, gramutil.TokenCache(self.path('cache')).options())
+        self.assertEqual(plain, self.prepare(input_file))
+        # a cache built without dedup is rebuilt with it, and the other way
+        deduped = self.prepare(input_file, gramutil.DedupSet(min_length=0))
+        self.assertEqual(plain[:3] + ['challenge\n'], deduped)
+        cache = gramutil.TokenCache(self.path('cache'))
+        self.assertTrue(cache.exists(input_file, dedup=True))
+        self.assertFalse(cache.exists(input_file))
+        self.assertEqual(plain, self.prepare(input_file))
+
+    def testUnrecorded(self):
+        input_file = self.writeInput('love to embrace\n')
+        self.prepare(input_file)
+        cache = gramutil.TokenCache(self.path('cache'))
+        os.remove(cache.options_file)
+        self.assertFalse(cache.exists(input_file))
+        self.assertFalse(cache.exists(input_file, dedup=True))
+
+
+def uniqueLines(lines):
+    """DedupSet.unique of the set shared with a pool worker"""
+    return gramutil.sharedDedup().unique(lines)
+
+
+class DedupSetTest(GramTestCase):
+
+    def testNormalized(self):
+        dedup = gramutil.DedupSet(min_length=0)
+        lines = ['Hello  World\n', 'hello world', ' HELLO\tworld \n', 'hello worlds\n']
+        self.assertEqual(['Hello  World\n', 'hello worlds\n'], dedup.unique(lines))
+        self.assertEqual({'stored_lines': 2, 'removed_lines': 2,
+                          'removed_bytes': len(lines[1]) + len(lines[2])}, dedup.report())
+        self.assertEqual([], dedup.unique(lines))
+        self.assertEqual(6, dedup.removed_lines)
+
+    def testFingerprint(self):
+        # the first 8 bytes of md5, the same in every process and run
+        self.assertEqual(0x588032684d180b1,
+                         gramutil.DedupSet.fingerprint('love to embrace a challenge'))
+        self.assertEqual(0x21571c17fea4070c,
+                         gramutil.DedupSet.fingerprint('love to embrace a challenge!'))
+        dedup = gramutil.DedupSet(min_length=0)
+        lines = ['Love to  embrace a challenge\n', 'love to embrace a challenge!\n',
+                 'love to embrace a CHALLENGE\n']
+        self.assertEqual(lines[:2], dedup.unique(lines))
+
+    def testMinLength(self):
+        dedup = gramutil.DedupSet(min_length=12)
+        # 11 characters once normalized, always kept
+        short = 'hello  world\n'
+        longer = 'hello worlds\n'
+        self.assertEqual([short, short, longer], dedup.unique([short, short, longer, longer]))
+        self.assertEqual([short], dedup.unique([short, longer]))
+        self.assertEqual(1, dedup.stored)
+
+    def testCapacity(self):
+        dedup = gramutil.DedupSet(capacity=2, min_length=0)
+        self.assertEqual(['a\n', 'b\n', 'c\n', 'c\n'], dedup.unique(['a\n', 'b\n', 'c\n', 'c\n']))
+        self.assertEqual(['c\n'], dedup.unique(['a\n', 'b\n', 'c\n']))
+        self.assertEqual(2, dedup.stored)
+
+    def testFilterBlocks(self):
+        dedup = gramutil.DedupSet(min_length=0)
+        blocks = ['one\ntwo\n', 'two\nthree\none\n', 'four']
+        self.assertEqual(['one\ntwo\n', 'three\n', 'four'], list(dedup.filterBlocks(blocks)))
+
+    def testWorkers(self):
+        dedup = gramutil.DedupSet(min_length=0)
+        lines = ['line %d\n' % (i % 50) for i in xrange(400)]
+        batches = [lines[i:i+40] for i in xrange(0, len(lines), 40)]
+        pool = multiprocessing.Pool(3, initializer=gramutil.shareObjects, initargs=(dedup,))
+        try:
+            kept = pool.map(uniqueLines, batches, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        kept = [line for batch in kept for line in batch]
+        self.assertEqual(sorted(set(lines)), sorted(kept))
+        self.assertEqual(50, dedup.stored)
+        self.assertEqual(350, dedup.removed_lines)
+
+    def testRangeJob(self):
+        text = randomText(random.Random(11), 100) + '\n'
+        input_file = self.writeInput(text * 3)
+        lines = text.splitlines(True)
+        # which copy of a line is kept depends on the worker order, the
+        # words kept do not
+        want = Sink()
+        gramutil.prepareFile(input_file, [1], [want], dedup=gramutil.DedupSet(min_length=0))
+        dedup = gramutil.DedupSet(min_length=0)
+        outputs = [(1, self.path('range1'))]
+        self.runJob(gramutil.RangeJob(input_file, outputs, 64, dedup=True), dedup)
+        self.assertEqual(collections.Counter(want.lines),
+                         collections.Counter(self.readLines(self.path('range1'))))
+        self.assertEqual(len(set(lines)), dedup.stored)
+        self.assertEqual(len(lines) * 3 - len(set(lines)), dedup.removed_lines)
+
+
+def lineWord(index):
+    """Word of letters only, told apart by index and never rejected"""
+    return 'q' + ''.join('abcdefghij'[int(digit)] if i % 2 else 'klmnopqrst'[int(digit)]
+                         for i, digit in enumerate(str(index)))
+
+
+class LineSampleTest(GramTestCase):
+
+    def sampleWords(self, input_file, sample):
+        fd = Sink()
+        gramutil.prepareFile(input_file, [1], [fd], sample=sample)
+        return [line.strip() for line in fd.lines]
+
+    def testRate(self):
+        words = [lineWord(i) for i in xrange(2000)]
+        input_file = self.writeInput('\n'.join(words) + '\n')
+        sample = gramutil.LineSample(rate=0.25, seed=4)
+        kept = self.sampleWords(input_file, sample)
+        self.assertEqual(2000, sample.seen)
+        self.assertEqual(len(kept), sample.kept)
+        self.assertAlmostEqual(0.25, sample.rate, delta=0.05)
+        self.assertEqual(float(len(kept)) / 2000, sample.rate)
+        # input order is kept
+        self.assertEqual(sorted(kept, key=words.index), kept)
+        # the same seed gives the same sample, another seed another one
+        self.assertEqual(kept, self.sampleWords(input_file, gramutil.LineSample(rate=0.25,
+                                                                                seed=4)))
+        self.assertNotEqual(kept, self.sampleWords(input_file, gramutil.LineSample(rate=0.25,
+                                                                                   seed=5)))
+
+    def testSize(self):
+        words = [lineWord(i) for i in xrange(500)]
+        input_file = self.writeInput('\n'.join(words) + '\n')
+        sample = gramutil.LineSample(size=40, seed=1)
+        kept = self.sampleWords(input_file, sample)
+        self.assertEqual(40, len(kept))
+        self.assertEqual(sorted(kept, key=words.index), kept)
+        self.assertEqual(0.08, sample.rate)
+        self.assertEqual(kept, self.sampleWords(input_file, gramutil.LineSample(size=40, seed=1)))
+
+    def testRangeJob(self):
+        words = [lineWord(i) for i in xrange(1000)]
+        input_file = self.writeInput('\n'.join(words) + '\n')
+        kept = []
+        for _ in xrange(2):
+            sample = gramutil.LineSample(rate=0.5, seed=2)
+            outputs = [(1, self.path('range1'))]
+            self.runJob(gramutil.RangeJob(input_file, outputs, 500, sample=True), sample=sample)
+            kept.append(self.readLines(self.path('range1')))
+            self.assertEqual(1000, sample.seen)
+            self.assertEqual(len(kept[-1]), sample.kept)
+        self.assertEqual(kept[0], kept[1])
+
+    def testFusedRate(self):
+        input_file = self.writeInput('\n'.join('love to embrace challenge %s' % lineWord(i)
+                                               for i in xrange(200)))
+        candidate_file = self.writeInput('love\tto\n', 'candidates.txt')
+        sample = gramutil.LineSample(rate=0.5, seed=3)
+        process = data_process.Process(self.path('grams.txt'), candidate_file,
+                                       self.path('scores.txt'))
+        process.buildTrie(inputFile=input_file, sample=sample)
+        self.assertEqual(sample.rate, process._sampleRate)
+        self.assertNotEqual(1.0, process._sampleRate)
+
+
+class ScoreTest(GramTestCase):
+
+    GRAMS = ['love\tto\tembrace'] * 3 + ['gram\ttrie\tlove'] + ['to\tembrace\tgram'] * 2 + \
+        ['trie\tgram\tto']
+
+    def scores(self, sample_rate):
+        gram_file = self.writeInput('\n'.join(self.GRAMS) + '\n', 'grams.txt')
+        candidate_file = self.writeInput('love\tto\ngram\ttrie\n', 'candidates.txt')
+        score_file = self.path('scores.txt')
+        process = data_process.Process(gram_file, candidate_file, score_file,
+                                       sampleRate=sample_rate)
+        process.buildTrie()
+        process.generateScore()
+        with open(score_file) as fd:
+            return dict((gram, float(score)) for gram, score in
+                        (line.rstrip('\n').rsplit('\t', 1) for line in fd))
+
+    def testSampleRate(self):
+        full = self.scores(1.0)
+        sampled = self.scores(0.5)
+        # probabilities are estimated alike, the counts they are weighted
+        # with and filtered by are scaled
+        self.assertEqual(['love\tto'], full.keys())
+        self.assertEqual(['gram\ttrie', 'love\tto'], sorted(sampled.keys()))
+        self.assertAlmostEqual(2 * full['love\tto'], sampled['love\tto'], delta=0.01)
+
+
+class PhraseFilterTest(GramTestCase):
+
+    def filter(self, phrases, text):
+        phrase_filter = gramutil.PhraseFilter(phrases)
+        return list(phrase_filter.filter(text.split()))
+
+    def testPhrase(self):
+        phrases = ['love to\n']
+        self.assertEqual(['we', None, 'embrace'], self.filter(phrases, 'we love to embrace'))
+        self.assertEqual(['love', None], self.filter(phrases, 'love love to'))
+        self.assertEqual(['we', 'love'], self.filter(phrases, 'we love'))
+        # phrases are tokenized like the text
+        self.assertEqual([None, None], self.filter(['Love, TO\n'], 'love to love to'))
+
+    def testOverlapping(self):
+        # the phrase ending first is dropped, the words it shares with the
+        # other one with it
+        phrases = ['love to\n', 'to embrace\n']
+        self.assertEqual(['we', None, 'embrace', 'it'],
+                         self.filter(phrases, 'we love to embrace it'))
+        self.assertEqual(['we', None, 'it'], self.filter(phrases, 'we to embrace it'))
+
+    def testSuffix(self):
+        phrases = ['love to embrace\n', 'to embrace\n']
+        self.assertEqual(['we', None, 'it'], self.filter(phrases, 'we love to embrace it'))
+        self.assertEqual(['like', None], self.filter(phrases, 'like to embrace'))
+        # a phrase ending inside a longer one, found by the failure links
+        phrases = ['love to embrace challenge\n', 'to embrace\n']
+        self.assertEqual(['love', None, 'it'], self.filter(phrases, 'love to embrace it'))
+        self.assertEqual(['we', 'love', None, 'it'],
+                         self.filter(phrases, 'we love to embrace it'))
+
+    def testFailure(self):
+        phrases = ['love to embrace\n', 'to trie\n']
+        self.assertEqual(['love', 'to', None], self.filter(phrases, 'love to love to embrace'))
+        self.assertEqual(['love', None], self.filter(phrases, 'love to trie'))
+        self.assertEqual(['love', 'to', 'gram'], self.filter(phrases, 'love to gram'))
+
+    def testBreak(self):
+        phrase_filter = gramutil.PhraseFilter(['love to\n'])
+        self.assertEqual(['love', None, 'to'], list(phrase_filter.filter(['love', None, 'to'])))
+
+    def testLines(self):
+        # a phrase crossing lines of the text is dropped, no gram spans it
+        input_file = self.writeInput('we love\nto embrace\nlove\n\nto\n')
+        fd = Sink()
+        gramutil.prepareFile(input_file, [2], [fd],
+                             phrases=gramutil.PhraseFilter(['love to\n']))
+        self.assertEqual(['we\n', 'embrace\n'], fd.lines)
+
+    def testChars(self):
+        phrase_filter = gramutil.PhraseFilter([u'天地\n'.encode('utf-8')], chars=True)
+        chars = gramutil.CharTokenizer().splitText(u'人天地人'.encode('utf-8'))
+        self.assertEqual([u'人'.encode('utf-8'), None, u'人'.encode('utf-8'), None],
+                         list(phrase_filter.filter(chars)))
+
+
+class ParallelTrieTest(GramTestCase):
+
+    CANDIDATES = 'love\tto\ngram\ttrie\nto\tembrace\nembrace\tlove\n'
+
+    def build(self, gram_file, chars=False, processes=None):
+        candidate_file = self.writeInput(self.CANDIDATES, 'candidates.txt')
+        process = data_process.Process(gram_file, candidate_file,
+                                       self.path('scores%s.txt' % processes), chars=chars)
+        process.buildTrie(processes=processes)
+        return process
+
+    def checkTries(self, text, chars=False, name='grams.txt'):
+        gram_file = self.path(name)
+        with gramutil.openFile(gram_file, 'w') as fd:
+            fd.write(text)
+        want = self.build(gram_file, chars)
+        got = self.build(gram_file, chars, processes=3)
+        for want_trie, got_trie in ((want._pretrie, got._pretrie),
+                                    (want._posttrie, got._posttrie)):
+            self.assertTrue(isinstance(got_trie, pygtrie.FrozenTrie))
+            self.assertEqual(len(want_trie), len(got_trie))
+            self.assertEqual(want_trie.items(), got_trie.items())
+            self.assertEqual(want_trie.prefix_sum(), got_trie.prefix_sum())
+            for key, _ in want_trie.iteritems():
+                prefix = key[:1] if chars else key.split('\t', 1)[0]
+                self.assertEqual(want_trie.has_node(prefix), got_trie.has_node(prefix))
+                self.assertEqual(want_trie.prefix_sum(prefix), got_trie.prefix_sum(prefix))
+        want.generateScore()
+        got.generateScore()
+        self.assertEqual(self.readLines(want._scoreFile), self.readLines(got._scoreFile))
+        return got
+
+    def testWords(self):
+        rng = random.Random(29)
+        grams = ['\t'.join(rng.choice(WORDS[:8]).lower() for _ in xrange(rng.randint(2, 3)))
+                 for _ in xrange(500)]
+        # combined records are added up, blank lines counted as sequentially
+        self.checkTries('\n'.join(grams) + '\n\nlove\tto\tembrace\t7\n')
+
+    def testChars(self):
+        rng = random.Random(31)
+        grams = ['\t'.join(rng.choice(CHARS).encode('utf-8') for _ in xrange(3))
+                 for _ in xrange(300)]
+        self.checkTries('\n'.join(grams) + '\n', chars=True)
+
+    def testCompressed(self):
+        self.checkTries('love\tto\tembrace\ngram\ttrie\tlove\nto\tembrace\n',
+                        name='grams.txt.gz')
+
+    def testSmall(self):
+        # fewer lines than workers, and none
+        self.checkTries('love\tto\tembrace\n')
+        self.checkTries('')
+
+    def testNoFilesLeft(self):
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            process = self.checkTries('love\tto\tembrace\ngram\ttrie\tlove\n')
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(['candidates.txt', 'grams.txt', 'scores3.txt', 'scoresNone.txt'],
+                         sorted(os.listdir(self.dir)))
+        # a saved trie is scored the same
+        process.saveTrie(self.path('saved'))
+        loaded = self.build(self.path('grams.txt'))
+        loaded._scoreFile = self.path('loaded.txt')
+        loaded.generateScore(self.path('saved'))
+        self.assertEqual(self.readLines(process._scoreFile), self.readLines(loaded._scoreFile))
+
+
+class ManifestTest(GramTestCase):
+
+    def testChanges(self):
+        manifest_file = self.path('manifest.json')
+        manifest = gramutil.Manifest(manifest_file)
+        input_file = self.writeInput('love to embrace\n')
+        self.assertTrue(manifest.changed(input_file))
+        self.assertFalse(input_file in manifest)
+        manifest.update(input_file)
+        manifest.save()
+
+        manifest = gramutil.Manifest(manifest_file)
+        self.assertTrue(input_file in manifest)
+        self.assertEqual([os.path.abspath(input_file)], manifest.files())
+        self.assertFalse(manifest.changed(input_file))
+        # touched but identical
+        os.utime(input_file, (0, 0))
+        self.assertFalse(manifest.changed(input_file))
+        self.writeInput('love to embrace a challenge\n')
+        self.assertTrue(manifest.changed(input_file))
+        manifest.remove(input_file)
+        self.assertFalse(input_file in manifest)
+        self.assertEqual([], manifest.files())
+
+
+class FolderTestCase(GramTestCase):
+    """Runs of the folder-support scripts on a directory of sources"""
+
+    def setUp(self):
+        super(FolderTestCase, self).setUp()
+        self.rng = random.Random(37)
+        os.mkdir(self.path('sources'))
+        for index in xrange(3):
+            self.writeSource('s%d.txt' % index)
+
+    def writeSource(self, name):
+        self.writeInput(randomText(self.rng, 100), os.path.join('sources', name))
+
+    def runFolder(self, name, shards=None, mapped=False, incremental=False, merged=False):
+        """Prepare the sources to directories named after name and score them
+        Return:
+            dict of score file name to its lines
+        """
+        dirs = [self.path('%s-%s' % (name, kind))
+                for kind in ('grams', 'candidates', 'pickles', 'scores')]
+        gram_dir, candidate_dir, pickle_dir, score_dir = dirs
+        for path in dirs:
+            if not os.path.exists(path):
+                os.mkdir(path)
+        # scores of this run only
+        shutil.rmtree(score_dir)
+        os.mkdir(score_dir)
+        with captured():
+            manifest_file = os.path.join(pickle_dir, 'sources.json') if incremental else None
+            prep = folder_prepare.PrepareWords(self.path('sources'), gram_dir, candidate_dir,
+                                               manifest_file=manifest_file, shards=shards)
+            prep.prepareGram(3)
+            prep.prepareCandidate(2)
+            prep.run()
+            process = folder_process.Process(gram_dir, candidate_dir, score_dir, pickle_dir,
+                                             mapped=mapped)
+            process.buildTrie(incremental=incremental)
+            if merged:
+                self.assertTrue(process.mergeTries())
+            process.loadTrie(merged=merged)
+            process.generateScore()
+        return dict((file, self.readLines(os.path.join(score_dir, file)))
+                    for file in os.listdir(score_dir))
+
+
+class IncrementalTest(FolderTestCase):
+
+    def checkSteps(self, shards=None, mapped=False):
+        steps = [('first', lambda: None),
+                 ('add', lambda: self.writeSource('s3.txt')),
+                 ('modify', lambda: self.writeSource('s1.txt')),
+                 ('remove', lambda: os.remove(self.path('sources/s0.txt')))]
+        for step, change in steps:
+            change()
+            got = self.runFolder('incremental', shards, mapped, incremental=True)
+            want = self.runFolder(step, shards, mapped)
+            self.assertTrue(any(want.values()))
+            self.assertEqual(want, got, step)
+
+    def testFiles(self):
+        self.checkSteps()
+
+    def testMapped(self):
+        self.checkSteps(mapped=True)
+
+    def testShards(self):
+        self.checkSteps(shards=3)
+
+    def testMappedShards(self):
+        self.checkSteps(shards=3, mapped=True)
+
+
+class MergeTest(FolderTestCase):
+
+    def setUp(self):
+        super(MergeTest, self).setUp()
+        # merged over a few rounds
+        for index in xrange(3, 7):
+            self.writeSource('s%d.txt' % index)
+
+    def testScores(self):
+        for name, mapped in (('pickled', False), ('mapped', True)):
+            want = self.runFolder(name, mapped=mapped)
+            got = self.runFolder(name, mapped=mapped, merged=True)
+            self.assertTrue(any(want.values()))
+            self.assertEqual(want, got, name)
+
+    def testError(self):
+        self.runFolder('error')
+        pickle_dir = self.path('error-pickles')
+        with captured():
+            process = folder_process.Process(self.path('error-grams'),
+                                             self.path('error-candidates'),
+                                             self.path('error-scores'), pickle_dir)
+        trie_files = process.getTrieFiles()
+        with open(trie_files[3], 'wb') as fd:
+            fd.write('broken')
+        with captured('stderr') as stderr:
+            self.assertFalse(process.mergeTries())
+        self.assertTrue(stderr.getvalue().startswith('Failed merging tries'))
+        self.assertTrue(trie_files[3] in stderr.getvalue())
+        # intermediate merges are removed, no merged trie is written
+        self.assertEqual(sorted(map(os.path.basename, trie_files)), sorted(os.listdir(pickle_dir)))
+
+
+class ScheduleTest(GramTestCase):
+
+    def testSchedule(self):
+        os.mkdir(self.path('inputs'))
+        sizes = [30, 500, 5, 100, 60, 20, 300, 50, 10]
+        files = dict((self.writeInput('x' * size, os.path.join('inputs', 'f%d' % size)), size)
+                     for size in sizes)
+        prep = folder_prepare.PrepareWords(self.path('inputs'), self.dir, self.dir,
+                                           batch_size=100)
+        tasks = prep.schedule(dict((file, [(3, self.dir)]) for file in files))
+        # largest first, files under batch_size grouped until it is reached
+        self.assertEqual([[500], [300], [100], [60, 50], [30, 20, 10, 5]],
+                         [[files[args[0]] for args in task] for task in tasks])
+        self.assertEqual([(3, self.dir)], tasks[0][0][1])
+
+    def testBatchErrors(self):
+        input_file = self.writeInput('love to embrace a challenge\n')
+        missing = self.path('missing.txt')
+        os.mkdir(self.path('grams'))
+        report = folder_prepare.prepareBatch([(missing, [(2, self.path('grams'))]),
+                                              (input_file, [(2, self.path('grams'))])])
+        self.assertEqual([missing, input_file], [file for file, _, _, _ in report])
+        # a failed file does not stop the others of its task
+        self.assertTrue('IOError' in report[0][2])
+        self.assertEqual(None, report[1][2])
+        self.assertEqual(['love\tto\n', 'to\tembrace\n', 'embrace\tchallenge\n', 'challenge\n'],
+                         self.readLines(self.path('grams/input.txt')))
+
+
+class FusedTrieTest(GramTestCase):
+
+    def score(self, name, input_file=None, **kwargs):
+        """Score lines of the candidates, by grams counted straight from
+        input_file if given, otherwise read from the gram file
+        """
+        process = data_process.Process(self.path('grams.txt'), self.path('candidates.txt'),
+                                       self.path(name))
+        process.buildTrie(input_file, **kwargs)
+        process.generateScore()
+        return self.readLines(self.path(name))
+
+    def testScores(self):
+        input_file = self.writeInput(randomText(random.Random(37), 300))
+        data_preparation.PrepareMulti(input_file, [(3, self.path('grams.txt')),
+                                                   (2, self.path('candidates.txt'))])
+        grams = self.readLines(self.path('grams.txt'))
+        want = self.score('file.txt')
+        self.assertTrue(want)
+        self.assertEqual(want, self.score('fused.txt', input_file))
+        # the grams written on the way are those of the gram file
+        os.remove(self.path('grams.txt'))
+        self.assertEqual(want, self.score('written.txt', input_file, writeGrams=True))
+        self.assertEqual(grams, self.readLines(self.path('grams.txt')))
+        # the cache built by the first run is read by the second
+        cache = self.path('cache')
+        self.assertEqual(want, self.score('built.txt', input_file, cacheFile=cache))
+        self.assertTrue(gramutil.TokenCache(cache).exists(input_file))
+        self.assertEqual(want, self.score('cached.txt', input_file, cacheFile=cache))
+
+
+class MmapScanTest(GramTestCase):
+
+    def prepare(self, input_file, use_mmap, **kwargs):
+        fds = [Sink(), Sink()]
+        gramutil.prepareFile(input_file, [1, 3], fds, use_mmap=use_mmap, **kwargs)
+        return [fd.lines for fd in fds]
+
+    def checkScan(self, text, chars=False):
+        input_file = self.writeInput(text)
+        want = self.prepare(input_file, False, chars=chars)
+        self.assertEqual(want, self.prepare(input_file, True, chars=chars))
+        # filtered blocks are copied out of the map
+        self.assertEqual(self.prepare(input_file, False, chars=chars,
+                                      dedup=gramutil.DedupSet(min_length=1)),
+                         self.prepare(input_file, True, chars=chars,
+                                      dedup=gramutil.DedupSet(min_length=1)))
+
+    def testWords(self):
+        rng = random.Random(41)
+        for lines in (1, 10, 400):
+            self.checkScan(randomText(rng, lines))
+
+    def testBlocks(self):
+        # lines across blocks and a block without a line end
+        text = randomText(random.Random(43), 300)
+        block_size = gramutil.Tokenizer.BLOCK_SIZE
+        gramutil.Tokenizer.BLOCK_SIZE = 100
+        try:
+            self.checkScan(text)
+            self.checkScan(text.rstrip('\n') + ' love')
+        finally:
+            gramutil.Tokenizer.BLOCK_SIZE = block_size
+
+    def testChars(self):
+        self.checkScan(randomText(random.Random(47), 200, chars=True), chars=True)
+
+    def testEmpty(self):
+        self.checkScan('')
+        self.checkScan('\n\n')
+
+    def testRange(self):
+        input_file = self.writeInput(randomText(random.Random(53), 200))
+        tokenizer = gramutil.Tokenizer()
+        for start, end in gramutil.splitRanges(input_file, 500):
+            with open(input_file, 'rb') as fd:
+                fd.seek(start)
+                lines = fd.read(end - start).splitlines(True)
+            self.assertEqual(list(tokenizer.tokenize(lines)),
+                             list(tokenizer.scanFile(input_file, start, end)))
+
+
+class CompressedTest(GramTestCase):
+
+    TEXT = randomText(random.Random(59), 300)
+
+    def testRoundTrips(self):
+        for ext in gramutil.COMPRESSED_EXTENSIONS:
+            if ext in ('.xz', '.lzma') and gramutil.lzma is None:
+                continue
+            path = self.path('text.txt' + ext)
+            with gramutil.openFile(path, 'w') as fd:
+                fd.write(self.TEXT)
+            with open(path, 'rb') as fd:
+                self.assertNotEqual(self.TEXT, fd.read(), ext)
+            with gramutil.openFile(path) as fd:
+                self.assertEqual(self.TEXT.splitlines(True), list(fd), ext)
+            with gramutil.openFile(path) as fd:
+                self.assertEqual(self.TEXT, ''.join(fd.blocks()), ext)
+            with gramutil.openFile(path, threaded=False) as fd:
+                self.assertEqual(self.TEXT, fd.read(), ext)
+
+    def testPrepare(self):
+        plain = self.writeInput(self.TEXT)
+        want = self.readLines(self.prepareSequential(plain, [2])[0][1])
+        for ext in ('.gz', '.bz2'):
+            input_file = self.path('input.txt' + ext)
+            with gramutil.openFile(input_file, 'w') as fd:
+                fd.write(self.TEXT)
+            output = self.path('grams.txt' + ext)
+            # larger than the chunk size, but not split into byte ranges
+            prep = data_preparation.PrepareWords(input_file, output, self.path('unused'),
+                                                 processes=2, chunkSize=64)
+            prep.prepareGram(2)
+            with captured():
+                prep.run()
+            with gramutil.openFile(output) as fd:
+                self.assertEqual(want, list(fd), ext)
+
+
+class TokenStatsTest(GramTestCase):
+
+    TEXT = 'Love to x, 42 abc1 a1b\naaa zz hellooo EMBRACE\n\nto-be\n'
+
+    def testRejected(self):
+        input_file = self.writeInput(self.TEXT)
+        stats = data_preparation.PrepareMulti(input_file, [(1, self.path('grams.txt'))],
+                                              profile=True)
+        self.assertEqual({'length': 1, 'number': 1, 'alnum': 2, 'single_repeat': 2,
+                          'triple_repeat': 1}, dict(stats.rejected))
+        self.assertEqual(4, stats.counts['lines'])
+        self.assertEqual(12, stats.counts['tokens_in'])
+        self.assertEqual(5, stats.counts['tokens_out'])
+        self.assertEqual(1, stats.counts['files'])
+        # the words kept are those of the plain tokenizer
+        self.assertEqual(self.readLines(self.prepareSequential(input_file, [1])[0][1]),
+                         self.readLines(self.path('grams.txt')))
+        report = stats.report()
+        self.assertEqual(dict(stats.rejected), report['rejected'])
+        self.assertTrue(stats.seconds['total'] > 0)
+        self.assertEqual(set(stats.seconds), set(report['seconds']))
+
+    def testRanges(self):
+        # stats of byte ranges add up to those of the whole file
+        input_file = self.writeInput(randomText(random.Random(61), 300))
+        want = data_preparation.PrepareMulti(input_file, [(1, self.path('seq1'))],
+                                             profile=True)
+        job = gramutil.RangeJob(input_file, [(1, self.path('range1'))], 200, profile=True)
+        got = self.runJob(job)
+        self.assertEqual(want.rejected, got.rejected)
+        self.assertEqual(want.counts['tokens_in'], got.counts['tokens_in'])
+        self.assertEqual(want.counts['tokens_out'], got.counts['tokens_out'])
+
+
+class CharScoreTest(GramTestCase):
+
+    def testScores(self):
+        rng = random.Random(67)
+        # few characters, so that pairs are met often enough to be scored
+        text = '\n'.join(u''.join(rng.choice(CHARS[:4] + [u'，'])
+                                  for _ in xrange(rng.randint(0, 10))).encode('utf-8')
+                         for _ in xrange(60))
+        input_file = self.writeInput(text)
+        gram_file, candidate_file = self.path('grams.txt'), self.path('candidates.txt')
+        prep = data_preparation.PrepareWords(input_file, gram_file, candidate_file,
+                                             processes=1, chars=True)
+        prep.prepareGram(3)
+        prep.prepareCandidate(2)
+        with captured():
+            prep.run()
+        process = data_process.Process(gram_file, candidate_file, self.path('scores.txt'),
+                                       chars=True)
+        process.buildTrie()
+        process.generateScore()
+        # counts of the grams starting with each run of characters
+        sums = collections.Counter()
+        for line in self.readLines(gram_file):
+            chars = line.rstrip('\n').split('\t')
+            for i in xrange(1, len(chars) + 1):
+                sums[tuple(chars[:i])] += 1
+        total = len(self.readLines(gram_file))
+        want = []
+        for line in self.readLines(candidate_file):
+            pair = tuple(line.rstrip('\n').split('\t'))
+            if len(pair) == 2 and 2 <= sums[pair] <= 24:
+                pmi = math.log(float(sums[pair]) * total / sums[pair[:1]] / sums[pair[1:]], 2)
+                want.append('%s\t%.2f\n' % ('\t'.join(pair), pmi * sums[pair]))
+        self.assertTrue(want)
+        self.assertEqual(want, self.readLines(self.path('scores.txt')))
+
+
+class CombinedScoreTest(GramTestCase):
+
+    CANDIDATES = 'love\tto\nto\tembrace\ngram\ttrie\n'
+
+    def score(self, gram_file, name, processes=None):
+        candidate_file = self.writeInput(self.CANDIDATES, 'candidates.txt')
+        process = data_process.Process(gram_file, candidate_file, self.path(name))
+        process.buildTrie(processes=processes)
+        process.generateScore()
+        return process, self.readLines(self.path(name))
+
+    def testSplitRecords(self):
+        lines = self.writeInput('love\tto\tembrace\n' * 6 + 'to\tembrace\tgram\n' * 3 +
+                                'gram\ttrie\n' * 2 + 'embrace\tgram\n' * 2 + 'trie\tlove\n',
+                                'lines.txt')
+        # records of a gram split across ranges or spills, plain lines mixed in
+        records = self.writeInput('love\tto\tembrace\t2\ngram\ttrie\t2\nto\tembrace\tgram\n'
+                                  'love\tto\tembrace\t3\nto\tembrace\tgram\t2\n'
+                                  'love\tto\tembrace\nembrace\tgram\t2\ntrie\tlove\t1\n',
+                                  'records.txt')
+        want_process, want = self.score(lines, 'want.txt')
+        self.assertEqual(3, len(want))
+        for processes in (None, 2):
+            process, got = self.score(records, 'got%s.txt' % processes, processes)
+            self.assertEqual(want, got)
+            self.assertEqual(want_process._pretrie.items(), process._pretrie.items())
+            self.assertEqual(want_process._posttrie.items(), process._posttrie.items())
+
+    def testPrepared(self):
+        input_file = self.writeInput(randomText(random.Random(71), 400))
+        scores = []
+        for combine in (False, True):
+            gram_file = self.path('grams%s.txt' % combine)
+            job = gramutil.RangeJob(input_file, [(3, gram_file)], 300, combine=combine)
+            self.runJob(job)
+            scores.append(self.score(gram_file, 'scores%s.txt' % combine)[1])
+        self.assertTrue(scores[0])
+        self.assertEqual(scores[0], scores[1])
+
+
+class Sink(object):
+    """File like sink keeping the lines written to it"""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+
+if __name__ == '__main__':
+    unittest.main()